@@ -6,6 +6,7 @@ to run BET.
 """
 
 import collections
+import numpy as np
 
 
 class comm_for_no_mpi4py(object):
@@ -108,6 +109,62 @@ class comm_for_no_mpi4py(object):
         """
         return val
 
+    def Allgatherv(self, val, val2=None):
+        """
+        :param val: buffer to Allgatherv, or a list whose first entry is the
+            buffer
+        :param val2: buffer receiving ``val``, or a list whose first entry is
+            the buffer
+
+        :rtype: object
+        :returns: val
+
+        """
+        if val2 is not None:
+            if isinstance(val, (list, tuple)):
+                val = val[0]
+            if isinstance(val2, (list, tuple)):
+                val2 = val2[0]
+            val2[...] = np.reshape(val, val2.shape)
+        return val
+
+    def Gatherv(self, val, val2=None, root=0):
+        """
+        :param val: buffer to Gatherv, or a list whose first entry is the
+            buffer
+        :param val2: buffer receiving ``val``, or a list whose first entry is
+            the buffer
+        :param int root: 0
+
+        :rtype: object
+        :returns: val
+
+        """
+        return self.Allgatherv(val, val2)
+
+    def alltoall(self, val):
+        """
+        :param list val: list with one object to send to each processor
+
+        :rtype: list
+        :returns: val
+
+        """
+        return val
+
+    def Alltoallv(self, val, val2=None):
+        """
+        :param val: buffer to Alltoallv, or a list whose first entry is the
+            buffer
+        :param val2: buffer receiving ``val``, or a list whose first entry is
+            the buffer
+
+        :rtype: object
+        :returns: val
+
+        """
+        return self.Allgatherv(val, val2)
+
     def Allreduce(self, val1, val2=None, op=None):
         """
         :param object val1: object to Allreduce
@@ -170,10 +227,14 @@ class MPI_for_no_mpi4py(object):
         #: fake sum
         self.SUM = None
         self.MAX = None
+        #: fake logical and
+        self.LAND = None
         #: float type
         self.DOUBLE = float
         #: int type
         self.INT = int
+        #: 64 bit int type
+        self.INT64_T = np.int64
         #: bool type
         self.BOOL = bool
 
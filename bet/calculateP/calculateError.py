@@ -154,7 +154,10 @@ class sampling_error(object):
     def __init__(self, disc, exact=True):
         """
 
-        Set things up for a given discretization
+        Set things up for a given discretization. The connectivity of the
+        cells needs the global input values, so the input sample set can not
+        be in distributed mode, see
+        :meth:`bet.sample.sample_set_base.set_distributed`.
 
         :param disc: An object containing the discretization information.
         :type disc: :class:`bet.sample.discretization`
@@ -166,6 +169,10 @@ class sampling_error(object):
         if not isinstance(disc, samp.discretization):
             msg = "The argument must be of type bet.sample.discretization."
             raise wrong_argument_type(msg)
+        if disc._input_sample_set.get_distributed():
+            msg = "sampling_error needs the global input values, which are "
+            msg += "not formed in distributed mode."
+            raise NotImplementedError(msg)
 
         #: :class:`bet.sample.discretization` that defines the problem
         self.disc = disc
@@ -273,7 +280,7 @@ class sampling_error(object):
 
         # Set up discretizations
         if emulated_set is not None:
-            disc = self.disc.copy()
+            disc = self.disc.shallow_copy()
             disc.set_emulated_input_sample_set(emulated_set)
             disc.set_emulated_ii_ptr(globalize=False)
             disc_new = samp.discretization(input_sample_set=s_set,
@@ -295,7 +302,7 @@ class sampling_error(object):
             disc_new.set_emulated_ii_ptr(globalize=False)
         else:
             logging.warning("Using MC assumption for calculating volumes.")
-            disc = self.disc.copy()
+            disc = self.disc.shallow_copy()
             disc.set_emulated_input_sample_set(disc._input_sample_set)
             disc.set_emulated_ii_ptr(globalize=False)
 
@@ -485,7 +492,7 @@ class model_error(object):
             self.disc.globalize_ptrs()
             self.disc_new.globalize_ptrs()
 
-            disc = self.disc.copy()
+            disc = self.disc.shallow_copy()
             disc.set_emulated_input_sample_set(emulated_set)
             disc.set_emulated_ii_ptr(globalize=False)
 
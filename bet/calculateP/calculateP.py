@@ -8,19 +8,183 @@ This module provides methods for calulating the probability measure
     calculates the probability for a set of emulation points.
 * :mod:`~bet.calculateP.calculateP.prob` estimates the 
     probability based on pre-defined volumes.
+* :mod:`~bet.calculateP.calculateP.prob_batch` estimates the probability
+    based on pre-defined volumes for many output probabilities at once.
 * :mod:`~bet.calculateP.calculateP.prob_with_emulated` estimates the 
     probability using volume emulation.
 * :mod:`~bet.calculateP.calculateP.prob_from_sample_set` estimates the 
     probability based on probabilities from another sample set on the same
     space.
+* :mod:`~bet.calculateP.calculateP.prob_streaming` estimates the
+    probability based on pre-defined volumes for samples read in chunks.
+* :class:`~bet.calculateP.calculateP.transfer_operator` maps probabilities
+    from one sample set to another on the same space, and can be reused for
+    many probability vectors.
 
 """
+import os
+import functools
 import logging
 import numpy as np
+import scipy.sparse as sparse
 from bet.Comm import comm, MPI
 import bet.util as util
 import bet.sample as samp
 
+try:
+    #: types of file names, including ``unicode`` on Python 2
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+
+def _scatter_cell_probabilities(ptr, cell_prob, cell_sum, weights=None):
+    r"""
+    Divides the probability ``cell_prob`` of each cell among the entries of
+    ``ptr`` in the cell in proportion to ``weights``, whose sum over the cell
+    is ``cell_sum``. Entries in cells with no probability or a zero sum, or
+    outside of the cells, get no probability.
+
+    :param ptr: cell of each entry
+    :type ptr: :class:`numpy.ndarray` of int of shape (local_num,)
+    :param cell_prob: probability of each cell
+    :type cell_prob: :class:`numpy.ndarray` of shape (num,)
+    :param cell_sum: sum of ``weights`` over each cell
+    :type cell_sum: :class:`numpy.ndarray` of shape (num,)
+    :param weights: weight of each entry, 1 if None
+    :type weights: :class:`numpy.ndarray` of shape (local_num,)
+
+    :rtype: :class:`numpy.ndarray` of shape (local_num,)
+    :returns: probability of each entry
+
+    """
+    ptr = np.ravel(ptr)
+    num = len(cell_prob)
+    P = np.zeros((len(ptr),))
+    inside = np.flatnonzero(np.logical_and(ptr >= 0, ptr < num))
+    cells = ptr[inside]
+    has_prob = np.logical_and(cell_prob[cells] > 0.0, cell_sum[cells] > 0)
+    inside = inside[has_prob]
+    cells = cells[has_prob]
+    if weights is None:
+        P[inside] = cell_prob[cells]/cell_sum[cells]
+    else:
+        P[inside] = cell_prob[cells]*np.ravel(weights)[inside]/cell_sum[cells]
+    return P
+
+
+def _saved_chunks(file_name, discretization_name, chunk_size):
+    """
+    Yields ``(None, outputs, volumes)`` chunks of at most ``chunk_size`` of
+    the rows this processor holds, see
+    :meth:`~bet.sample.sample_set_base.global_to_local`, of the output values
+    and input volumes of a discretization saved to ``file_name``.
+    """
+    out_key = discretization_name + '_output_sample_set_values'
+    vol_key = discretization_name + '_input_sample_set_volumes'
+    num = samp.saved_shapes(file_name)[out_key][0]
+    (num_local, remainder) = divmod(int(num), comm.size)
+    start = comm.rank*num_local + min(comm.rank, remainder)
+    stop = start + num_local + (comm.rank < remainder)
+    for first in range(start, stop, chunk_size):
+        rows = slice(first, min(first + chunk_size, stop))
+        yield (None, samp.load_rows(file_name, out_key, rows),
+               samp.load_rows(file_name, vol_key, rows, vector=True))
+
+
+def prob_streaming(chunks, output_probability_set, file_name,
+                   discretization_name=None, chunk_size=None):
+    r"""
+    Calculates :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples}})` as in
+    :meth:`prob` for samples which are only read a chunk at a time, e.g.
+    from a generator or from disk, so that memory is bounded by the chunk
+    size. A first pass queries the output samples of each chunk, writes the
+    pointers to the output cells to ``file_name`` and sums the volumes over
+    each output cell. A second pass writes the probabilities of the samples
+    of each chunk to ``file_name``.
+
+    The results are appended a chunk at a time to the
+    :class:`~bet.sample.chunked_store` of ``file_name`` as the io pointer of
+    the discretization ``discretization_name`` and the probabilities of its
+    input sample set, so they can be read with
+    :func:`~bet.sample.load_rows` or with the discretization if
+    ``file_name`` is the file it was saved to. With several processors each
+    processor streams its own chunks and writes to its own
+    ``proc{rank}_file_name``, and the sums are reduced with a single
+    ``Allreduce``.
+
+    :param chunks: callable returning a new iterable of ``(inputs, outputs,
+        volumes)`` chunks for each pass, e.g. a generator function, of which
+        only the values of the output samples and the volumes of the input
+        samples are used, or the name of a file a discretization was saved
+        to with :func:`~bet.sample.save_discretization`
+    :type chunks: callable or string
+    :param output_probability_set: output cells with probabilities
+    :type output_probability_set: :class:`~bet.sample.sample_set_base`
+    :param string file_name: Name of the file to write the results to
+    :param string discretization_name: name of the discretization in
+        ``chunks`` and ``file_name``
+    :param int chunk_size: maximum number of rows read from a file or
+        queried at a time
+
+    :rtype: :class:`numpy.ndarray` of shape (num_cells,)
+    :returns: sums of the volumes of the input samples over each output cell
+
+    """
+    if discretization_name is None:
+        discretization_name = 'default'
+    if chunk_size is None:
+        chunk_size = samp.default_query_chunk_size
+    chunk_size = int(chunk_size)
+    if isinstance(chunks, _string_types):
+        chunks = functools.partial(_saved_chunks, chunks, discretization_name,
+                                   chunk_size)
+    if comm.size > 1:
+        file_name = os.path.join(os.path.dirname(file_name), "proc{}_{}".
+                                 format(comm.rank, os.path.basename(file_name)))
+    store = samp.chunked_store(samp._chunked_path(file_name))
+    input_name = discretization_name + '_input_sample_set'
+    op_num = output_probability_set.check_num()
+    cell_prob = _global_probabilities(output_probability_set)
+
+    # first pass, sum the volumes in each output cell
+    Itemp_sum = np.zeros((op_num,))
+    num_chunks = 0
+    for (_, outputs, volumes) in chunks():
+        if len(np.ravel(volumes)) == 0:
+            continue
+        ptr = output_probability_set.query_chunked(
+            util.fix_dimensions_data(outputs, output_probability_set._dim),
+            chunk_size=chunk_size)
+        store.append_rows(discretization_name, 'bet.sample.discretization',
+                          '_io_ptr', ptr, new=num_chunks == 0)
+        Itemp_sum += samp.cell_sum(ptr, op_num, volumes, globalize=False)
+        num_chunks += 1
+    Itemp_local = np.copy(Itemp_sum)
+    comm.Allreduce([Itemp_local, MPI.DOUBLE], [Itemp_sum, MPI.DOUBLE],
+                   op=MPI.SUM)
+    if num_chunks == 0:
+        return Itemp_sum
+
+    # second pass, write the probabilities of each chunk
+    ptr_chunks = store.iter_chunks(discretization_name, '_io_ptr')
+    num_written = 0
+    for (_, _, volumes) in chunks():
+        volumes = np.ravel(volumes)
+        if len(volumes) == 0:
+            continue
+        ptr = next(ptr_chunks, np.zeros((0,), dtype=int))
+        if len(ptr) != len(volumes):
+            raise samp.length_not_matching("Chunks differ between passes.")
+        store.append_rows(input_name, 'bet.sample.sample_set',
+                          '_probabilities', _scatter_cell_probabilities(
+                              ptr, cell_prob, Itemp_sum, volumes),
+                          new=num_written == 0)
+        num_written += 1
+    if num_written != num_chunks:
+        raise samp.length_not_matching("Chunks differ between passes.")
+    return Itemp_sum
+
 
 def prob_on_emulated_samples(discretization, globalize=True):
     r"""
@@ -47,19 +211,14 @@ def prob_on_emulated_samples(discretization, globalize=True):
     if discretization._emulated_ii_ptr_local is None:
         discretization.set_emulated_ii_ptr(globalize=False)
 
-    # Calculate Probabilties
-    P = np.zeros((discretization._emulated_input_sample_set.
-                  _values_local.shape[0],))
+    # Calculate Probabilties, counting the emulated samples in each output
+    # cell with a single Allreduce
     d_distr_emu_ptr = discretization._io_ptr[discretization.
                                              _emulated_ii_ptr_local]
-    for i in range(op_num):
-        if discretization._output_probability_set._probabilities[i] > 0.0:
-            Itemp = np.equal(d_distr_emu_ptr, i)
-            Itemp_sum = np.sum(Itemp)
-            Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-            if Itemp_sum > 0:
-                P[Itemp] = discretization._output_probability_set.\
-                    _probabilities[i]/Itemp_sum
+    Itemp_sum = samp.cell_sum(d_distr_emu_ptr, op_num)
+    P = _scatter_cell_probabilities(
+        d_distr_emu_ptr, discretization._output_probability_set.
+        _probabilities, Itemp_sum)
 
     discretization._emulated_input_sample_set._probabilities_local = P
     if globalize:
@@ -67,16 +226,75 @@ def prob_on_emulated_samples(discretization, globalize=True):
     pass
 
 
-def prob(discretization, globalize=True):
+def _update_probabilities(discretization, volumes_local, num):
+    r"""
+    Updates the probabilities of the input samples from the last incremental
+    call of :meth:`prob`, only for the samples in output cells whose samples
+    or probability changed since. The last call keeps private copies of its
+    pointers, volumes and probabilities, so arrays it returned do not change
+    and in-place edits of them are not reused. Returns None if there is no
+    last call for the same volumes and number of output cells. Must be called
+    on all processors.
+
+    :param discretization: An object containing the discretization information.
+    :type discretization: class:`bet.sample.discretization`
+    :param volumes_local: local volumes of the input samples
+    :type volumes_local: :class:`numpy.ndarray` of shape (local_num,)
+    :param int num: number of output cells
+
+    :rtype: tuple
+    :returns: (P_local, Itemp_sum) the local probabilities of the input
+        samples and the sums of the volumes over each output cell
+
+    """
+    if discretization._prob_state is None:
+        return None
+    (old_ptr, old_sum, old_prob, old_volumes, P_local) = \
+        discretization._prob_state
+    ptr = discretization._io_ptr_local
+    cell_prob = discretization._output_probability_set._probabilities
+    valid = len(old_sum) == num and len(old_ptr) == len(ptr) and \
+        np.array_equal(old_volumes, volumes_local)
+    if not comm.allreduce(valid, op=MPI.LAND):
+        return None
+
+    # move the volumes of the samples which changed cells with a single
+    # Allreduce
+    changed = np.flatnonzero(old_ptr != ptr)
+    Itemp_sum = old_sum + samp.cell_sum(
+        np.concatenate((ptr[changed], old_ptr[changed])), num,
+        np.concatenate((volumes_local[changed], -volumes_local[changed])))
+    affected = np.append(np.logical_or(Itemp_sum != old_sum,
+                                       cell_prob != old_prob), False)
+    rows = np.union1d(np.flatnonzero(affected[np.minimum(ptr, num)]),
+                      changed)
+    P_local = np.copy(P_local)
+    P_local[rows] = _scatter_cell_probabilities(
+        ptr[rows], cell_prob, Itemp_sum, volumes_local[rows])
+    return (P_local, Itemp_sum)
+
+
+def prob(discretization, globalize=True, incremental=False):
     r"""
     Calculates :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples}})`, the
     probability assoicated with a set of  cells defined by the model
     solves at :math:`(\lambda_{samples})` where the volumes of these 
     cells are provided.
 
+    With ``incremental`` the pointers, volumes and probabilities are kept.
+    When the output probability set of a later incremental call has the same
+    number of cells, e.g. after
+    :meth:`bet.sample.discretization.set_io_ptr` with ``incremental``, and
+    the volumes are equal, only the probabilities of the input samples in
+    the output cells whose samples or probability changed are computed
+    again, in a copy of the last probabilities.
+
     :param discretization: An object containing the discretization information.
     :type discretization: class:`bet.sample.discretization`
-    :param bool globalize: Makes local variables global.
+    :param bool globalize: Makes local variables global, unless the input
+        sample set is distributed.
+    :param bool incremental: flag whether or not to update the probabilities
+        of the last incremental call
 
     """
 
@@ -91,23 +309,131 @@ def prob(discretization, globalize=True):
     # Calculate Probabilities
     if discretization._input_sample_set._values_local is None:
         discretization._input_sample_set.global_to_local()
-    P_local = np.zeros((len(discretization._io_ptr_local),))
-    for i in range(op_num):
-        if discretization._output_probability_set._probabilities[i] > 0.0:
-            Itemp = np.equal(discretization._io_ptr_local, i)
-            Itemp_sum = np.sum(discretization._input_sample_set.
-                               _volumes_local[Itemp])
-            Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-            if Itemp_sum > 0:
-                P_local[Itemp] = discretization._output_probability_set.\
-                    _probabilities[i]*discretization._input_sample_set.\
-                    _volumes_local[Itemp]/Itemp_sum
-    if globalize:
+    volumes_local = discretization._input_sample_set._volumes_local
+    cell_prob = discretization._output_probability_set._probabilities
+    updated = None
+    if incremental:
+        updated = _update_probabilities(discretization, volumes_local, op_num)
+    if updated is not None:
+        (P_local, Itemp_sum) = updated
+    else:
+        # sum the volumes in each output cell with a single Allreduce
+        Itemp_sum = samp.cell_sum(discretization._io_ptr_local, op_num,
+                                  volumes_local)
+        P_local = _scatter_cell_probabilities(
+            discretization._io_ptr_local, cell_prob, Itemp_sum,
+            volumes_local)
+    if incremental:
+        discretization._prob_state = (
+            np.copy(discretization._io_ptr_local), Itemp_sum,
+            np.copy(cell_prob), np.copy(volumes_local), np.copy(P_local))
+    if globalize and not discretization._input_sample_set.get_distributed():
         discretization._input_sample_set._probabilities = util.\
             get_global_values(P_local)
     discretization._input_sample_set._probabilities_local = P_local
 
 
+def _cell_fraction_matrix(ptr, num, weights):
+    r"""
+    Returns the sparse matrix of the fraction of the sum of ``weights`` over
+    each cell held by each entry of ``ptr``, summed over all processors with
+    a single ``Allreduce``. Entries in cells with a zero sum, or outside of
+    the cells, have no fractions.
+
+    :param ptr: cell of each entry
+    :type ptr: :class:`numpy.ndarray` of int of shape (local_num,)
+    :param int num: number of cells
+    :param weights: weight of each entry
+    :type weights: :class:`numpy.ndarray` of shape (local_num,)
+
+    :rtype: :class:`scipy.sparse.csr_matrix` of shape (local_num, num)
+    :returns: fractions of the cells
+
+    """
+    ptr = np.ravel(ptr)
+    weights = np.ravel(weights)
+    cell_sum = samp.cell_sum(ptr, num, weights)
+    inside = np.flatnonzero(np.logical_and(ptr >= 0, ptr < num))
+    inside = inside[cell_sum[ptr[inside]] > 0]
+    cells = ptr[inside]
+    return sparse.csr_matrix((weights[inside]/cell_sum[cells],
+                              (inside, cells)), shape=(len(ptr), num))
+
+
+def prob_batch(discretization, output_probabilities, globalize=True):
+    r"""
+    Calculates :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples}})` as in
+    :meth:`prob` for many probabilities of the output cells at once, e.g.
+    for many observed data. The pointers, the volumes and the sums of the
+    volumes over each cell are computed once per output partition, and the
+    probabilities of every scenario on a partition are a single sparse
+    matrix product. The input sample set of ``discretization`` is left
+    unchanged.
+
+    :param discretization: An object containing the discretization information.
+    :type discretization: class:`bet.sample.discretization`
+    :param output_probabilities: probabilities of the cells of
+        ``discretization._output_probability_set``, one row per scenario, or
+        a list of sample sets on the output space with probabilities, one
+        scenario per set, whose cells may differ
+    :type output_probabilities: :class:`numpy.ndarray` of shape
+        (num_scenarios, num_cells) or list of
+        :class:`~bet.sample.sample_set_base`
+    :param bool globalize: Returns the probabilities of all the input
+        samples, unless the input sample set is distributed.
+
+    :rtype: :class:`numpy.ndarray` of shape (num_scenarios, num) or
+        (num_scenarios, local_num)
+    :returns: probabilities of the input samples for each scenario
+
+    """
+    discretization.check_nums()
+    if discretization._input_sample_set._values_local is None:
+        discretization._input_sample_set.global_to_local()
+    volumes_local = discretization._input_sample_set._volumes_local
+
+    # group the scenarios by output partition
+    partitions = []
+    scenarios = []
+    if isinstance(output_probabilities, np.ndarray):
+        output_probabilities = np.atleast_2d(output_probabilities)
+        if discretization._io_ptr_local is None:
+            discretization.set_io_ptr(globalize=False)
+        partitions.append((discretization._io_ptr_local, discretization.
+                           _output_probability_set.check_num()))
+        scenarios.append((np.arange(output_probabilities.shape[0]),
+                          output_probabilities))
+    else:
+        output_sets = list(output_probabilities)
+        index = {}
+        for output_set in output_sets:
+            if id(output_set) not in index:
+                index[id(output_set)] = len(partitions)
+                partitions.append((output_set.query_sample_set(
+                    discretization._output_sample_set),
+                                   output_set.check_num()))
+        for i in range(len(partitions)):
+            rows = [j for j, s in enumerate(output_sets) if
+                    index[id(s)] == i]
+            scenarios.append((np.array(rows, dtype=int), np.array(
+                [_global_probabilities(output_sets[j]) for j in rows])))
+
+    P_local = np.zeros((sum(len(rows) for (rows, _) in scenarios),
+                        len(volumes_local)))
+    for (ptr, num), (rows, probabilities) in zip(partitions, scenarios):
+        if probabilities.shape[1] != num:
+            raise samp.length_not_matching("Probabilities must be given "
+                                           "for each output cell.")
+        # as in prob only cells with probability contribute
+        probabilities = np.where(probabilities > 0.0, probabilities, 0.0)
+        P_local[rows] = _cell_fraction_matrix(ptr, num, volumes_local).dot(
+            probabilities.transpose()).transpose()
+
+    if globalize and not discretization._input_sample_set.get_distributed():
+        return util.get_global_values(P_local.transpose()).transpose()
+    return P_local
+
+
 def prob_with_emulated_volumes(discretization):
     r"""
 
@@ -133,6 +459,142 @@ def prob_with_emulated_volumes(discretization):
     return prob(discretization)
 
 
+class transfer_operator(object):
+    r"""
+
+    Maps probabilities of the cells of an old sample set to the cells of a
+    new sample set on the same space, :math:`P_{new} = A P_{old}`, where
+    :math:`A_{ji}` is the fraction of the points of old cell :math:`i` that
+    lie in new cell :math:`j`. The points are the emulated points of
+    ``set_emulate`` distributed with respect to the volume measure, or the
+    samples of ``set_old`` (the MC assumption) if it is not given. The
+    overlap counts are kept as a :class:`scipy.sparse.csr_matrix` over the
+    local points, built with one query per sample set, so each call of
+    :meth:`apply` is a sparse matrix-vector product and a single
+    ``Allreduce``. With the MC assumption each old cell holds one point, so
+    the local probabilities of the old cells can be mapped with
+    :meth:`apply_local` without gathering them.
+
+    """
+
+    def __init__(self, set_old, set_new, set_emulate=None):
+        """
+
+        Initialization, must be called on all processors.
+
+        :param set_old: Sample set whose cells probabilities are mapped from
+        :type set_old: :class:`~bet.sample.sample_set_base`
+        :param set_new: Sample set whose cells probabilities are mapped to
+        :type set_new: :class:`~bet.sample.sample_set_base`
+        :param set_emulate: Sample set for volume emulation
+        :type set_emulate: :class:`~bet.sample.sample_set_base`
+
+        """
+        #: Number of cells of the old sample set
+        self.num_old = set_old.check_num()
+        #: Number of cells of the new sample set
+        self.num_new = set_new.check_num()
+        if set_old._dim != set_new._dim or (set_emulate is not None and
+                                            set_old._dim != set_emulate._dim):
+            raise samp.dim_not_matching("Dimensions of sets are not equal.")
+
+        if set_emulate is None:
+            # each old sample is the only point of its cell, so the old cells
+            # are indexed locally
+            ptr_new = np.ravel(set_new.query_sample_set(set_old))
+            num_local = len(ptr_new)
+            offset = int(np.sum(comm.allgather(num_local)[:comm.rank]))
+            ptr_old = np.arange(num_local)
+            num_cols = num_local
+            #: Global indices of the local old cells with the MC assumption,
+            #: and ``None`` otherwise
+            self.old_rows = slice(offset, offset + num_local)
+            #: Number of points in each old cell on all processors, ``None``
+            #: with the MC assumption where it is one
+            self.counts = None
+        else:
+            ptr_old = np.ravel(set_old.query_sample_set(set_emulate))
+            ptr_new = np.ravel(set_new.query_sample_set(set_emulate))
+            num_cols = self.num_old
+            self.old_rows = None
+            self.counts = samp.cell_sum(ptr_old, self.num_old)
+        inside = np.logical_and(ptr_old < num_cols, ptr_new < self.num_new)
+
+        #: Number of local points in each pair of new and old cells,
+        #: :class:`scipy.sparse.csr_matrix` of shape (num_new, num_old), or
+        #: (num_new, local_num_old) over the local old cells with the MC
+        #: assumption
+        self.overlap = sparse.csr_matrix(
+            (np.ones((np.sum(inside),)), (ptr_new[inside], ptr_old[inside])),
+            shape=(self.num_new, num_cols))
+
+    def apply(self, prob_old):
+        """
+
+        Maps the probabilities of the old cells to the new cells. If some old
+        cells with probability have no points in them the probabilities are
+        renormalized. Must be called on all processors.
+
+        :param prob_old: probabilities of the old cells
+        :type prob_old: :class:`numpy.ndarray` of shape (num_old,)
+
+        :rtype: :class:`numpy.ndarray` of shape (num_new,)
+        :returns: probabilities of the new cells
+
+        """
+        prob_old = np.ravel(prob_old)
+        if self.counts is None:
+            return self.apply_local(prob_old[self.old_rows])
+        has_points = self.counts > 0
+        prob_point = np.zeros((self.num_old,))
+        prob_point[has_points] = prob_old[has_points]/self.counts[has_points]
+        prob_new_local = self.overlap.dot(prob_point)
+        prob_new = np.copy(prob_new_local)
+        comm.Allreduce([prob_new_local, MPI.DOUBLE], [prob_new, MPI.DOUBLE],
+                       op=MPI.SUM)
+
+        # Warn that some cells have no points in them
+        if np.any(np.logical_and(prob_old > 0.0, np.logical_not(has_points))):
+            msg = "Some old cells have no emulated points in them. "
+            msg += "Renormalizing probability."
+            logging.warning(msg)
+            prob_new = prob_new/np.sum(prob_point*self.counts)
+        return prob_new
+
+    def apply_local(self, prob_old_local):
+        """
+
+        Maps the probabilities of the old cells to the new cells as
+        :meth:`apply`, given the probabilities of the local old cells. With
+        the MC assumption these are not gathered, otherwise they are. Must be
+        called on all processors.
+
+        :param prob_old_local: probabilities of the local old cells
+        :type prob_old_local: :class:`numpy.ndarray` of shape (local_num_old,)
+
+        :rtype: :class:`numpy.ndarray` of shape (num_new,)
+        :returns: probabilities of the new cells
+
+        """
+        if self.counts is not None:
+            return self.apply(util.get_global_values(prob_old_local))
+        prob_new_local = self.overlap.dot(np.ravel(prob_old_local))
+        prob_new = np.copy(prob_new_local)
+        comm.Allreduce([prob_new_local, MPI.DOUBLE], [prob_new, MPI.DOUBLE],
+                       op=MPI.SUM)
+        return prob_new
+
+
+def _global_probabilities(sample_set):
+    """
+    Returns the global probabilities of ``sample_set``, gathering them from
+    the local ones if needed.
+    """
+    if sample_set._probabilities is not None:
+        return sample_set._probabilities
+    return util.get_global_values(sample_set._probabilities_local)
+
+
 def prob_from_sample_set_with_emulated_volumes(set_old, set_new,
                                                set_emulate=None):
     r"""
@@ -140,7 +602,8 @@ def prob_from_sample_set_with_emulated_volumes(set_old, set_new,
     Calculates :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples_new}})`
     from :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples_old}})` using
     a set of emulated points are distributed with respect to the 
-    volume measure.
+    volume measure. To map many probabilities between the same sets build a
+    :class:`transfer_operator` once instead.
 
     :param set_old: Sample set on which probabilities have already been
         calculated
@@ -155,51 +618,8 @@ def prob_from_sample_set_with_emulated_volumes(set_old, set_new,
         logging.warning("Using MC assumption because no emulated points given")
         return prob_from_sample_set(set_old, set_new)
 
-    # Check dimensions
-    num_old = set_old.check_num()
-    num_new = set_new.check_num()
-    set_emulate.check_num()
-    if (set_old._dim != set_new._dim) or (set_old._dim != set_emulate._dim):
-        raise samp.dim_not_matching("Dimensions of sets are not equal.")
-    # Localize emulated points
-    if set_emulate._values_local is None:
-        set_emulate.global_to_local()
-
-    # Map emulated points to old and new sets
-    (_, ptr1) = set_old.query(set_emulate._values_local)
-    (_, ptr2) = set_new.query(set_emulate._values_local)
-    ptr1 = ptr1.flat[:]
-    ptr2 = ptr2.flat[:]
-
-    # Set up probability vectors
-    prob_new = np.zeros((num_new,))
-    prob_em = np.zeros((len(ptr1), ))
-
-    # Loop over old cells and divide probability over emulated cells
-    warn = False
-    for i in range(num_old):
-        if set_old._probabilities[i] > 0.0:
-            Itemp = np.equal(ptr1, i)
-            Itemp_sum = np.sum(Itemp)
-            Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-            if Itemp_sum > 0:
-                prob_em[Itemp] += set_old._probabilities[i]/float(Itemp_sum)
-            else:
-                warn = True
-    # Warn that some cells have no emulated points in them
-    if warn:
-        msg = "Some old cells have no emulated points in them. "
-        msg += "Renormalizing probability."
-        logging.warning(msg)
-        total_prob = np.sum(prob_em)
-        total_prob = comm.allreduce(total_prob, op=MPI.SUM)
-        prob_em = prob_em/total_prob
-    # Loop over new cells and distribute probability from emulated cells
-    for i in range(num_new):
-        Itemp = np.equal(ptr2, i)
-        Itemp_sum = np.sum(prob_em[Itemp])
-        Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-        prob_new[i] = Itemp_sum
+    prob_new = transfer_operator(set_old, set_new, set_emulate).apply(
+        _global_probabilities(set_old))
 
     # Set probabilities
     set_new.set_probabilities(prob_new)
@@ -211,7 +631,8 @@ def prob_from_sample_set(set_old, set_new):
 
     Calculates :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples_new}})`
     from :math:`P_{\Lambda}(\mathcal{V}_{\lambda_{samples_old}})` using
-    the MC assumption with respect to set_old.
+    the MC assumption with respect to set_old. To map many probabilities
+    between the same sets build a :class:`transfer_operator` once instead.
 
     :param set_old: Sample set on which probabilities have already been
         calculated
@@ -220,28 +641,8 @@ def prob_from_sample_set(set_old, set_new):
     :type set_new: :class:`~bet.sample.sample_set_base` 
 
     """
-    # Check dimensions
-    set_old.check_num()
-    num_new = set_new.check_num()
-
-    if (set_old._dim != set_new._dim):
-        raise samp.dim_not_matching("Dimensions of sets are not equal.")
-
-    # Map old points new sets
-    if set_old._values_local is None:
-        set_old.global_to_local()
-    (_, ptr) = set_new.query(set_old._values_local)
-    ptr = ptr.flat[:]
-
-    # Set up probability vector
-    prob_new = np.zeros((num_new,))
-
-    # Loop over new cells and distribute probability from old
-    for i in range(num_new):
-        Itemp = np.equal(ptr, i)
-        Itemp_sum = np.sum(set_old._probabilities_local[Itemp])
-        Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-        prob_new[i] = Itemp_sum
+    prob_new = transfer_operator(set_old, set_new).apply(
+        _global_probabilities(set_old))
 
     # Set probabilities
     set_new.set_probabilities(prob_new)
@@ -275,23 +676,9 @@ def prob_from_discretization_input(disc, set_new):
 
     # Check dimensions
     disc.check_nums()
-    num_new = set_new.check_num()
-
-    if (disc._input_sample_set._dim != set_new._dim):
-        raise samp.dim_not_matching("Dimensions of sets are not equal.")
-
-    (_, ptr) = set_new.query(em_set._values_local)
-    ptr = ptr.flat[:]
-
-    # Set up probability vectors
-    prob_new = np.zeros((num_new,))
-    prob_em = em_set._probabilities_local
 
-    for i in range(num_new):
-        Itemp = np.equal(ptr, i)
-        Itemp_sum = np.sum(prob_em[Itemp])
-        Itemp_sum = comm.allreduce(Itemp_sum, op=MPI.SUM)
-        prob_new[i] = Itemp_sum
+    prob_new = transfer_operator(em_set, set_new).apply_local(
+        em_set._probabilities_local)
 
     # Set probabilities
     set_new.set_probabilities(prob_new)
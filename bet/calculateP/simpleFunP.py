@@ -229,13 +229,13 @@ def uniform_partition_uniform_distribution_rectangle_size(data_set,
     # Bin these samples using nearest neighbor searches
     (_, k) = s_set.query(d_distr_emulate)
 
-    count_neighbors = np.zeros((M,), dtype=np.int)
-    for i in range(M):
-        count_neighbors[i] = np.sum(np.equal(k, i))
+    count_neighbors = np.bincount(np.ravel(k), minlength=M)[:M].astype(
+        np.int64)
 
     # Use the binning to define :math:`\rho_{\mathcal{D},M}`
     ccount_neighbors = np.copy(count_neighbors)
-    comm.Allreduce([count_neighbors, MPI.INT], [ccount_neighbors, MPI.INT],
+    comm.Allreduce([count_neighbors, MPI.INT64_T],
+                   [ccount_neighbors, MPI.INT64_T],
                    op=MPI.SUM)
     count_neighbors = ccount_neighbors
     rho_D_M = count_neighbors.astype(np.float64) / float(num_d_emulate)
@@ -405,7 +405,7 @@ def regular_partition_uniform_distribution_rectangle_size(data_set, Q_ref=None,
     xi = []
     for i in range(dim):
         xi.append(np.linspace(mins[0][i], maxes[0][i],
-                              cells_per_dimension[i] + 1))
+                              int(cells_per_dimension[i]) + 1))
 
     s_set = samp.cartesian_sample_set(dim)
     s_set.setup(xi)
@@ -623,7 +623,7 @@ def normal_partition_normal_distribution(data_set, Q_ref=None, std=1, M=1,
         d_distr_samples = np.expand_dims(d_distr_samples, axis=1)
 
     (_, k) = s_set.query(d_distr_emulate)
-    count_neighbors = np.zeros((M,), dtype=np.int)
+    count_neighbors = np.zeros((M,), dtype=np.int64)
     volumes = np.zeros((M,))
     for i in range(M):
         Itemp = np.equal(k, i)
@@ -633,7 +633,8 @@ def normal_partition_normal_distribution(data_set, Q_ref=None, std=1, M=1,
     # Now define probability of the d_distr_samples
     # This together with d_distr_samples defines :math:`\rho_{\mathcal{D},M}`
     ccount_neighbors = np.copy(count_neighbors)
-    comm.Allreduce([count_neighbors, MPI.INT], [ccount_neighbors, MPI.INT],
+    comm.Allreduce([count_neighbors, MPI.INT64_T],
+                   [ccount_neighbors, MPI.INT64_T],
                    op=MPI.SUM)
     count_neighbors = ccount_neighbors
     cvolumes = np.copy(volumes)
@@ -715,16 +716,14 @@ def uniform_partition_normal_distribution(data_set, Q_ref=None, std=1, M=1,
         d_distr_samples = np.expand_dims(d_distr_samples, axis=1)
 
     (_, k) = s_set.query(d_distr_emulate)
-    count_neighbors = np.zeros((M,), dtype=np.int)
-    # volumes = np.zeros((M,))
-    for i in range(M):
-        Itemp = np.equal(k, i)
-        count_neighbors[i] = np.sum(Itemp)
+    count_neighbors = np.bincount(np.ravel(k), minlength=M)[:M].astype(
+        np.int64)
 
     r'''Now define probability of the d_distr_samples This together with
     d_distr_samples defines :math:`\rho_{\mathcal{D},M}`'''
     ccount_neighbors = np.copy(count_neighbors)
-    comm.Allreduce([count_neighbors, MPI.INT], [ccount_neighbors, MPI.INT],
+    comm.Allreduce([count_neighbors, MPI.INT64_T],
+                   [ccount_neighbors, MPI.INT64_T],
                    op=MPI.SUM)
     count_neighbors = ccount_neighbors
     rho_D_M = count_neighbors.astype(np.float64) / float(num_d_emulate)
@@ -826,13 +825,13 @@ def user_partition_user_distribution(data_set, data_partition_set,
 
     (_, k) = s_set.query(d_distr_emulate)
 
-    count_neighbors = np.zeros((M,), dtype=np.int)
-    for i in range(M):
-        count_neighbors[i] = np.sum(np.equal(k, i))
+    count_neighbors = np.bincount(np.ravel(k), minlength=M)[:M].astype(
+        np.int64)
 
     # Use the binning to define :math:`\rho_{\mathcal{D},M}`
     ccount_neighbors = np.copy(count_neighbors)
-    comm.Allreduce([count_neighbors, MPI.INT], [ccount_neighbors, MPI.INT],
+    comm.Allreduce([count_neighbors, MPI.INT64_T],
+                   [ccount_neighbors, MPI.INT64_T],
                    op=MPI.SUM)
     count_neighbors = ccount_neighbors
     rho_D_M = count_neighbors.astype(np.float64) / \
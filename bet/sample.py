@@ -11,9 +11,19 @@ This module contains data structure/storage classes for BET. Notably:
 import os
 import logging
 import glob
-import warnings
+import re
+import itertools
+import collections
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import json
+import shutil
+import functools
+import pickle
+import hashlib
 import numpy as np
-import math as math
 import numpy.linalg as linalg
 import scipy.spatial as spatial
 import scipy.io as sio
@@ -48,11 +58,744 @@ class wrong_p_norm(Exception):
     """
 
 
-def save_sample_set(save_set, file_name, sample_set_name=None, globalize=False):
+class unknown_kdtree_backend(Exception):
     """
-    Saves this :class:`bet.sample.sample_set` as a ``.mat`` file. Each
-    attribute is added to a dictionary of names and arrays which are then
-    saved to a MATLAB-style file.
+    Exception for when a nearest neighbor search backend is not registered.
+    """
+
+
+class unknown_file_format(Exception):
+    """
+    Exception for when a file format is not supported.
+    """
+
+
+def _query_ckdtree(kdtree, x, k=1, p=2.0, distance_upper_bound=np.inf,
+                   n_jobs=1):
+    """
+    Queries a :class:`scipy.spatial.cKDTree`. Batches of points are split
+    over ``n_jobs`` threads.
+    """
+    return kdtree.query(x, k=k, p=p, distance_upper_bound=distance_upper_bound,
+                        n_jobs=n_jobs)
+
+
+def _query_kdtree(kdtree, x, k=1, p=2.0, distance_upper_bound=np.inf,
+                  n_jobs=1):
+    """
+    Queries a :class:`scipy.spatial.KDTree`. ``n_jobs`` is ignored.
+    """
+    return kdtree.query(x, k=k, p=p, distance_upper_bound=distance_upper_bound)
+
+
+#: Registry of nearest neighbor search backends. Maps the name of a backend
+#: to a tuple ``(build, query)`` where ``build(values)`` returns a tree with a
+#: ``data`` attribute and ``query(tree, x, k, p, distance_upper_bound,
+#: n_jobs)`` returns ``(dist, ptr)`` like :meth:`scipy.spatial.KDTree.query`.
+#: Trees holding their own copy of the values can be shared between copies of
+#: a sample set.
+kdtree_backends = {'ckdtree': (functools.partial(spatial.cKDTree,
+                                                 copy_data=True),
+                               _query_ckdtree),
+                   'kdtree': (spatial.KDTree, _query_kdtree)}
+
+#: Name of the backend used by newly created sample sets
+default_kdtree_backend = 'ckdtree'
+
+#: Number of threads used by newly created sample sets to query their trees,
+#: -1 uses all available cores
+default_kdtree_n_jobs = 1
+
+#: Default number of points per call to ``query`` when pointers are computed
+#: with :meth:`~bet.sample.sample_set_base.query_chunked`
+default_query_chunk_size = int(1E6)
+
+#: Default maximum number of bytes of pointers kept by
+#: :data:`bet.sample.query_cache`
+default_query_cache_bytes = 2**28
+
+#: Format of files written by :func:`save_sample_set` and
+#: :func:`save_discretization`, either ``'mat'`` for a MATLAB-style file or
+#: ``'chunked'`` for a :class:`chunked_store`
+default_file_format = 'mat'
+
+#: Flag whether :meth:`~bet.sample.sample_set_base.check_num` checks every
+#: array and sums the local counts each time instead of using the numbers
+#: of rows recorded when the arrays are set, for debugging
+debug_checks = False
+
+#: Source of the versions of sample set attributes, see
+#: :meth:`~bet.sample.sample_set_base.get_version`
+_version_counter = itertools.count()
+
+
+def register_kdtree_backend(name, build, query):
+    """
+    Registers a nearest neighbor search backend so that it may be chosen
+    with :meth:`~bet.sample.sample_set_base.set_kdtree_backend`.
+
+    :param string name: name of the backend
+    :param build: callable returning a tree for values of shape (num, dim)
+    :type build: callable
+    :param query: callable with the signature ``query(tree, x, k, p,
+        distance_upper_bound, n_jobs)`` returning ``(dist, ptr)``
+    :type query: callable
+
+    """
+    kdtree_backends[name] = (build, query)
+
+
+def get_kdtree_backend(name):
+    """
+    Returns the ``(build, query)`` pair registered under ``name``.
+
+    :param string name: name of the backend
+
+    :rtype: tuple
+    :returns: (build, query)
+
+    """
+    if name not in kdtree_backends:
+        raise unknown_kdtree_backend("No nearest neighbor backend named {}. "
+                                     "Choose from {}.".format(
+                                         name, sorted(kdtree_backends.keys())))
+    return kdtree_backends[name]
+
+
+def ptr_dtype(num):
+    """
+    Returns the smallest integer type able to hold pointers into a sample set
+    with ``num`` samples (pointers may equal ``num`` when no neighbor is
+    found).
+
+    :param int num: number of samples
+
+    :rtype: :class:`numpy.dtype`
+    :returns: :class:`numpy.int32`, :class:`numpy.uint32` or
+        :class:`numpy.int64`
+
+    """
+    if num < np.iinfo(np.int32).max:
+        return np.dtype(np.int32)
+    if num < np.iinfo(np.uint32).max:
+        return np.dtype(np.uint32)
+    return np.dtype(np.int64)
+
+
+def _chunks(x, chunk_size):
+    """
+    Yields slices of ``x`` with at most ``chunk_size`` rows. If ``x`` is not
+    a :class:`numpy.ndarray` it is treated as an iterable of arrays, each of
+    which is sliced in turn.
+    """
+    if isinstance(x, np.ndarray):
+        x = [x]
+    for x_chunk in x:
+        x_chunk = np.asarray(x_chunk)
+        for start in range(0, x_chunk.shape[0], chunk_size):
+            yield x_chunk[start:start+chunk_size]
+
+
+def cell_sum(ptr, num, weights=None, globalize=True):
+    """
+    Sums ``weights`` over the cells given by ``ptr`` with
+    :meth:`numpy.bincount`. If ``weights`` is None counts the number of
+    entries of ``ptr`` in each cell. Pointers outside of ``[0, num)`` are
+    ignored.
+
+    :param ptr: local cell index of each entry
+    :type ptr: :class:`numpy.ndarray` of int of shape (local_num,)
+    :param int num: number of cells
+    :param weights: local weights
+    :type weights: :class:`numpy.ndarray` of shape (local_num,)
+    :param bool globalize: flag whether or not to sum over all processors
+        with a single ``Allreduce``
+
+    :rtype: :class:`numpy.ndarray` of shape (num,)
+    :returns: sum of ``weights`` in each cell
+
+    """
+    ptr = np.ravel(ptr)
+    inside = np.logical_and(ptr >= 0, ptr < num)
+    if weights is not None:
+        weights = np.ravel(weights)[inside].astype(np.float64)
+    local_sum = np.bincount(ptr[inside], weights=weights,
+                            minlength=num).astype(np.float64)
+    if not globalize:
+        return local_sum
+    global_sum = np.copy(local_sum)
+    comm.Allreduce([local_sum, MPI.DOUBLE], [global_sum, MPI.DOUBLE],
+                   op=MPI.SUM)
+    return global_sum
+
+
+def cell_max(ptr, num, values, globalize=True):
+    """
+    Takes the maximum of ``values`` over the cells given by ``ptr`` by
+    sorting by cell and using :meth:`numpy.maximum.reduceat`. The values are
+    expected to be non-negative (e.g. distances) and cells without entries
+    are 0. Pointers outside of ``[0, num)`` are ignored.
+
+    :param ptr: local cell index of each entry
+    :type ptr: :class:`numpy.ndarray` of int of shape (local_num,)
+    :param int num: number of cells
+    :param values: local values
+    :type values: :class:`numpy.ndarray` of shape (local_num,)
+    :param bool globalize: flag whether or not to take the maximum over all
+        processors with a single ``Allreduce``
+
+    :rtype: :class:`numpy.ndarray` of shape (num,)
+    :returns: maximum of ``values`` in each cell
+
+    """
+    ptr = np.ravel(ptr)
+    values = np.ravel(values)
+    inside = np.logical_and(ptr >= 0, ptr < num)
+    ptr = ptr[inside]
+    values = values[inside]
+    local_max = np.zeros((num,))
+    if ptr.size > 0:
+        order = np.argsort(ptr, kind='mergesort')
+        ptr = ptr[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(ptr)) + 1))
+        local_max[ptr[starts]] = np.maximum.reduceat(values[order], starts)
+    if not globalize:
+        return local_max
+    global_max = np.copy(local_max)
+    comm.Allreduce([local_max, MPI.DOUBLE], [global_max, MPI.DOUBLE],
+                   op=MPI.MAX)
+    return global_max
+
+
+def _replace(src, dst):
+    """
+    Renames ``src`` to ``dst``, replacing ``dst`` if it exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        # os.rename of Python 2 only replaces files on POSIX
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def _chunked_path(file_name):
+    """
+    Returns the name of the directory of the :class:`chunked_store` for
+    ``file_name``.
+    """
+    if file_name.endswith('.mat'):
+        file_name = file_name[:-4]
+    return file_name + '.bet'
+
+
+def _kdtree_path(file_name, sample_set_name):
+    """
+    Returns the name of the file holding the snapshot of the nearest neighbor
+    search tree of ``sample_set_name`` saved to ``file_name``, inside a
+    :class:`chunked_store` or next to a ``.mat`` file.
+    """
+    if os.path.isdir(_chunked_path(file_name)):
+        return os.path.join(_chunked_path(file_name),
+                            sample_set_name + '.kdtree')
+    return "{}_{}.kdtree".format(_chunked_path(file_name)[:-4],
+                                 sample_set_name)
+
+
+def _values_hash(values):
+    """
+    Returns a hash of the shape, type and contents of ``values``.
+    """
+    digest = hashlib.sha1(str((values.shape, values.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(values).data)
+    return digest.hexdigest()
+
+
+def _save_kdtree(save_set, file_name, sample_set_name):
+    """
+    Saves a snapshot of the nearest neighbor search tree of ``save_set`` after
+    a JSON header line with a hash of the values it indexes, see
+    :func:`_load_kdtree`. An old snapshot is removed if ``save_set`` has no
+    tree of its current values or the tree can not be pickled.
+    """
+    kdtree_file = _kdtree_path(file_name, sample_set_name)
+    if os.path.exists(kdtree_file):
+        os.remove(kdtree_file)
+    if save_set._values is None or not save_set._has_current_kdtree():
+        return
+    header = {'backend': save_set._kdtree_backend,
+              'hash': _values_hash(save_set._values)}
+    try:
+        with open(kdtree_file + '.tmp', 'wb') as f:
+            f.write((json.dumps(header) + '\n').encode('utf-8'))
+            pickle.dump(save_set._kdtree, f, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        logging.info("Nearest neighbor search tree of {} can not be saved"
+                     .format(sample_set_name))
+        os.remove(kdtree_file + '.tmp')
+        return
+    _replace(kdtree_file + '.tmp', kdtree_file)
+
+
+def _load_kdtree(kdtree_file, sample_set):
+    """
+    Returns the nearest neighbor search tree saved to ``kdtree_file`` by
+    :func:`_save_kdtree` if it was built by the backend of ``sample_set``
+    from values with the same hash as ``sample_set._values``, and ``None``
+    otherwise. The header is not pickled, so nothing is unpickled unless the
+    hash matches.
+    """
+    with open(kdtree_file, 'rb') as f:
+        try:
+            header = json.loads(f.readline().decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(header, dict) or sample_set._values is None or \
+                header.get('backend') != sample_set._kdtree_backend or \
+                header.get('hash') != _values_hash(sample_set._values):
+            return None
+        kdtree = pickle.load(f)
+    sample_set._kdtree_values = kdtree.data
+    sample_set._kdtree_version = sample_set._versions.get('_values')
+    return kdtree
+
+
+def _loadmat(file_name, mmap_mode=None):
+    """
+    Returns the arrays saved to ``file_name`` keyed by name, from either a
+    :class:`chunked_store` (memory-mapped with ``mmap_mode``) or a ``.mat``
+    file.
+    """
+    if os.path.isdir(_chunked_path(file_name)):
+        return chunked_store(_chunked_path(file_name), mmap_mode)
+    return sio.loadmat(file_name)
+
+
+def _load_attribute(mdat, key, squeeze):
+    """
+    Returns ``mdat[key]``, squeezed if ``squeeze``. Used to load attributes
+    lazily, see :meth:`~bet.sample.sample_set_base.set_lazy`.
+    """
+    if squeeze:
+        return np.squeeze(mdat[key])
+    return mdat[key]
+
+
+def _load_attribute_rows(store, key, rows):
+    """
+    Returns the rows ``rows`` of the array saved as ``key`` to the
+    :class:`chunked_store` ``store``. Used to localize attributes lazily,
+    see :meth:`~bet.sample.sample_set_base.set_lazy`.
+    """
+    return store.load_rows(*store._keys()[key], rows=rows)
+
+
+def _glob_parallel(file_name):
+    """
+    Returns the names of the processor specific files saved for
+    ``file_name``, as ``.mat`` files or as :class:`chunked_store`.
+    """
+    save_dir = os.path.dirname(file_name)
+    base_name = os.path.basename(file_name)
+    mdat_files = glob.glob(os.path.join(save_dir,
+                                        "proc*_{}".format(base_name)))
+    if len(mdat_files) == 0:
+        mdat_files = [f[:-4] for f in glob.glob(os.path.join(
+            save_dir, "proc*_{}".format(_chunked_path(base_name))))]
+    # order by processor so that rows are in their global order
+    return sorted(mdat_files, key=lambda f: int(re.match(
+        r"proc(\d+)_", os.path.basename(f)).group(1)))
+
+
+def saved_shapes(file_name):
+    """
+    Returns the shapes of the arrays saved to ``file_name``, a ``.mat`` file
+    or a :class:`chunked_store`, without reading them.
+
+    :param string file_name: Name of the file
+    :rtype: dict
+    :returns: shapes keyed by array name
+    """
+    if os.path.isdir(_chunked_path(file_name)):
+        return chunked_store(_chunked_path(file_name)).shapes()
+    return {name: shape for (name, shape, _) in sio.whosmat(file_name)}
+
+
+def load_rows(file_name, key, rows, vector=False):
+    """
+    Reads some rows of the array saved as ``key`` to ``file_name``. Only the
+    chunks of a :class:`chunked_store` holding the rows are read (through a
+    memory map); arrays in ``.mat`` files are read whole and then indexed.
+
+    :param string file_name: Name of the file
+    :param string key: name of the array
+    :param rows: increasing indices of the rows to read
+    :type rows: :class:`numpy.ndarray` of ints or slice
+    :param bool vector: Flag whether the array is a vector, ``.mat`` files
+        store vectors as a single row
+
+    :rtype: :class:`numpy.ndarray`
+    :returns: the rows
+    """
+    if os.path.isdir(_chunked_path(file_name)):
+        store = chunked_store(_chunked_path(file_name))
+        if key in store:
+            return store.load_rows(*store._keys()[key], rows=rows)
+    array = sio.loadmat(file_name, variable_names=[key])[key]
+    if vector:
+        array = np.reshape(array, (-1,))
+    return array[rows]
+
+
+def _load_keys(file_name, keys):
+    """
+    Returns the arrays saved as ``keys`` to ``file_name`` keyed by name,
+    skipping missing keys.
+    """
+    if os.path.isdir(_chunked_path(file_name)):
+        store = chunked_store(_chunked_path(file_name))
+        return {key: store[key] for key in keys if key in store}
+    return sio.loadmat(file_name, variable_names=keys)
+
+
+def _load_local_rows(mdat_files, shapes, key, vector):
+    """
+    Returns the rows of the concatenation of the arrays saved as ``key`` to
+    ``mdat_files`` which this processor holds when they are split as in
+    :meth:`~bet.sample.sample_set_base.global_to_local`, reading only those
+    rows. ``shapes`` are the :func:`saved_shapes` of ``mdat_files``.
+    """
+    nums = [int(np.prod(shape[key])) if vector else shape[key][0]
+            for shape in shapes]
+    offsets = np.cumsum([0] + nums)
+    (num_local, remainder) = divmod(int(offsets[-1]), comm.size)
+    start = comm.rank*num_local + min(comm.rank, remainder)
+    stop = start + num_local + (comm.rank < remainder)
+    local_rows = []
+    for (mdat_file, offset, num) in zip(mdat_files, offsets, nums):
+        rows = slice(max(start - offset, 0), min(stop - offset, num))
+        if rows.start < rows.stop or (len(local_rows) == 0 and
+                                      mdat_file == mdat_files[-1]):
+            local_rows.append(load_rows(mdat_file, key, rows, vector))
+    return np.concatenate(local_rows)
+
+
+class chunked_store(Mapping):
+    """
+
+    A directory of arrays saved in chunks so that saving again only writes
+    what changed. Each saved object has a small JSON header ``name.json``
+    listing its attributes, and each attribute ``attr`` is a directory
+    ``name+attr`` of ``.npy`` chunks of consecutive rows. The header keeps a
+    hash of the rows of each chunk. When an attribute listed as having rows
+    grows and the hashes of all its stored chunks are unchanged, only the
+    new rows are written as another chunk; otherwise the attribute is
+    rewritten. Headers are replaced only after the chunks are written.
+
+    The store behaves as a read-only dictionary of arrays keyed by
+    ``name+attr`` (and ``name+'_sample_set_type'``) like the dictionary
+    returned by :func:`scipy.io.loadmat`. Arrays are read when accessed, or
+    memory-mapped if ``mmap_mode`` is given. Attributes stored in a single
+    chunk are mapped without copying, those stored in several chunks are
+    concatenated in memory.
+
+    """
+
+    def __init__(self, path, mmap_mode=None):
+        """
+
+        Initialization
+
+        :param string path: directory of the store
+        :param string mmap_mode: mode used to memory-map arrays, see
+            :func:`numpy.load`, ``None`` reads arrays into memory
+
+        """
+        #: Directory of the store
+        self.path = path
+        #: Mode used to memory-map arrays
+        self.mmap_mode = mmap_mode
+
+    def _headers(self):
+        """
+        Returns the headers of the saved objects keyed by name.
+        """
+        headers = {}
+        if os.path.isdir(self.path):
+            for header_file in glob.glob(os.path.join(self.path, '*.json')):
+                with open(header_file) as f:
+                    name = os.path.basename(header_file)[:-5]
+                    headers[name] = json.load(f)
+        return headers
+
+    def _keys(self):
+        """
+        Returns a dictionary mapping keys to ``(name, attrname)``.
+        """
+        keys = {}
+        for (name, header) in self._headers().items():
+            keys[name + '_sample_set_type'] = (name, None)
+            for attrname in header['attributes']:
+                keys[name + attrname] = (name, attrname)
+        return keys
+
+    def __getitem__(self, key):
+        (name, attrname) = self._keys()[key]
+        return self.load(name, attrname)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def load(self, name, attrname=None):
+        """
+        Reads an attribute of a saved object.
+
+        :param string name: name of the object
+        :param string attrname: name of the attribute, if ``None`` the type of
+            the object is returned in a list
+
+        :rtype: :class:`numpy.ndarray` or list
+        :returns: attribute
+        """
+        with open(os.path.join(self.path, name + '.json')) as f:
+            header = json.load(f)
+        if attrname is None:
+            return [header['type']]
+        attr = header['attributes'][attrname]
+        chunks = [np.load(os.path.join(self.path, name + attrname, c),
+                          mmap_mode=self.mmap_mode) for c in attr['chunks']]
+        if len(chunks) == 1:
+            return chunks[0]
+        return np.concatenate(chunks)
+
+    def shapes(self):
+        """
+        Returns the shapes of the stored arrays keyed by ``name+attr``.
+
+        :rtype: dict
+        :returns: shapes
+        """
+        return {name + attrname: tuple(attr['shape']) for (name, header) in
+                self._headers().items() for (attrname, attr) in
+                header['attributes'].items()}
+
+    def load_rows(self, name, attrname, rows):
+        """
+        Reads some rows of an attribute of a saved object, only reading the
+        chunks that hold them. If ``self.mmap_mode`` is given and ``rows`` is
+        a slice of consecutive rows within one chunk, the rows are a view of
+        the memory-mapped chunk.
+
+        :param string name: name of the object
+        :param string attrname: name of the attribute
+        :param rows: increasing indices of the rows to read
+        :type rows: :class:`numpy.ndarray` of ints or slice
+
+        :rtype: :class:`numpy.ndarray`
+        :returns: the rows
+        """
+        with open(os.path.join(self.path, name + '.json')) as f:
+            attr = json.load(f)['attributes'][attrname]
+        if self.mmap_mode is not None and isinstance(rows, slice) and \
+                rows.step in (None, 1):
+            (start, stop, _) = rows.indices(attr['rows'])
+            offset = 0
+            for (c, length) in zip(attr['chunks'], self._lengths(
+                    name, attrname, attr)):
+                if offset <= start and stop <= offset + length and \
+                        start < stop:
+                    chunk = np.load(os.path.join(self.path, name + attrname,
+                                                 c), mmap_mode=self.mmap_mode)
+                    return chunk[start-offset:stop-offset]
+                offset += length
+        rows = np.arange(attr['rows'])[rows]
+        local_rows = [np.empty([0] + attr['shape'][1:], dtype=attr['dtype'])]
+        offset = 0
+        for c in attr['chunks']:
+            chunk = np.load(os.path.join(self.path, name + attrname, c),
+                            mmap_mode='r')
+            in_chunk = rows[(rows >= offset) & (rows < offset + len(chunk))]
+            if len(in_chunk) > 0:
+                local_rows.append(np.array(chunk[in_chunk - offset]))
+            offset += len(chunk)
+        return np.concatenate(local_rows)
+
+    def _lengths(self, name, attrname, attr):
+        """
+        Returns the number of rows of each chunk of an attribute, from its
+        header or else from the chunks.
+        """
+        if len(attr.get('lengths', [])) == len(attr['chunks']):
+            return attr['lengths']
+        return [len(np.load(os.path.join(self.path, name + attrname, c),
+                            mmap_mode='r')) for c in attr['chunks']]
+
+    def iter_chunks(self, name, attrname):
+        """
+        Yields the chunks of rows of an attribute of a saved object in order,
+        memory-mapped if ``self.mmap_mode`` is given.
+
+        :param string name: name of the object
+        :param string attrname: name of the attribute
+
+        :rtype: generator
+        :returns: chunks of rows
+        """
+        with open(os.path.join(self.path, name + '.json')) as f:
+            attr = json.load(f)['attributes'][attrname]
+        for c in attr['chunks']:
+            yield np.load(os.path.join(self.path, name + attrname, c),
+                          mmap_mode=self.mmap_mode)
+
+    def append_rows(self, name, obj_type, attrname, rows, new=False):
+        """
+        Appends rows to an attribute of a saved object as another chunk
+        without reading the stored rows, so that an attribute larger than
+        memory can be written a chunk at a time. The object and the attribute
+        are created if they do not exist. Rows are converted to the type of
+        the stored rows.
+
+        :param string name: name of the object
+        :param string obj_type: type of the object if it is created
+        :param string attrname: name of the attribute
+        :param rows: rows to append
+        :type rows: :class:`numpy.ndarray`
+        :param bool new: flag whether or not to replace the stored rows
+
+        """
+        header_file = os.path.join(self.path, name + '.json')
+        header = {'type': obj_type, 'attributes': {}}
+        if os.path.exists(header_file):
+            with open(header_file) as f:
+                header = json.load(f)
+        rows = np.asarray(rows)
+        old = header['attributes'].get(attrname)
+        attr = old
+        if attr is None or new:
+            generation = 0 if attr is None else attr['generation'] + 1
+            attr = {'generation': generation, 'rows': 0, 'chunks': [],
+                    'hashes': [], 'lengths': [], 'dtype': rows.dtype.str,
+                    'shape': [0] + list(rows.shape[1:])}
+        elif attr['shape'][1:] != list(rows.shape[1:]):
+            raise dim_not_matching("Rows have the wrong shape.")
+        elif len(rows) == 0:
+            return
+        rows = rows.astype(attr['dtype'])
+        attr_dir = os.path.join(self.path, name + attrname)
+        if not os.path.isdir(attr_dir):
+            os.makedirs(attr_dir)
+        chunk = "{}_{}.npy".format(attr['generation'], attr['rows'])
+        np.save(os.path.join(attr_dir, chunk), rows)
+        attr['chunks'].append(chunk)
+        if 'hashes' in attr:
+            attr['hashes'].append(_values_hash(rows))
+            attr['lengths'].append(rows.shape[0])
+        attr['rows'] += rows.shape[0]
+        attr['shape'][0] = attr['rows']
+        header['attributes'][attrname] = attr
+
+        with open(header_file + '.tmp', 'w') as f:
+            json.dump(header, f)
+        _replace(header_file + '.tmp', header_file)
+
+        # remove the replaced chunks
+        if old is not None and new:
+            for c in old['chunks']:
+                os.remove(os.path.join(attr_dir, c))
+
+    def save(self, name, obj_type, attributes, row_names=()):
+        """
+        Saves the attributes of an object, appending rows where possible.
+
+        :param string name: name of the object
+        :param string obj_type: type of the object
+        :param dict attributes: arrays (or ``None`` to remove them) keyed by
+            attribute name
+        :param row_names: names of the attributes whose first axis indexes
+            rows that are only ever appended to
+        :type row_names: iterable of strings
+
+        """
+        header_file = os.path.join(self.path, name + '.json')
+        old = {}
+        if os.path.exists(header_file):
+            with open(header_file) as f:
+                old = json.load(f)['attributes']
+        header = {'type': obj_type, 'attributes': {}}
+        for (attrname, curr_attr) in attributes.items():
+            if curr_attr is None:
+                continue
+            curr_attr = np.asarray(curr_attr)
+            attr_dir = os.path.join(self.path, name + attrname)
+            attr = old.get(attrname)
+            if attr is None or attrname not in row_names or \
+                    not self._can_append(attr, curr_attr):
+                generation = 0 if attr is None else attr['generation'] + 1
+                attr = {'generation': generation, 'rows': 0, 'chunks': [],
+                        'hashes': [], 'lengths': []}
+            if not os.path.isdir(attr_dir):
+                os.makedirs(attr_dir)
+            rows = curr_attr.shape[0] if curr_attr.ndim > 0 else 0
+            if len(attr['chunks']) == 0 or rows > attr['rows']:
+                chunk = "{}_{}.npy".format(attr['generation'], attr['rows'])
+                new_rows = curr_attr[attr['rows']:] if curr_attr.ndim > 0 \
+                    else curr_attr
+                np.save(os.path.join(attr_dir, chunk), new_rows)
+                attr['chunks'].append(chunk)
+                attr['hashes'].append(_values_hash(new_rows))
+                attr['lengths'].append(rows - attr['rows'])
+            attr.update({'rows': rows, 'dtype': curr_attr.dtype.str,
+                         'shape': list(curr_attr.shape)})
+            header['attributes'][attrname] = attr
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(header_file + '.tmp', 'w') as f:
+            json.dump(header, f)
+        _replace(header_file + '.tmp', header_file)
+
+        # remove chunks no longer in the header
+        for (attrname, attr) in old.items():
+            attr_dir = os.path.join(self.path, name + attrname)
+            if attrname not in header['attributes']:
+                shutil.rmtree(attr_dir, ignore_errors=True)
+                continue
+            for chunk in attr['chunks']:
+                if chunk not in header['attributes'][attrname]['chunks']:
+                    os.remove(os.path.join(attr_dir, chunk))
+
+    def _can_append(self, attr, curr_attr):
+        """
+        Checks whether ``curr_attr`` extends the stored rows of an attribute,
+        comparing the hash of the rows of every stored chunk.
+        """
+        if curr_attr.ndim == 0 or len(attr['chunks']) == 0 or \
+                attr['dtype'] != curr_attr.dtype.str or \
+                attr['shape'][1:] != list(curr_attr.shape[1:]) or \
+                attr['rows'] == 0 or attr['rows'] > curr_attr.shape[0] or \
+                len(attr.get('hashes', [])) != len(attr['chunks']):
+            return False
+        offset = 0
+        for (chunk_hash, length) in zip(attr['hashes'], attr['lengths']):
+            if _values_hash(curr_attr[offset:offset+length]) != chunk_hash:
+                return False
+            offset += length
+        return True
+
+
+def save_sample_set(save_set, file_name, sample_set_name=None, globalize=False,
+                    file_format=None):
+    """
+    Saves this :class:`bet.sample.sample_set` as a ``.mat`` file or a
+    :class:`~bet.sample.chunked_store`. For a ``.mat`` file each attribute is
+    added to a dictionary of names and arrays which are then saved to a
+    MATLAB-style file. A chunked store only writes the rows appended since
+    the last save. A nearest neighbor search tree of the current values is
+    saved next to the sample set, see :func:`load_sample_set`.
 
     :param save_set: sample set to save
     :type save_set: :class:`bet.sample.sample_set_base`
@@ -62,11 +805,19 @@ def save_sample_set(save_set, file_name, sample_set_name=None, globalize=False):
         saving multiple :class`bet.sample.sample_set_base` objects to a single
         ``.mat`` file
     :param bool globalize: flag whether or not to globalize
+    :param string file_format: ``'mat'`` or ``'chunked'``, defaults to
+        :data:`bet.sample.default_file_format`
 
     :rtype: string
     :returns: local file name
 
     """
+    if file_format is None:
+        file_format = default_file_format
+    if file_format not in ['mat', 'chunked']:
+        raise unknown_file_format("No file format named {}.".format(
+            file_format))
+
     # create processor specific file name
     if comm.size > 1 and not globalize:
         local_file_name = os.path.join(os.path.dirname(file_name),
@@ -80,6 +831,24 @@ def save_sample_set(save_set, file_name, sample_set_name=None, globalize=False):
         save_set.local_to_global()
     comm.barrier()
 
+    if sample_set_name is None:
+        sample_set_name = 'default'
+    attributes = dict()
+    for attrname in save_set.vector_names + save_set.all_ndarray_names:
+        attributes[attrname] = getattr(save_set, attrname)
+    sample_set_type = str(type(save_set)).split("'")[1]
+
+    if file_format == 'chunked':
+        row_names = [n for n in attributes if n == '_local_index' or
+                     n in save_set.array_names or
+                     n[:-len('_local')] in save_set.array_names]
+        if (globalize and comm.rank == 0) or not globalize:
+            chunked_store(_chunked_path(local_file_name)).save(
+                sample_set_name, sample_set_type, attributes, row_names)
+            _save_kdtree(save_set, local_file_name, sample_set_name)
+        comm.barrier()
+        return local_file_name
+
     new_mdat = dict()
     # create temporary dictionary
     if os.path.exists(local_file_name) or \
@@ -87,38 +856,41 @@ def save_sample_set(save_set, file_name, sample_set_name=None, globalize=False):
         new_mdat = sio.loadmat(local_file_name)
 
     # store sample set in dictionary
-    if sample_set_name is None:
-        sample_set_name = 'default'
-    for attrname in save_set.vector_names:
-        curr_attr = getattr(save_set, attrname)
+    for (attrname, curr_attr) in attributes.items():
         if curr_attr is not None:
             new_mdat[sample_set_name+attrname] = curr_attr
         elif sample_set_name+attrname in new_mdat:
             new_mdat.pop(sample_set_name+attrname)
-    for attrname in save_set.all_ndarray_names:
-        curr_attr = getattr(save_set, attrname)
-        if curr_attr is not None:
-            new_mdat[sample_set_name+attrname] = curr_attr
-        elif sample_set_name+attrname in new_mdat:
-            new_mdat.pop(sample_set_name+attrname)
-    new_mdat[sample_set_name + '_sample_set_type'] = \
-        str(type(save_set)).split("'")[1]
+    new_mdat[sample_set_name + '_sample_set_type'] = sample_set_type
     comm.barrier()
 
     # save new file or append to existing file
     if (globalize and comm.rank == 0) or not globalize:
         sio.savemat(local_file_name, new_mdat)
+        _save_kdtree(save_set, local_file_name, sample_set_name)
     comm.barrier()
     return local_file_name
 
 
-def load_sample_set(file_name, sample_set_name=None, localize=True):
+def load_sample_set(file_name, sample_set_name=None, localize=True,
+                    lazy=False):
     """
-    Loads a :class:`~bet.sample.sample_set` from a ``.mat`` file. If a file
+    Loads a :class:`~bet.sample.sample_set` from a ``.mat`` file or a
+    :class:`~bet.sample.chunked_store`. If a file
     contains multiple :class:`~bet.sample.sample_set` objects then
     ``sample_set_name`` is used to distinguish which between different
     :class:`~bet.sample.sample_set` objects.
 
+    If ``lazy`` and the file is a chunked store, each attribute is
+    memory-mapped (copy-on-write) when it is first accessed. With
+    ``localize`` the local arrays are deferred too and only read the local
+    rows when first accessed, as views of the mapping of a chunk when the
+    rows are within one chunk, so attributes saved in several chunks are not
+    concatenated unless the global attribute is accessed.
+
+    A nearest neighbor search tree saved with the sample set is restored if
+    the hash of the values it indexes matches the loaded values.
+
     :param string file_name: Name of the ``.mat`` file, no extension is
         needed.
     :param string sample_set_name: String to prepend to attribute names when
@@ -126,6 +898,8 @@ def load_sample_set(file_name, sample_set_name=None, localize=True):
         ``.mat`` file
     :param bool localize: Flag whether or not to re-localize arrays. If
         ``file_name`` is prepended by ``proc_{}`` localize is set to ``False``.
+    :param bool lazy: Flag whether or not to memory-map attributes on first
+        access
 
     :rtype: :class:`~bet.sample.sample_set`
     :returns: the ``sample_set`` that matches the ``sample_set_name``
@@ -135,11 +909,17 @@ def load_sample_set(file_name, sample_set_name=None, localize=True):
     if file_name.startswith('proc_'):
         localize = False
     elif not os.path.exists(file_name) and os.path.exists(os.path.join(
-            os.path.dirname(file_name), "proc{}_0".format(
+            os.path.dirname(file_name), "proc0_{}".format(
                 os.path.basename(file_name)))):
-        return load_sample_set_parallel(file_name, sample_set_name)
-
-    mdat = sio.loadmat(file_name)
+        return load_sample_set_parallel(file_name, sample_set_name, lazy)
+    elif not os.path.isdir(_chunked_path(file_name)) and \
+            os.path.isdir(_chunked_path(os.path.join(
+                os.path.dirname(file_name), "proc0_{}".format(
+                    os.path.basename(file_name))))):
+        return load_sample_set_parallel(file_name, sample_set_name, lazy)
+
+    mdat = _loadmat(file_name, 'c' if lazy else None)
+    lazy = lazy and isinstance(mdat, chunked_store)
     if sample_set_name is None:
         sample_set_name = 'default'
 
@@ -151,14 +931,33 @@ def load_sample_set(file_name, sample_set_name=None, localize=True):
                      format(sample_set_name))
         return None
 
-    for attrname in loaded_set.vector_names:
+    keys = list(mdat.keys())
+    if lazy:
+        shapes = mdat.shapes()
+    for attrname in loaded_set.vector_names + loaded_set.all_ndarray_names:
         if attrname is not '_dim':
-            if sample_set_name+attrname in list(mdat.keys()):
-                setattr(loaded_set, attrname,
-                        np.squeeze(mdat[sample_set_name+attrname]))
-    for attrname in loaded_set.all_ndarray_names:
-        if sample_set_name+attrname in list(mdat.keys()):
-            setattr(loaded_set, attrname, mdat[sample_set_name+attrname])
+            if sample_set_name+attrname in keys:
+                loader = functools.partial(
+                    _load_attribute, mdat, sample_set_name+attrname,
+                    attrname in loaded_set.vector_names)
+                if lazy:
+                    shape = shapes[sample_set_name+attrname]
+                    loaded_set.set_lazy(attrname, loader, shape[0]
+                                        if len(shape) > 0 else None,
+                                        functools.partial(
+                                            _load_attribute_rows, mdat,
+                                            sample_set_name+attrname))
+                else:
+                    setattr(loaded_set, attrname, loader())
+
+    # reuse the saved nearest neighbor search tree if it is still valid
+    kdtree_file = _kdtree_path(file_name, sample_set_name)
+    if os.path.exists(kdtree_file):
+        loader = functools.partial(_load_kdtree, kdtree_file, loaded_set)
+        if lazy:
+            loaded_set.set_lazy('_kdtree', loader)
+        else:
+            loaded_set._kdtree = loader()
 
     if localize:
         # re-localize if necessary
@@ -167,7 +966,7 @@ def load_sample_set(file_name, sample_set_name=None, localize=True):
     return loaded_set
 
 
-def load_sample_set_parallel(file_name, sample_set_name=None):
+def load_sample_set_parallel(file_name, sample_set_name=None, lazy=False):
     """
     Loads a :class:`~bet.sample.sample_set` from a ``.mat`` file in parallel
     and correctly re-localizes data if necessary. If a file contains multiple
@@ -175,11 +974,26 @@ def load_sample_set_parallel(file_name, sample_set_name=None):
     distinguish which between different :class:`~bet.sample.sample_set`
     objects.
 
+    If the files were saved by a different number of processors each
+    processor reads only the rows of the local arrays it holds, split as in
+    :meth:`~bet.sample.sample_set_base.global_to_local`. Global arrays are
+    not formed, see :meth:`~bet.sample.sample_set_base.local_to_global`.
+
+    .. note::
+
+        Earlier versions returned ``None`` when the files were saved by a
+        different number of processors. The sample set is now returned with
+        only its local arrays set; call
+        :meth:`~bet.sample.sample_set_base.local_to_global` on every
+        processor if the global arrays are needed.
+
     :param string file_name: Name of the ``.mat`` file, no extension is
         needed.
     :param string sample_set_name: String to prepend to attribute names when
         saving multiple :class`bet.sample.sample_set` objects to a single
         ``.mat`` file
+    :param bool lazy: Flag whether or not to memory-map attributes on first
+        access when each processor loads its own chunked store
 
     :rtype: :class:`~bet.sample.sample_set`
     :returns: the ``sample_set`` that matches the ``sample_set_name``
@@ -188,10 +1002,7 @@ def load_sample_set_parallel(file_name, sample_set_name=None):
     if sample_set_name is None:
         sample_set_name = 'default'
     # Find and open save files
-    save_dir = os.path.dirname(file_name)
-    base_name = os.path.basename(file_name)
-    mdat_files = glob.glob(os.path.join(save_dir,
-                                        "proc*_{}".format(base_name)))
+    mdat_files = _glob_parallel(file_name)
 
     if len(mdat_files) == comm.size:
         logging.info("Loading {} sample set using parallel files (same nproc)"
@@ -202,61 +1013,359 @@ def load_sample_set_parallel(file_name, sample_set_name=None):
         local_file_name = os.path.join(os.path.dirname(file_name),
                                        "proc{}_{}".format(comm.rank,
                                                           os.path.basename(file_name)))
-        return load_sample_set(local_file_name, sample_set_name)
+        return load_sample_set(local_file_name, sample_set_name, lazy=lazy)
     else:
         logging.info("Loading {} sample set using parallel files (diff nproc)"
                      .format(sample_set_name))
-        # Determine how many processors the previous data used
-        # otherwise gather the data from mdat and then scatter
-        # among the processors and update mdat
-        mdat_files_local = comm.scatter(mdat_files)
-        mdat_local = [sio.loadmat(m) for m in mdat_files_local]
-        mdat_list = comm.allgather(mdat_local)
-        mdat_global = []
-        # instead of a list of lists, create a list of mdat
-        for mlist in mdat_list:
-            mdat_global.extend(mlist)
-
-        if sample_set_name+"_dim" in list(mdat_global[0].keys()):
-            loaded_set = eval(mdat_global[0][sample_set_name +
-                                             '_sample_set_type'][0])(
-                np.squeeze(mdat_global[0][sample_set_name+"_dim"]))
-        else:
-            logging.info("No sample_set named {} with _dim in file".
-                         format(sample_set_name))
+        # Read the rows of the local arrays this processor holds from the
+        # files holding them, and the global attributes from the first file
+        shapes = [saved_shapes(m) for m in mdat_files]
+        loaded_set = load_sample_set_attributes(mdat_files[0],
+                                                sample_set_name)
+        if loaded_set is None:
             return None
 
-        # load attributes
-        for attrname in loaded_set.vector_names:
-            if attrname is not '_dim':
-                if sample_set_name+attrname in list(mdat_global[0].keys()):
-                    # create lists of local data
-                    if attrname.endswith('_local'):
-                        temp_input = []
-                        for mdat in mdat_global:
-                            temp_input.append(np.squeeze(
-                                mdat[sample_set_name+attrname]))
-                        # turn into arrays
-                        temp_input = np.concatenate(temp_input)
-                    else:
-                        temp_input = np.squeeze(mdat_global[0]
-                                                [sample_set_name+attrname])
-                    setattr(loaded_set, attrname, temp_input)
-        for attrname in loaded_set.all_ndarray_names:
-            if sample_set_name+attrname in list(mdat_global[0].keys()):
-                if attrname.endswith('_local'):
-                    # create lists of local data
-                    temp_input = []
-                    for mdat in mdat_global:
-                        temp_input.append(mdat[sample_set_name+attrname])
-                    # turn into arrays
-                    temp_input = np.concatenate(temp_input)
-                else:
-                    temp_input = mdat_global[0][sample_set_name+attrname]
-                setattr(loaded_set, attrname, temp_input)
+        attrnames = [attrname for attrname in loaded_set.vector_names +
+                     loaded_set.all_ndarray_names if attrname != '_dim'
+                     and sample_set_name+attrname in shapes[0] and
+                     _is_row_attribute(loaded_set, attrname)]
+        mdat = _load_keys(mdat_files[0], [sample_set_name+attrname for
+                                          attrname in attrnames if not
+                                          attrname.endswith('_local')])
+        for attrname in attrnames:
+            vector = attrname in loaded_set.vector_names
+            if attrname.endswith('_local'):
+                temp_input = _load_local_rows(mdat_files, shapes,
+                                              sample_set_name+attrname, vector)
+            elif vector:
+                temp_input = np.squeeze(mdat[sample_set_name+attrname])
+            else:
+                temp_input = mdat[sample_set_name+attrname]
+            setattr(loaded_set, attrname, temp_input)
+        return loaded_set
 
-        # re-localize if necessary
-        loaded_set.local_to_global()
+
+def _is_row_attribute(sample_set, attrname):
+    """
+    Returns whether the attribute ``attrname`` of ``sample_set`` holds a row
+    for each sample.
+    """
+    return attrname == '_local_index' or sample_set._has_rows(attrname)
+
+
+def load_sample_set_attributes(file_name, sample_set_name=None):
+    """
+    Loads a :class:`~bet.sample.sample_set` from a ``.mat`` file or chunked
+    store with only the attributes which do not hold a row for each sample,
+    e.g. the domain, so that no values are read. The rows can be read with
+    :func:`load_rows` and set afterwards.
+
+    :param string file_name: Name of the file
+    :param string sample_set_name: String to prepend to attribute names when
+        saving multiple :class`bet.sample.sample_set` objects to a single
+        ``.mat`` file
+
+    :rtype: :class:`~bet.sample.sample_set`
+    :returns: the ``sample_set`` that matches the ``sample_set_name`` without
+        its rows
+    """
+    if sample_set_name is None:
+        sample_set_name = 'default'
+    mdat = _load_keys(file_name, [sample_set_name+"_dim",
+                                  sample_set_name+'_sample_set_type'])
+    if sample_set_name+"_dim" in mdat:
+        loaded_set = eval(mdat[sample_set_name+'_sample_set_type'][0])(
+            np.squeeze(mdat[sample_set_name+"_dim"]))
+    else:
+        logging.info("No sample_set named {} with _dim in file".
+                     format(sample_set_name))
+        return None
+
+    shapes = saved_shapes(file_name)
+    attrnames = [attrname for attrname in loaded_set.vector_names +
+                 loaded_set.all_ndarray_names if attrname != '_dim' and
+                 sample_set_name+attrname in shapes and not
+                 _is_row_attribute(loaded_set, attrname)]
+    mdat = _load_keys(file_name, [sample_set_name+attrname for attrname in
+                                  attrnames])
+    for attrname in attrnames:
+        if attrname in loaded_set.vector_names:
+            setattr(loaded_set, attrname,
+                    np.squeeze(mdat[sample_set_name+attrname]))
+        else:
+            setattr(loaded_set, attrname, mdat[sample_set_name+attrname])
+    return loaded_set
+
+
+def _append_rows(array, buffer, rows):
+    """
+    Returns ``(array, buffer)`` with ``rows`` appended to ``array``, where the
+    new ``array`` is a view of the first rows of ``buffer``. If ``array`` is
+    already such a view and ``buffer`` has room the rows are written in place,
+    otherwise a buffer with twice the needed capacity is allocated.
+    """
+    num = array.shape[0]
+    new_num = num + rows.shape[0]
+    if buffer is None or array.base is not buffer or \
+            array.__array_interface__['data'][0] != \
+            buffer.__array_interface__['data'][0] or \
+            array.shape[1:] != rows.shape[1:] or \
+            buffer.dtype != np.result_type(array, rows) or \
+            new_num > buffer.shape[0]:
+        buffer = np.empty((2*new_num,) + array.shape[1:],
+                          dtype=np.result_type(array, rows))
+        buffer[:num] = array
+    buffer[num:new_num] = rows
+    return (buffer[:new_num], buffer)
+
+
+def _is_broadcast_rows(array):
+    """
+    Returns whether ``array`` repeats one row without storing it more than
+    once, as the bounds made by :meth:`sample_set_base.update_bounds` do.
+    """
+    return array.ndim > 1 and array.strides[0] == 0
+
+
+def _shared_view(array):
+    """
+    Returns a read-only view of ``array``, used to give a shallow copy of a
+    sample set or discretization the arrays of the original without copying
+    them.
+    """
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def _copy_array(array):
+    """
+    Returns a copy of ``array``. Rows broadcast from a single row, see
+    :func:`_is_broadcast_rows`, stay broadcast from a copy of that row.
+    """
+    if _is_broadcast_rows(array):
+        return np.broadcast_to(np.copy(array[0]), array.shape)
+    return np.copy(array)
+
+
+def _kdtree_shares_memory(kdtree, values):
+    """
+    Returns whether ``kdtree`` may refer to the memory of ``values``, in which
+    case it can not be shared with a copy of ``values``.
+    """
+    if isinstance(kdtree, kdtree_forest):
+        return any(_kdtree_shares_memory(tree, values) for (_, tree) in
+                   kdtree.trees)
+    return np.may_share_memory(kdtree.data, values)
+
+
+def _merge_nearest(dist, ptr, k):
+    """
+    Returns the ``k`` nearest of the candidate neighbors in each row of
+    ``dist`` and ``ptr``, with ties going to the smallest index.
+    """
+    order = np.lexsort((ptr, dist))[:, :k]
+    return (np.take_along_axis(dist, order, axis=1),
+            np.take_along_axis(ptr, order, axis=1))
+
+
+class kdtree_forest(object):
+    """
+
+    A nearest neighbor search index over values that grow by appending. The
+    values are split into consecutive blocks, each with its own tree built by
+    a backend in :data:`bet.sample.kdtree_backends`. Like the digits of a
+    binary counter, a new block is merged with the last block while the last
+    block is no larger, so there are at most ``log2(num)`` trees and each
+    value is indexed O(log(num)) times over all appends.
+
+    """
+
+    def __init__(self, backend, values, tree=None):
+        """
+
+        Initialization
+
+        :param string backend: name of a backend in
+            :data:`bet.sample.kdtree_backends`
+        :param values: values to index
+        :type values: :class:`numpy.ndarray` of shape (num, dim)
+        :param tree: an existing tree of ``values`` built by ``backend``
+
+        """
+        (self._build, self._query) = get_kdtree_backend(backend)
+        #: Name of the backend building the trees
+        self.backend = backend
+        #: Indexed values, :class:`numpy.ndarray` of shape (num, dim)
+        self.data = values[:0]
+        #: List of ``(offset, tree)`` for each block of values
+        self.trees = []
+        if tree is not None:
+            self.data = values
+            self.trees.append((0, tree))
+        else:
+            self.append(values)
+
+    def append(self, values):
+        """
+        Indexes the values after those already indexed.
+
+        :param values: values whose first rows are the indexed values
+        :type values: :class:`numpy.ndarray` of shape (new_num, dim)
+
+        """
+        offset = self.data.shape[0]
+        self.data = values
+        if offset == values.shape[0]:
+            return
+        while len(self.trees) > 0 and \
+                offset - self.trees[-1][0] <= values.shape[0] - offset:
+            offset = self.trees.pop()[0]
+        self.trees.append((offset, self._build(values[offset:])))
+
+    def copy(self, values):
+        """
+        Returns a forest of ``values``, which must equal the first rows of the
+        indexed values. The trees of the blocks within ``values`` are shared
+        and only the rest of ``values`` is indexed again.
+
+        :param values: values to index
+        :type values: :class:`numpy.ndarray` of shape (num, dim)
+
+        :rtype: :class:`~bet.sample.kdtree_forest`
+        :returns: forest of ``values``
+        """
+        forest = kdtree_forest(self.backend, values[:0])
+        ends = [offset for (offset, _) in self.trees[1:]] + \
+            [self.data.shape[0]]
+        for ((offset, tree), end) in zip(self.trees, ends):
+            if end > values.shape[0]:
+                break
+            forest.trees.append((offset, tree))
+            forest.data = values[:end]
+        forest.append(values)
+        return forest
+
+    def query(self, x, k=1, p=2.0, distance_upper_bound=np.inf, n_jobs=1):
+        """
+        Queries every tree and keeps the ``k`` nearest neighbors, with ties
+        going to the smallest index. Missing neighbors have an infinite
+        distance and an index equal to the number of values, as with
+        :meth:`scipy.spatial.cKDTree.query`.
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int k: number of nearest neighbors to return
+        :param float p: p-norm to use
+        :param float distance_upper_bound: return only neighbors within this
+            distance
+        :param int n_jobs: number of threads used by each query
+
+        :rtype: tuple
+        :returns: (dist, ptr)
+        """
+        x = np.asarray(x)
+        num_x = int(np.prod(x.shape[:-1]))
+        num = self.data.shape[0]
+        dist = []
+        ptr = []
+        for (offset, tree) in self.trees:
+            (tree_dist, tree_ptr) = self._query(
+                tree, x, k=k, p=p, distance_upper_bound=distance_upper_bound,
+                n_jobs=n_jobs)
+            tree_dist = np.reshape(tree_dist, (num_x, k))
+            tree_ptr = np.reshape(tree_ptr, (num_x, k)) + offset
+            tree_ptr[np.isinf(tree_dist)] = num
+            dist.append(tree_dist)
+            ptr.append(tree_ptr)
+        (dist, ptr) = _merge_nearest(np.hstack(dist), np.hstack(ptr), k)
+        shape = x.shape[:-1] if k == 1 else x.shape[:-1] + (k,)
+        return (np.reshape(dist, shape), np.reshape(ptr, shape))
+
+
+class query_result_cache(object):
+    """
+
+    A least recently used cache of query results, see
+    :meth:`~bet.sample.sample_set_base.query_sample_set`. The least recently
+    used results are evicted once the results take more than ``max_bytes``.
+
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+
+        Initialization
+
+        :param int max_bytes: maximum number of bytes of results to keep,
+            defaults to :data:`bet.sample.default_query_cache_bytes`
+
+        """
+        if max_bytes is None:
+            max_bytes = default_query_cache_bytes
+        #: Maximum number of bytes of results to keep
+        self.max_bytes = max_bytes
+        #: Number of bytes of results kept
+        self.nbytes = 0
+        #: Results ordered from least to most recently used
+        self._results = collections.OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the result stored under ``key`` or ``None``.
+
+        :param tuple key: key of the result
+
+        :rtype: :class:`numpy.ndarray`
+        :returns: result
+
+        """
+        result = self._results.pop(key, None)
+        if result is not None:
+            self._results[key] = result
+        return result
+
+    def put(self, key, result):
+        """
+        Stores ``result`` under ``key``, evicting the least recently used
+        results as needed. Results larger than ``max_bytes`` are not stored.
+
+        :param tuple key: key of the result
+        :param result: result to store
+        :type result: :class:`numpy.ndarray`
+
+        """
+        old = self._results.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        if result.nbytes <= self.max_bytes:
+            self._results[key] = result
+            self.nbytes += result.nbytes
+        self.set_max_bytes(self.max_bytes)
+
+    def set_max_bytes(self, max_bytes):
+        """
+        Sets the maximum number of bytes of results to keep and evicts the
+        least recently used results until they fit.
+
+        :param int max_bytes: maximum number of bytes of results to keep
+
+        """
+        self.max_bytes = max_bytes
+        while self.nbytes > self.max_bytes:
+            (_, old) = self._results.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def clear(self):
+        """
+        Removes all results.
+        """
+        self._results.clear()
+        self.nbytes = 0
+
+
+#: Cache of query results shared by all sample sets
+query_cache = query_result_cache()
 
 
 class sample_set_base(object):
@@ -286,6 +1395,11 @@ class sample_set_base(object):
                          '_right', '_right_local', '_width', '_width_local',
                          '_domain', '_kdtree_values', '_jacobians',
                          '_jacobians_local', '_domain_original']
+    #: List of attribute names which determine the results of :meth:`query`,
+    #: setting any of them draws a new version, see :meth:`get_version`
+    version_names = ['_values', '_values_local', '_p_norm']
+    #: List of attribute names which :meth:`partition_shift` compares
+    partition_names = []
 
     def __init__(self, dim):
         """
@@ -295,6 +1409,18 @@ class sample_set_base(object):
         :param int dim: Dimension of the space in which these samples reside.
 
         """
+        #: Loaders of attributes not yet loaded, see :meth:`set_lazy`
+        self._lazy = {}
+        #: Loaders of rows of attributes not yet loaded, see :meth:`set_lazy`
+        self._lazy_rows = {}
+        #: Numbers of rows of the arrays named in :attr:`array_names` and of
+        #: their local versions, recorded when they are set
+        self._nums = {}
+        #: Global number of samples summed from the local arrays, reset when
+        #: any of them is set, see :meth:`check_num`
+        self._num_from_local = None
+        #: Versions of the attributes in :attr:`version_names`
+        self._versions = {}
         #: Dimension of the sample space
         self._dim = dim
         #: :class:`numpy.ndarray` of sample values of shape (num, dim)
@@ -333,21 +1459,45 @@ class sample_set_base(object):
         #: Local indicies of global arrays, :class:`numpy.ndarray` of shape
         #: (local_num, dim)
         self._local_index = None
-        #: :class:`scipy.spatial.KDTree`
+        #: Nearest neighbor search tree, :class:`scipy.spatial.cKDTree` by
+        #: default
         self._kdtree = None
+        #: Name of the nearest neighbor search backend, see
+        #: :data:`bet.sample.kdtree_backends`
+        self._kdtree_backend = default_kdtree_backend
+        #: Number of threads used to query ``self._kdtree``
+        self._kdtree_n_jobs = default_kdtree_n_jobs
+        #: Version of ``self._values`` indexed by ``self._kdtree``
+        self._kdtree_version = None
+        #: Nearest neighbor search tree of ``self._values_local`` used in
+        #: distributed mode, see :meth:`set_distributed`
+        self._local_kdtree = None
+        #: Version of ``self._values_local`` indexed by ``self._local_kdtree``
+        self._local_kdtree_version = None
+        #: Flag whether global arrays are never built implicitly, see
+        #: :meth:`set_distributed`
+        self._distributed = False
+        #: Type the values are stored as, see :meth:`set_values_dtype`
+        self._values_dtype = None
         #: Values defining kd tree, :class:`numpy.ndarray` of shape (num, dim)
         self._kdtree_values = None
         #: Local values defining kd tree, :class:`numpy.ndarray` of
         #: shape (num, dim)
         self._kdtree_values_local = None
-        #: Local pointwise left (local_num, dim)
+        #: Buffer holding ``self._values`` with room to append values
+        self._values_buffer = None
+        #: Buffer holding ``self._values_local`` with room to append values
+        self._values_local_buffer = None
+        #: Local pointwise left (local_num, dim), a read-only broadcast of
+        #: the domain unless each sample has its own bounds
         self._left_local = None
         #: Local pointwise right (local_num, dim)
         self._right_local = None
         #: Local pointwise width (local_num, dim)
         self._width_local = None
 
-        #: Pointwise left (num, dim)
+        #: Pointwise left (num, dim), a read-only broadcast of the domain
+        #: unless each sample has its own bounds
         self._left = None
         #: Pointwise right (num, dim)
         self._right = None
@@ -499,6 +1649,8 @@ class sample_set_base(object):
     def set_region_local(self, region):
         """
         Sets local region for sample set.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :param region: array of regions
         :type values: :class:`numpy.ndarray` of shape (some_num, dim)
@@ -529,6 +1681,8 @@ class sample_set_base(object):
     def set_error_id_local(self, error_id):
         """
         Sets local error id for sample set.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :param error_id: array of error identifiers
         :type error_id: :class:`numpy.ndarray` of shape (some_num, dim)
@@ -543,22 +1697,137 @@ class sample_set_base(object):
 
     def update_bounds(self, num=None):
         """
-        Creates ``self._right``, ``self._left``, ``self._width``.
+        Creates ``self._right``, ``self._left``, ``self._width``. These are
+        read-only broadcasts of the rows of the domain, so they take no
+        memory per sample.
 
         :param int num: Determines shape of pointwise bounds (num, dim)
 
         """
         if num is None:
             num = self._values.shape[0]
-        self._left = np.repeat([self._domain[:, 0]], num, 0)
-        self._right = np.repeat([self._domain[:, 1]], num, 0)
-        self._width = self._right-self._left
+        shape = (int(num), self._dim)
+        self._left = np.broadcast_to(self._domain[:, 0], shape)
+        self._right = np.broadcast_to(self._domain[:, 1], shape)
+        self._width = np.broadcast_to(self._domain[:, 1] -
+                                      self._domain[:, 0], shape)
+
+    def __setattr__(self, name, value):
+        """
+        Sets an attribute, drawing a new version if it is in
+        :attr:`version_names` and recording the number of rows if it is named
+        in :attr:`array_names`.
+        """
+        if self.__dict__.get('_lazy'):
+            self._lazy.pop(name, None)
+            self._lazy_rows.pop(name, None)
+        if name in self.version_names:
+            self._versions[name] = next(_version_counter)
+        if self._has_rows(name):
+            shape = np.shape(value) if value is not None else ()
+            self._set_num(name, shape[0] if len(shape) > 0 else None)
+        object.__setattr__(self, name, value)
+
+    def _has_rows(self, name):
+        """
+        Returns whether ``name`` is named in :attr:`array_names`, globally or
+        locally.
+        """
+        if name.endswith('_local'):
+            name = name[:-len('_local')]
+        return name in self.array_names
+
+    def _set_num(self, name, num):
+        """
+        Records the number of rows ``num`` of the array ``name``. The global
+        number of samples kept by :meth:`check_num` is discarded if the number
+        of rows of a local array changes.
+        """
+        nums = self.__dict__.setdefault('_nums', {})
+        if name.endswith('_local') and nums.get(name) != num:
+            self.__dict__['_num_from_local'] = None
+        if num is None:
+            nums.pop(name, None)
+        else:
+            nums[name] = num
+
+    def __getattr__(self, name):
+        """
+        Loads an attribute deferred with :meth:`set_lazy`.
+        """
+        lazy = self.__dict__.get('_lazy')
+        if not lazy or name not in lazy:
+            raise AttributeError("{} object has no attribute {}".format(
+                type(self).__name__, name))
+        setattr(self, name, lazy[name]())
+        return self.__dict__[name]
+
+    def set_lazy(self, attrname, loader, num=None, rows_loader=None):
+        """
+        Defers setting an attribute until it is first accessed, when it is
+        set to ``loader()``. Setting the attribute first discards the loader.
+
+        :param string attrname: name of the attribute
+        :param loader: returns the value of the attribute
+        :type loader: callable
+        :param int num: number of rows of the attribute if known, so that
+            :meth:`check_num` does not need to load it
+        :param rows_loader: returns some rows of the attribute without
+            loading all of them, so that :meth:`global_to_local` can defer
+            the local attribute instead of loading the attribute
+        :type rows_loader: callable taking a slice
+
+        """
+        self.__dict__.pop(attrname, None)
+        self._lazy[attrname] = loader
+        if rows_loader is None:
+            self._lazy_rows.pop(attrname, None)
+        else:
+            self._lazy_rows[attrname] = rows_loader
+        if self._has_rows(attrname):
+            self._set_num(attrname, num)
+
+    def get_version(self):
+        """
+        Returns the versions of the attributes in :attr:`version_names`
+        other than ``_values_local``, unless in distributed mode. Setting any
+        of these attributes changes the version. Attributes made by
+        :meth:`local_to_global`, :meth:`global_to_local` and :meth:`copy`
+        keep the version of the attribute they are made from. Changes made in
+        place are not tracked, see :meth:`mark_changed`.
+
+        :rtype: tuple
+        :returns: versions
+        """
+        return tuple(self._versions.get(name) for name in self.version_names
+                     if name != '_values_local' or self._distributed)
+
+    def get_version_local(self):
+        """
+        Returns the version of ``self._values_local``.
+
+        :rtype: int
+        :returns: version
+        """
+        return self._versions.get('_values_local')
+
+    def mark_changed(self, attrname=None):
+        """
+        Draws a new version of ``attrname``, or of all the attributes in
+        :attr:`version_names`, after changing it in place, so that search
+        trees and cached pointers of the old values are not reused.
+
+        :param string attrname: name of the attribute changed in place
+        """
+        for name in self.version_names:
+            if attrname is None or name == attrname:
+                self._versions[name] = next(_version_counter)
 
     def update_bounds_local(self, local_num=None):
         """
         Creates local versions of ``self._right``, ``self._left``,
         ``self._width`` (``self._right_local``, ``self._left_local``,
-        ``self._width_local``).
+        ``self._width_local``), see :meth:`update_bounds`.
 
         :param int local_num: Determines shape of local pointwise bounds
             (local_num, dim)
@@ -566,42 +1835,50 @@ class sample_set_base(object):
         """
         if local_num is None:
             local_num = self._values_local.shape[0]
-        self._left_local = np.repeat([self._domain[:, 0]], local_num, 0)
-        self._right_local = np.repeat([self._domain[:, 1]], local_num, 0)
-        self._width_local = self._right_local-self._left_local
+        shape = (int(local_num), self._dim)
+        self._left_local = np.broadcast_to(self._domain[:, 0], shape)
+        self._right_local = np.broadcast_to(self._domain[:, 1], shape)
+        self._width_local = np.broadcast_to(self._domain[:, 1] -
+                                            self._domain[:, 0], shape)
 
     def append_values(self, values):
         """
-        Appends the values in ``_values`` to ``self._values``.
+        Appends the values in ``_values`` to ``self._values``. The values are
+        kept in a buffer whose capacity doubles when full and an existing
+        nearest neighbor search tree is extended with the new values, so the
+        cost is proportional to the number of values appended.
 
         .. seealso::
 
-            :meth:`numpy.concatenate`
+            :class:`~bet.sample.kdtree_forest`
 
         :param values: values to append
         :type values: :class:`numpy.ndarray` of shape (some_num, dim)
         """
-        self._values = np.concatenate((self._values,
-                                       util.fix_dimensions_data(values, self._dim)), 0)
+        num = self._values.shape[0]
+        (self._values, self._values_buffer) = _append_rows(
+            self._values, self._values_buffer, self._as_values(values))
+        self._extend_kdtree(num)
 
     def append_values_local(self, values_local):
         """
-        Appends the values in ``_values_local`` to ``self._values``.
-
-        .. seealso::
-
-            :meth:`numpy.concatenate`
+        Appends the values in ``_values_local`` to ``self._values``. The
+        values are kept in a buffer whose capacity doubles when full. This
+        changes the number of local rows, so it must happen on all
+        processors, see :meth:`check_num`.
 
         :param values_local: values to append
         :type values_local: :class:`numpy.ndarray` of shape (some_num, dim)
         """
-        self._values_local = np.concatenate((self._values_local,
-                                             util.fix_dimensions_data(values_local, self._dim)), 0)
+        (self._values_local, self._values_local_buffer) = _append_rows(
+            self._values_local, self._values_local_buffer,
+            self._as_values(values_local))
 
     def clip(self, cnum):
         """
         Creates and returns a sample set with the the first `cnum` 
-        entries of the sample set.
+        entries of the sample set. A nearest neighbor search tree of the
+        current values is reused where it indexes the first `cnum` values.
 
         :param int cnum: number of values of sample set to return
 
@@ -620,7 +1897,11 @@ class sample_set_base(object):
                 setattr(sset, array_name, new_array)
         if sset._values_local is not None:
             sset.global_to_local()
-        sset.set_kdtree()
+        if self._has_current_kdtree() and \
+                not _kdtree_shares_memory(self._kdtree, self._values):
+            sset._share_kdtree(self._kdtree)
+        else:
+            sset.set_kdtree()
         return sset
 
     def check_num(self):
@@ -630,9 +1911,67 @@ class sample_set_base(object):
         ``self._volumes``, ``self._probabilities``, ``self._jacobians``, and
         ``self._error_estimates`` all match (assuming the named array exists).
 
+        The numbers of rows recorded when the arrays are set are compared, and
+        the global number of samples summed from the local arrays is kept
+        until the number of rows of one of them changes. Then this sums the
+        local numbers over all processors, so it must be called on all
+        processors, and a local array may only change its number of rows if
+        it does so on all processors. Setting a local array with the same
+        number of rows on some processors only is safe. Set
+        :data:`bet.sample.debug_checks` to check the arrays themselves and sum
+        the local counts every time.
+
         :rtype: int
         :returns: num
 
+        """
+        if debug_checks:
+            return self._check_num_arrays()
+        num = self._check_nums_recorded(self.array_names)
+        if num is None:
+            if self._num_from_local is None:
+                num_local = self.check_num_local()
+                if num_local is None:
+                    num_local = 0
+                self._num_from_local = comm.allreduce(num_local, op=MPI.SUM)
+            num = self._num_from_local
+        return num
+
+    def _check_nums_recorded(self, array_names):
+        """
+        Checks that the recorded numbers of rows of the arrays named in
+        ``array_names`` match, and the dimension of the values. Arrays not yet
+        loaded whose number of rows is unknown are loaded first.
+
+        :rtype: int
+        :returns: num or ``None`` if none of the arrays exist
+        """
+        for array_name in array_names:
+            if array_name in self._lazy and array_name not in self._nums:
+                getattr(self, array_name)
+        num = None
+        for array_name in array_names:
+            current_num = self._nums.get(array_name)
+            if current_num is not None:
+                if num is None:
+                    num = current_num
+                    first_array = array_name
+                elif num != current_num:
+                    errortxt = "length of {} inconsistent with {}"
+                    raise length_not_matching(errortxt.format(array_name,
+                                                              first_array))
+        values = self.__dict__.get('_values')
+        if values is not None and values.shape[1] != self._dim:
+            raise dim_not_matching("dimension of values incorrect")
+        return num
+
+    def _check_num_arrays(self):
+        """
+        Checks the number of entries of the global arrays themselves, see
+        :meth:`check_num`.
+
+        :rtype: int
+        :returns: num
         """
         num = None
         for array_name in self.array_names:
@@ -669,6 +2008,9 @@ class sample_set_base(object):
         :returns: num
 
         """
+        if not debug_checks:
+            return self._check_nums_recorded([array_name + "_local" for
+                                              array_name in self.array_names])
         num = None
         for array_name in self.array_names:
             array_name_local = array_name + "_local"
@@ -723,7 +2065,7 @@ class sample_set_base(object):
         :type values: :class:`numpy.ndarray` of shape (num, dim)
 
         """
-        self._values = util.fix_dimensions_data(values, self._dim)
+        self._values = self._as_values(values)
         if self._values.shape[1] != self._dim:
             raise dim_not_matching("dimension of values incorrect")
 
@@ -737,6 +2079,50 @@ class sample_set_base(object):
         """
         return self._values
 
+    def set_values_dtype(self, dtype):
+        """
+        Sets the type the values are stored as, e.g. :class:`numpy.float32`
+        to halve the memory and communication of large emulated sample sets.
+        The current values are converted and values set or appended later are
+        converted too. Sums over samples still accumulate in double
+        precision. ``None`` stores values with the type they are given in.
+
+        :param dtype: type of the values
+        :type dtype: :class:`numpy.dtype` or None
+
+        """
+        if dtype is not None:
+            dtype = np.dtype(dtype)
+        self._values_dtype = dtype
+        if dtype is None:
+            return
+        for array_name in ['_values', '_values_local']:
+            current_array = getattr(self, array_name)
+            if current_array is not None and current_array.dtype != dtype:
+                setattr(self, array_name, current_array.astype(dtype))
+                setattr(self, array_name + "_buffer", None)
+
+    def get_values_dtype(self):
+        """
+        Returns the type the values are stored as, see
+        :meth:`set_values_dtype`.
+
+        :rtype: :class:`numpy.dtype` or None
+        :returns: type of the values
+
+        """
+        return self._values_dtype
+
+    def _as_values(self, values):
+        """
+        Returns ``values`` of shape (num, dim) with the type set by
+        :meth:`set_values_dtype`.
+        """
+        values = util.fix_dimensions_data(values, self._dim)
+        if self._values_dtype is not None:
+            values = np.asarray(values, dtype=self._values_dtype)
+        return values
+
     def set_domain(self, domain):
         """
         Sets the domain.
@@ -875,13 +2261,15 @@ class sample_set_base(object):
 
     def set_values_local(self, values_local):
         """
-        Sets the local sample values. 
+        Sets the local sample values.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :param values_local: sample local values
         :type values_local: :class:`numpy.ndarray` of shape (local_num, dim)
 
         """
-        self._values_local = util.fix_dimensions_data(values_local, self._dim)
+        self._values_local = self._as_values(values_local)
         if len(self._values_local.shape) > 1 and \
                 self._values_local.shape[1] != self._dim:
             raise dim_not_matching("dimension of values incorrect")
@@ -889,21 +2277,173 @@ class sample_set_base(object):
 
     def set_kdtree(self):
         """
-        Creates a :class:`scipy.spatial.KDTree` for this set of samples.
+        Creates a nearest neighbor search tree for this set of samples using
+        the backend chosen with :meth:`set_kdtree_backend`.
         """
-        self._kdtree = spatial.KDTree(self._values)
+        (build, _) = get_kdtree_backend(self._kdtree_backend)
+        self._kdtree = build(self._values)
         self._kdtree_values = self._kdtree.data
+        self._kdtree_version = self._versions.get('_values')
+
+    def _has_current_kdtree(self):
+        """
+        Checks whether ``self._kdtree`` indexes the current ``self._values``.
+        """
+        return self._kdtree is not None and \
+            self._kdtree_version == self._versions.get('_values')
+
+    def _share_kdtree(self, kdtree):
+        """
+        Uses ``kdtree``, a tree of values whose first rows equal
+        ``self._values``, instead of building a new tree. A
+        :class:`~bet.sample.kdtree_forest` is copied keeping the trees of the
+        blocks within ``self._values``, any other tree is only used if it
+        indexes exactly ``self._values``.
+
+        :param kdtree: tree to use
+        """
+        if isinstance(kdtree, kdtree_forest):
+            kdtree = kdtree.copy(self._values)
+        elif kdtree.data.shape[0] != self._values.shape[0]:
+            self.set_kdtree()
+            return
+        self._kdtree = kdtree
+        self._kdtree_values = kdtree.data
+        self._kdtree_version = self._versions.get('_values')
+
+    def _extend_kdtree(self, num):
+        """
+        Adds the values after the first ``num`` to ``self._kdtree`` if it
+        indexes exactly the first ``num`` values, turning it into a
+        :class:`~bet.sample.kdtree_forest` if necessary.
+
+        :param int num: number of values before the append
+        """
+        if self._kdtree is None or self._kdtree.data.shape[0] != num:
+            return
+        if not isinstance(self._kdtree, kdtree_forest):
+            self._kdtree = kdtree_forest(self._kdtree_backend,
+                                         self._values[:num], self._kdtree)
+        self._kdtree.append(self._values)
+        self._kdtree_values = self._kdtree.data
+        self._kdtree_version = self._versions.get('_values')
 
     def get_kdtree(self):
         """
-        Returns a :class:`scipy.spatial.KDTree` for this set of samples.
+        Returns the nearest neighbor search tree for this set of samples.
 
-        :rtype: :class:`scipy.spatial.KDTree`
-        :returns: :class:`scipy.spatial.KDTree` for this set of samples.
+        :rtype: :class:`scipy.spatial.cKDTree` or the type built by the
+            chosen backend
+        :returns: nearest neighbor search tree for this set of samples.
 
         """
         return self._kdtree
 
+    def set_kdtree_backend(self, backend, n_jobs=None):
+        """
+        Chooses the nearest neighbor search backend for this set of samples.
+        An existing tree is discarded and rebuilt on the next query.
+
+        :param string backend: name of a backend in
+            :data:`bet.sample.kdtree_backends`
+        :param int n_jobs: number of threads used for queries, -1 uses all
+            available cores
+
+        """
+        get_kdtree_backend(backend)
+        if backend != self._kdtree_backend:
+            self._kdtree = None
+        self._kdtree_backend = backend
+        if n_jobs is not None:
+            self._kdtree_n_jobs = n_jobs
+
+    def get_kdtree_backend(self):
+        """
+        Returns the name of the nearest neighbor search backend.
+
+        :rtype: string
+        :returns: name of the backend
+        """
+        return self._kdtree_backend
+
+    def query_kdtree(self, x, k=1, distance_upper_bound=np.inf):
+        """
+        Queries the nearest neighbor search tree of this set of samples with
+        ``self._p_norm``, building it if necessary.
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int k: number of nearest neighbors to return
+        :param float distance_upper_bound: return only neighbors within this
+            distance
+
+        :rtype: tuple
+        :returns: (dist, ptr)
+        """
+        if self._distributed and self._values is None:
+            return self._query_distributed(x, k, distance_upper_bound)
+        if self._kdtree is None:
+            self.set_kdtree()
+        if isinstance(self._kdtree, kdtree_forest):
+            query = kdtree_forest.query
+        else:
+            (_, query) = get_kdtree_backend(self._kdtree_backend)
+        return query(self._kdtree, x, k=k, p=self._p_norm,
+                     distance_upper_bound=distance_upper_bound,
+                     n_jobs=self._kdtree_n_jobs)
+
+    def _query_distributed(self, x, k=1, distance_upper_bound=np.inf):
+        """
+        Queries the local values of all processors without forming the
+        global values. Each processor indexes its local values with a tree,
+        and the points ``x`` of each processor are passed around a ring of
+        the processors together with their nearest neighbors so far, so all
+        processors must query at the same time. Ties go to the smallest
+        index, see :meth:`query_kdtree`.
+        """
+        (build, query) = get_kdtree_backend(self._kdtree_backend)
+        values_local = self._values_local
+        if self._local_kdtree is None or self._local_kdtree_version != \
+                self._versions.get('_values_local'):
+            self._local_kdtree = build(values_local) if len(values_local) > 0 \
+                else None
+            self._local_kdtree_version = self._versions.get('_values_local')
+        offsets = np.cumsum([0] + comm.allgather(len(values_local)))
+        num = int(offsets[-1])
+
+        x = np.asarray(x, dtype=float)
+        shape = x.shape[:-1] if k == 1 else x.shape[:-1] + (k,)
+        x = np.reshape(x, (-1, self._dim))
+        nums_x = comm.allgather(len(x))
+        dist = np.full((len(x), k), np.inf)
+        ptr = np.full((len(x), k), num, dtype=np.intp)
+        for step in range(comm.size):
+            if self._local_kdtree is not None and len(x) > 0:
+                (local_dist, local_ptr) = query(
+                    self._local_kdtree, x, k=k, p=self._p_norm,
+                    distance_upper_bound=distance_upper_bound,
+                    n_jobs=self._kdtree_n_jobs)
+                local_dist = np.reshape(local_dist, (len(x), k)).astype(float)
+                local_ptr = np.reshape(local_ptr, (len(x), k)).astype(
+                    np.intp) + offsets[comm.rank]
+                local_ptr[np.isinf(local_dist)] = num
+                (dist, ptr) = _merge_nearest(np.hstack((dist, local_dist)),
+                                             np.hstack((ptr, local_ptr)), k)
+            if comm.size > 1:
+                # pass the points and their neighbors on to the next processor
+                dest = (comm.rank + 1) % comm.size
+                source = (comm.rank - 1) % comm.size
+                num_x = nums_x[(comm.rank - step - 1) % comm.size]
+                blocks = []
+                for block in [x, dist, np.ascontiguousarray(ptr)]:
+                    recv = np.empty((num_x,) + block.shape[1:],
+                                    dtype=block.dtype)
+                    comm.Sendrecv(block, dest=dest, recvbuf=recv,
+                                  source=source)
+                    blocks.append(recv)
+                (x, dist, ptr) = blocks
+        return (np.reshape(dist, shape), np.reshape(ptr, shape))
+
     def get_values_local(self):
         """
         Returns sample local values.
@@ -917,6 +2457,8 @@ class sample_set_base(object):
     def set_volumes_local(self, volumes_local):
         """
         Sets local sample cell volumes.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :type volumes_local: :class:`numpy.ndarray` of shape (num,)
         :param volumes_local: local sample cell volumes
@@ -938,6 +2480,8 @@ class sample_set_base(object):
     def set_probabilities_local(self, probabilities_local):
         """
         Set sample local probabilities.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :type probabilities_local: :class:`numpy.ndarray` of shape (num,)
         :param probabilities_local: local sample probabilities
@@ -960,6 +2504,8 @@ class sample_set_base(object):
     def set_jacobians_local(self, jacobians_local):
         """
         Returns local sample jacobians.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :type jacobians_local: :class:`numpy.ndarray` of shape (num, other_dim,
             dim) 
@@ -982,6 +2528,8 @@ class sample_set_base(object):
     def set_error_estimates_local(self, error_estimates_local):
         """
         Returns local sample error estimates.
+        Changing the number of local rows must happen on all processors,
+        see :meth:`check_num`.
 
         :type error_estimates_local: :class:`numpy.ndarray` of shape (num,)
         :param error_estimates_local: local sample error estimates
@@ -1000,51 +2548,421 @@ class sample_set_base(object):
         """
         return self._error_estimates_local
 
+    def set_distributed(self, distributed=True):
+        """
+        Sets whether this sample set is in distributed mode, where global
+        arrays are never built implicitly so that the memory used on each
+        processor shrinks with the number of processors. In distributed mode
+        :meth:`local_to_global` does nothing, :meth:`global_to_local` frees
+        the global arrays it splits, queries search a tree of the local values
+        on each processor and :meth:`get_global_rows` requests rows from the
+        processors holding them. Use :meth:`gather_to_root` to form global
+        arrays, e.g. for plotting. Pointers of a
+        :class:`~bet.sample.discretization` are still globalized when asked.
+
+        This must be called on all processors.
+
+        :param bool distributed: flag whether or not to use distributed mode
+
+        """
+        self._distributed = distributed
+        if distributed:
+            self.global_to_local()
+
+    def get_distributed(self):
+        """
+        Returns whether this sample set is in distributed mode, see
+        :meth:`set_distributed`.
+
+        :rtype: bool
+        :returns: distributed
+        """
+        return self._distributed
+
+    def gather_to_root(self, root=0):
+        """
+        Gathers the local arrays into a copy of this sample set on the
+        processor ``root``, e.g. for plotting. The copy is not distributed
+        and its local arrays are its global arrays, so it can be used by
+        ``root`` alone. This must be called on all processors.
+
+        :param int root: processor receiving the copy
+
+        :rtype: :class:`~bet.sample.sample_set_base`
+        :returns: the copy on ``root`` and ``None`` on the other processors
+        """
+        gathered = {}
+        for array_name in self.array_names:
+            current_array_local = getattr(self, array_name + "_local")
+            if current_array_local is not None:
+                gathered[array_name] = util.get_root_values(
+                    current_array_local, root)
+        if comm.rank != root:
+            return None
+        root_set = self.copy()
+        root_set._distributed = False
+        for (array_name, current_array) in gathered.items():
+            setattr(root_set, array_name, current_array)
+            setattr(root_set, array_name + "_local", current_array)
+        if len(gathered) > 0:
+            root_set._local_index = np.arange(root_set._values.shape[0]
+                                              if root_set._values is not None
+                                              else len(current_array))
+        return root_set
+
+    def get_global_rows(self, array_name, index):
+        """
+        Returns the rows ``index`` of the global array ``array_name``, e.g.
+        ``'_values'``. Without the global array, as in distributed mode, the
+        rows are requested from the processors holding them with
+        :meth:`bet.util.get_global_values_at`, so this must then be called on
+        all processors.
+
+        :param string array_name: name of a global array in
+            :attr:`array_names`
+        :param index: indices of the rows
+        :type index: :class:`numpy.ndarray` of ints
+
+        :rtype: :class:`numpy.ndarray`
+        :returns: rows
+        """
+        current_array = getattr(self, array_name)
+        if current_array is not None:
+            return current_array[index]
+        return util.get_global_values_at(getattr(self, array_name + "_local"),
+                                         index)
+
     def local_to_global(self):
         """
-        Makes global arrays from available local ones.
+        Makes global arrays from available local ones, unless in distributed
+        mode.
         """
+        if self._distributed:
+            return
         for array_name in self.array_names:
             current_array_local = getattr(self, array_name + "_local")
             if current_array_local is not None:
+                if _is_broadcast_rows(current_array_local):
+                    # bounds broadcast from the domain stay broadcast
+                    self.update_bounds(comm.allreduce(
+                        current_array_local.shape[0], op=MPI.SUM))
+                    continue
                 setattr(self, array_name,
                         util.get_global_values(current_array_local))
+                if array_name + "_local" in self._versions:
+                    self._versions[array_name] = \
+                        self._versions[array_name + "_local"]
+
+    def _query_is_collective(self):
+        """
+        Returns whether :meth:`query` involves all processors, which then must
+        query at the same time.
+        """
+        return False
+
+    def query(self, x, k=1):
+        """
+        Identify which value points x are associated with for discretization.
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int k: number of nearest neighbors to return
+
+        """
+        pass
+
+    def query_chunked(self, x, k=1, chunk_size=None, return_dist=False,
+                      ptr_out=None):
+        """
+        Identify which value points x are associated with for discretization
+        by calling :meth:`query` on at most ``chunk_size`` points at a time.
+        Pointers are written to a single integer buffer and distances are
+        discarded unless requested, so the temporary memory is bounded by the
+        chunk size. If the queries involve all processors, see
+        :meth:`set_distributed`, processors with fewer chunks than others
+        query no points until all chunks are done, so all processors must call
+        this method at the same time.
+
+        :param x: points for query, or an iterable (e.g. a generator) of
+            arrays of points
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)`` or iterable
+        :param int k: number of nearest neighbors to return
+        :param int chunk_size: maximum number of points per call to
+            :meth:`query`, defaults to
+            :data:`bet.sample.default_query_chunk_size`
+        :param bool return_dist: flag whether or not to return distances
+        :param ptr_out: preallocated buffer to write pointers to, required
+            length is the total number of points
+        :type ptr_out: :class:`numpy.ndarray` of shape ``(*,)`` or ``(*, k)``
+
+        :rtype: :class:`numpy.ndarray` or tuple
+        :returns: ptr or (dist, ptr) if ``return_dist``
+        """
+        if chunk_size is None:
+            chunk_size = default_query_chunk_size
+        chunk_size = int(chunk_size)
+        if k == 1:
+            shape = ()
+        else:
+            shape = (k,)
+        dtype = ptr_dtype(self.check_num())
+
+        if ptr_out is None and isinstance(x, np.ndarray):
+            x = util.fix_dimensions_data(x, self._dim)
+            ptr_out = np.empty((x.shape[0],) + shape, dtype=dtype)
+        if return_dist and ptr_out is not None:
+            dist_out = np.empty(ptr_out.shape)
+
+        ptr_list = []
+        dist_list = []
+        start = 0
+        collective = self._query_is_collective()
+        chunks = _chunks(x, chunk_size)
+        while True:
+            x_chunk = next(chunks, None)
+            if collective and comm.allreduce(int(x_chunk is not None),
+                                             op=MPI.MAX) == 0:
+                break
+            elif x_chunk is None:
+                if not collective:
+                    break
+                # match the queries of processors with more chunks
+                self.query(np.empty((0, self._dim)), k=k)
+                continue
+            (dist, ptr) = self.query(x_chunk, k=k)
+            end = start + x_chunk.shape[0]
+            if ptr_out is None:
+                ptr_list.append(np.asarray(ptr, dtype=dtype))
+                if return_dist:
+                    dist_list.append(dist)
+            elif end > ptr_out.shape[0]:
+                raise length_not_matching("ptr_out is shorter than x")
+            else:
+                ptr_out[start:end] = ptr
+                if return_dist:
+                    dist_out[start:end] = dist
+            start = end
+
+        if ptr_out is None:
+            if len(ptr_list) == 0:
+                ptr_out = np.empty((0,) + shape, dtype=dtype)
+                dist_out = np.empty((0,) + shape)
+            else:
+                ptr_out = np.concatenate(ptr_list)
+                if return_dist:
+                    dist_out = np.concatenate(dist_list)
+        elif start != ptr_out.shape[0]:
+            raise length_not_matching("ptr_out is longer than x")
+
+        if return_dist:
+            return (dist_out, ptr_out)
+        return ptr_out
+
+    def query_sample_set(self, sample_set, k=1, chunk_size=None,
+                         use_cache=False):
+        """
+        Identify which value points the local values of ``sample_set`` are
+        associated with for discretization. With ``use_cache`` the pointers
+        are kept in :data:`bet.sample.query_cache` under the versions of both
+        sets, ``k`` and ``self._p_norm``, so querying unchanged sets again (or
+        copies of them) reuses the pointers, and the returned array is
+        read-only. Values changed in place must be marked with
+        :meth:`mark_changed` before querying with ``use_cache``. If the
+        queries involve all processors the pointers are only reused if they
+        are cached on all processors.
+
+        .. seealso::
+
+            :meth:`query_chunked`, :meth:`get_version`
+
+        :param sample_set: sample set whose local values are queried
+        :type sample_set: :class:`~bet.sample.sample_set_base`
+        :param int k: number of nearest neighbors to return
+        :param int chunk_size: maximum number of points per query
+        :param bool use_cache: flag whether or not to reuse and keep the
+            pointers in :data:`bet.sample.query_cache`
+
+        :rtype: :class:`numpy.ndarray`
+        :returns: ptr
+        """
+        if sample_set._values_local is None:
+            sample_set.global_to_local()
+        if not use_cache:
+            return self.query_chunked(sample_set._values_local, k=k,
+                                      chunk_size=chunk_size)
+        key = (self.get_version(), sample_set.get_version_local(), k,
+               float(self._p_norm))
+        ptr = query_cache.get(key)
+        if self._query_is_collective() and \
+                not comm.allreduce(ptr is not None, op=MPI.LAND):
+            ptr = None
+        if ptr is None:
+            ptr = self.query_chunked(sample_set._values_local, k=k,
+                                     chunk_size=chunk_size)
+            ptr.flags.writeable = False
+            query_cache.put(key, ptr)
+        return ptr
+
+    def query_margin(self, x, chunk_size=None):
+        """
+        Identify which value points x are associated with for discretization,
+        as :meth:`query_chunked`, together with a margin for each point. A
+        point stays in its cell as long as no boundary of the cells moves by
+        more than its margin, see :meth:`partition_shift`. The margin is 0 if
+        it is not known for this type of sample set.
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int chunk_size: maximum number of points per query
+
+        :rtype: tuple
+        :returns: (ptr, margin)
+        """
+        ptr = self.query_chunked(x, chunk_size=chunk_size)
+        return (ptr, np.zeros((len(ptr),)))
+
+    def partition_shift(self, other):
+        """
+        Returns an upper bound of the distance by which the boundaries of the
+        cells of ``other`` move to become the cells of this sample set, or
+        infinity if the cells cannot be compared. Must be called on all
+        processors.
+
+        .. seealso::
+
+            :meth:`query_margin`
+
+        :param other: sample set with the previous cells
+        :type other: :class:`~bet.sample.sample_set_base`
+
+        :rtype: float
+        :returns: shift
+        """
+        return np.inf
+
+    def _comparable(self, other):
+        """
+        Returns whether ``other`` is a sample set of the same type with the
+        same number of cells in the same space.
+        """
+        return type(self) is type(other) and self._dim == other._dim and \
+            float(self._p_norm) == float(other._p_norm) and \
+            self.check_num() == other.check_num()
 
-    def query(self, x, k=1):
+    def _partition_snapshot(self):
         """
-        Identify which value points x are associated with for discretization.
+        Returns a sample set of the same type holding private copies of the
+        arrays named in :attr:`partition_names`, to compare later cells with
+        in :meth:`partition_shift`.
+        """
+        snapshot = type(self)(self._dim)
+        snapshot._p_norm = self._p_norm
+        for array_name in self.partition_names:
+            current_array = getattr(self, array_name)
+            if current_array is not None:
+                setattr(snapshot, array_name, np.copy(current_array))
+        return snapshot
+
+    def _sequential_mc(self, n_mc_points, rel_tol=None, max_mc_points=None,
+                       min_volume=0.0, min_probability=None, callback=None):
+        """
+        Draws uniform Monte Carlo points on the domain in rounds of
+        ``n_mc_points`` and keeps running counts of the points in each cell.
+        Without ``rel_tol`` a single round is drawn. Otherwise rounds are
+        drawn until the relative standard error of the volume fraction of
+        every tracked cell is at most ``rel_tol`` or ``max_mc_points`` points
+        have been drawn. Tracked cells have an estimated volume fraction
+        above ``min_volume`` and, if given and ``self._probabilities``
+        exists, a probability above ``min_probability``.
+
+        :param int n_mc_points: number of MC points per round
+        :param float rel_tol: target relative standard error
+        :param int max_mc_points: maximum total number of MC points
+        :param float min_volume: volume fraction threshold of tracked cells
+        :param float min_probability: probability threshold of tracked cells
+        :param callback: called as ``callback(mc_points, emulate_ptr)`` with
+            the local points of each round and their cells
+        :type callback: callable
 
-        :param x: points for query
-        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
-        :param int k: number of nearest neighbors to return
+        :rtype: tuple
+        :returns: (counts, n_total, rel_error) where ``counts`` is the number
+            of points in each cell, ``n_total`` the number of points drawn and
+            ``rel_error`` the relative standard error of each cell
 
         """
-        pass
-
-    def estimate_volume(self, n_mc_points=int(1E4)):
+        num = self.check_num()
+        n_mc_points = max(1, int(n_mc_points))
+        if rel_tol is None or max_mc_points is None:
+            max_mc_points = n_mc_points
+        max_mc_points = int(max_mc_points)
+        width = self._domain[:, 1] - self._domain[:, 0]
+        counts = np.zeros((num,))
+        n_total = 0
+        n_rounds = 0
+        while True:
+            n_round = min(n_mc_points, max_mc_points - n_total)
+            n_round_local = int(n_round/comm.size) + \
+                int(comm.rank < n_round % comm.size)
+            mc_points = width*np.random.random((n_round_local,
+                                                self._domain.shape[0])) + \
+                self._domain[:, 0]
+            emulate_ptr = self.query_chunked(mc_points)
+            counts += cell_sum(emulate_ptr, num)
+            n_total += n_round
+            n_rounds += 1
+            if callback is not None:
+                callback(mc_points, emulate_ptr)
+
+            # relative standard error of count/n_total is sqrt((1-p)/count)
+            rel_error = np.inf*np.ones((num,))
+            hit = counts > 0
+            rel_error[hit] = np.sqrt((1.0 - counts[hit]/float(n_total)) /
+                                     counts[hit])
+            if rel_tol is None or n_total >= max_mc_points:
+                break
+            tracked = counts/float(n_total) > min_volume
+            if min_probability is not None and \
+                    self._probabilities is not None:
+                tracked = np.logical_and(tracked, self._probabilities >
+                                         min_probability)
+            if np.all(rel_error[tracked] <= rel_tol):
+                break
+        if rel_tol is not None:
+            logging.info("Used {} MC points in {} rounds, max relative error"
+                         " {}".format(n_total, n_rounds, np.max(rel_error)))
+        return (counts, n_total, rel_error)
+
+    def estimate_volume(self, n_mc_points=int(1E4), rel_tol=None,
+                        max_mc_points=int(1E7), min_volume=0.0,
+                        min_probability=None):
         """
         Calculate the volume faction of cells approximately using Monte
         Carlo integration. 
 
+        If ``rel_tol`` is given MC points are drawn in rounds of
+        ``n_mc_points`` until the relative standard error of the volume of
+        every cell with volume above ``min_volume`` (and probability above
+        ``min_probability``) is at most ``rel_tol`` or ``max_mc_points``
+        points have been used.
+
         :param int n_mc_points: If estimate is True, number of MC points to use
+            (per round if ``rel_tol`` is given)
+        :param float rel_tol: target relative standard error of the volumes
+        :param int max_mc_points: maximum number of MC points to use
+        :param float min_volume: only cells with a larger volume fraction need
+            to reach ``rel_tol``
+        :param float min_probability: only cells with a larger probability
+            need to reach ``rel_tol``
+
+        :rtype: :class:`numpy.ndarray` of shape (num,)
+        :returns: relative standard error of the volume of each cell
+
         """
-        num = self.check_num()
-        n_mc_points = int(n_mc_points)
-        n_mc_points_local = int(n_mc_points/comm.size) + \
-            int(comm.rank < n_mc_points % comm.size)
-        width = self._domain[:, 1] - self._domain[:, 0]
-        mc_points = width*np.random.random((n_mc_points_local,
-                                            self._domain.shape[0])) + self._domain[:, 0]
-        (_, emulate_ptr) = self.query(mc_points)
-        vol = np.zeros((num,))
-        for i in range(num):
-            vol[i] = np.sum(np.equal(emulate_ptr, i))
-        cvol = np.copy(vol)
-        comm.Allreduce([vol, MPI.DOUBLE], [cvol, MPI.DOUBLE], op=MPI.SUM)
-        vol = cvol
-        vol = vol/float(n_mc_points)
-        self._volumes = vol
+        (counts, n_total, rel_error) = self._sequential_mc(
+            n_mc_points, rel_tol, max_mc_points, min_volume, min_probability)
+        self._volumes = counts/float(n_total)
         self.global_to_local()
+        return rel_error
 
     def estimate_volume_emulated(self, emulated_sample_set):
         """
@@ -1063,19 +2981,11 @@ class sample_set_base(object):
         """
         num = self.check_num()
 
-        if emulated_sample_set._values_local is None:
-            emulated_sample_set.global_to_local()
-
-        (_, emulate_ptr) = self.query(emulated_sample_set._values_local)
+        emulate_ptr = self.query_sample_set(emulated_sample_set)
 
-        vol = np.zeros((num,))
-        for i in range(num):
-            vol[i] = np.sum(np.equal(emulate_ptr, i))
-        cvol = np.copy(vol)
-        comm.Allreduce([vol, MPI.DOUBLE], [cvol, MPI.DOUBLE], op=MPI.SUM)
+        vol = cell_sum(emulate_ptr, num)
         num_emulate = emulated_sample_set._values_local.shape[0]
         num_emulate = comm.allreduce(num_emulate, op=MPI.SUM)
-        vol = cvol
         vol = vol/float(num_emulate)
         self._volumes = vol
         self.global_to_local()
@@ -1095,38 +3005,103 @@ class sample_set_base(object):
 
     def global_to_local(self):
         """
-        Makes local arrays from available global ones.
+        Makes local arrays from available global ones. In distributed mode
+        the global arrays are then freed. Global arrays not yet loaded whose
+        rows can be loaded separately, see :meth:`set_lazy`, stay unloaded
+        and the local arrays are deferred to load only the local rows.
         """
         num = self.check_num()
-        global_index = np.arange(num, dtype=np.int)
-        self._local_index = np.array_split(global_index, comm.size)[comm.rank]
+        # the rows np.array_split gives this processor
+        (size, extra) = divmod(num, comm.size)
+        start = comm.rank*size + min(comm.rank, extra)
+        self._local_index = np.arange(start, start + size +
+                                      (comm.rank < extra),
+                                      dtype=ptr_dtype(num))
+        rows = slice(int(start), int(start + len(self._local_index)))
         for array_name in self.array_names:
+            if array_name in self._lazy and array_name in self._lazy_rows:
+                self.set_lazy(array_name + "_local", functools.partial(
+                    self._lazy_rows[array_name], rows), len(self._local_index))
+                if self._distributed:
+                    setattr(self, array_name, None)
+                continue
             current_array = getattr(self, array_name)
             if current_array is not None:
                 setattr(self, array_name + "_local",
                         np.array_split(current_array, comm.size)[comm.rank])
+                if array_name in self._versions:
+                    self._versions[array_name + "_local"] = \
+                        self._versions[array_name]
+                if self._distributed:
+                    setattr(self, array_name, None)
+        if self._distributed:
+            self._kdtree = None
+            self._values_buffer = None
         comm.barrier()
 
     def copy(self):
         """
-        Makes a copy using :meth:`numpy.copy`.
+        Makes a copy using :meth:`numpy.copy`. Attributes not yet loaded, see
+        :meth:`set_lazy`, and a nearest neighbor search tree of the current
+        values which holds its own copy of them are shared with the copy.
+
+        .. seealso::
+
+            :meth:`shallow_copy`
 
         :rtype: :class:`~bet.sample.sample_set_base`
         :returns: Copy of this :class:`~bet.sample.sample_set_base`
 
+        """
+        return self._copy(_copy_array)
+
+    def shallow_copy(self):
+        """
+        Makes a copy that shares the arrays of this sample set instead of
+        copying them. The arrays of the copy are read-only views, so setting
+        an attribute of the copy, e.g. with :meth:`set_values`, allocates a
+        new array while writing into an array of the copy in place raises a
+        :class:`ValueError`. The arrays of this sample set stay writable, and
+        writing into them in place changes the copy too. Attributes not yet
+        loaded, see :meth:`set_lazy`, and a nearest neighbor search tree of
+        the current values are shared too.
+
+        :rtype: :class:`~bet.sample.sample_set_base`
+        :returns: Shallow copy of this :class:`~bet.sample.sample_set_base`
+
+        """
+        return self._copy(_shared_view)
+
+    def _copy(self, copy_array):
+        """
+        Makes a copy whose arrays are ``copy_array`` of the arrays of this
+        sample set, see :meth:`copy` and :meth:`shallow_copy`.
         """
         my_copy = type(self)(self.get_dim())
-        for array_name in self.all_ndarray_names:
-            current_array = getattr(self, array_name)
+        for attrname in self.all_ndarray_names + self.vector_names:
+            if attrname == "_dim":
+                continue
+            if attrname in self._lazy:
+                my_copy.set_lazy(attrname, self._lazy[attrname],
+                                 self._nums.get(attrname),
+                                 self._lazy_rows.get(attrname))
+                continue
+            current_array = getattr(self, attrname)
+            if isinstance(current_array, np.ndarray):
+                current_array = copy_array(current_array)
+            elif current_array is not None:
+                current_array = np.copy(current_array)
             if current_array is not None:
-                setattr(my_copy, array_name,
-                        np.copy(current_array))
-        for vector_name in self.vector_names:
-            if vector_name is not "_dim":
-                current_vector = getattr(self, vector_name)
-                if current_vector is not None:
-                    setattr(my_copy, vector_name, np.copy(current_vector))
-        if self._kdtree is not None:
+                setattr(my_copy, attrname, current_array)
+        my_copy.set_kdtree_backend(self._kdtree_backend, self._kdtree_n_jobs)
+        my_copy._distributed = self._distributed
+        my_copy._values_dtype = self._values_dtype
+        my_copy._versions = dict(self._versions)
+        if self._has_current_kdtree() and (copy_array is _shared_view or not
+                                           _kdtree_shares_memory(
+                                               self._kdtree, self._values)):
+            my_copy._share_kdtree(self._kdtree)
+        elif self._kdtree is not None:
             my_copy.set_kdtree()
         return my_copy
 
@@ -1161,11 +3136,13 @@ class sample_set_base(object):
 
 
 def save_discretization(save_disc, file_name, discretization_name=None,
-                        globalize=False):
+                        globalize=False, file_format=None):
     """
-    Saves this :class:`bet.sample.discretization` as a ``.mat`` file. Each
-    attribute is added to a dictionary of names and arrays which are then
-    saved to a MATLAB-style file.
+    Saves this :class:`bet.sample.discretization` as a ``.mat`` file or a
+    :class:`~bet.sample.chunked_store`. For a ``.mat`` file each attribute is
+    added to a dictionary of names and arrays which are then saved to a
+    MATLAB-style file. A chunked store only writes the rows appended since
+    the last save.
 
     :param save_disc: sample set to save
     :type save_disc: :class:`bet.sample.discretization`
@@ -1177,11 +3154,16 @@ def save_discretization(save_disc, file_name, discretization_name=None,
     :param bool globalize: flag whether or not to globalize
         :class:`bet.sample.sample_set_base` objects stored in this
         discretization
+    :param string file_format: ``'mat'`` or ``'chunked'``, defaults to
+        :data:`bet.sample.default_file_format`
 
     :rtype: string
     :returns: local file name
 
     """
+    if file_format is None:
+        file_format = default_file_format
+
     # create temporary dictionary
     new_mdat = dict()
 
@@ -1206,7 +3188,19 @@ def save_discretization(save_disc, file_name, discretization_name=None,
         if curr_attr is not None:
             if attrname in discretization.sample_set_names:
                 save_sample_set(curr_attr, file_name,
-                                discretization_name+attrname, globalize)
+                                discretization_name+attrname, globalize,
+                                file_format)
+
+    if file_format == 'chunked':
+        attributes = dict()
+        for attrname in discretization.vector_names:
+            attributes[attrname] = getattr(save_disc, attrname)
+        if (globalize and comm.rank == 0) or not globalize:
+            chunked_store(_chunked_path(local_file_name)).save(
+                discretization_name, 'bet.sample.discretization', attributes,
+                discretization.vector_names)
+        comm.barrier()
+        return local_file_name
 
     new_mdat = dict()
     # create temporary dictionary
@@ -1230,28 +3224,33 @@ def save_discretization(save_disc, file_name, discretization_name=None,
     return local_file_name
 
 
-def load_discretization_parallel(file_name, discretization_name=None):
+def load_discretization_parallel(file_name, discretization_name=None,
+                                 lazy=False):
     """
     Loads a :class:`~bet.sample.discretization` from a ``.mat`` file. If a file
     contains multiple :class:`~bet.sample.discretization` objects then
     ``discretization_name`` is used to distinguish which between different
     :class:`~bet.sample.discretization` objects.
 
+    If the files were saved by a different number of processors each
+    processor reads only the rows of the local arrays it holds, see
+    :func:`load_sample_set_parallel`.
+
     :param string file_name: Name of the ``.mat`` file, no extension is
         needed.
     :param string discretization_name: String to prepend to attribute names when
         saving multiple :class`bet.sample.discretization` objects to a single
         ``.mat`` file
+    :param bool lazy: Flag whether or not to memory-map sample set
+        attributes on first access when each processor loads its own chunked
+        store
 
     :rtype: :class:`~bet.sample.discretization`
     :returns: the ``discretization`` that matches the ``discretization_name``
 
     """
     # Find and open save files
-    save_dir = os.path.dirname(file_name)
-    base_name = os.path.basename(file_name)
-    mdat_files = glob.glob(os.path.join(save_dir,
-                                        "proc*_{}".format(base_name)))
+    mdat_files = _glob_parallel(file_name)
 
     if len(mdat_files) == comm.size:
         logging.info("Loading {} sample set using parallel files (same nproc)"
@@ -1259,7 +3258,8 @@ def load_discretization_parallel(file_name, discretization_name=None):
         # if the number of processors is the same then set mdat to
         # be the one with the matching processor number (doesn't
         # really matter)
-        return load_discretization(mdat_files[comm.rank], discretization_name)
+        return load_discretization(mdat_files[comm.rank], discretization_name,
+                                   lazy)
     else:
         logging.info("Loading {} sample set using parallel files (diff nproc)"
                      .format(discretization_name))
@@ -1275,28 +3275,24 @@ def load_discretization_parallel(file_name, discretization_name=None):
 
         loaded_disc = discretization(input_sample_set, output_sample_set)
 
-        # Determine how many processors the previous data used
-        # otherwise gather the data from mdat and then scatter
-        # among the processors and update mdat
-        mdat_files_local = comm.scatter(mdat_files)
-        mdat_local = [sio.loadmat(m) for m in mdat_files_local]
-        mdat_list = comm.allgather(mdat_local)
-        mdat_global = []
-        # instead of a list of lists, create a list of mdat
-        for mlist in mdat_list:
-            mdat_global.extend(mlist)
+        # Read the rows of the local pointers this processor holds from the
+        # files holding them, and the global pointers from the first file
+        shapes = [saved_shapes(m) for m in mdat_files]
+        attrnames = [attrname for attrname in discretization.vector_names
+                     if discretization_name+attrname in shapes[0]]
+        mdat = _load_keys(mdat_files[0], [discretization_name+attrname for
+                                          attrname in attrnames if not
+                                          attrname.endswith('_local')])
 
         # load attributes
-        for attrname in discretization.vector_names:
-            if discretization_name+attrname in list(mdat_global[0].keys()):
-                if attrname.endswith('_local') and comm.size != \
-                        len(mdat_list):
-                    # create lists of local data
-                    temp_input = None
-                else:
-                    temp_input = np.squeeze(mdat_global[0][
-                        discretization_name+attrname])
-                setattr(loaded_disc, attrname, temp_input)
+        for attrname in attrnames:
+            if attrname.endswith('_local'):
+                temp_input = _load_local_rows(mdat_files, shapes,
+                                              discretization_name+attrname,
+                                              True)
+            else:
+                temp_input = np.squeeze(mdat[discretization_name+attrname])
+            setattr(loaded_disc, attrname, temp_input)
 
         # load sample sets
         for attrname in discretization.sample_set_names:
@@ -1304,22 +3300,13 @@ def load_discretization_parallel(file_name, discretization_name=None):
                     attrname is not '_output_sample_set':
                 setattr(loaded_disc, attrname, load_sample_set(file_name,
                                                                discretization_name+attrname))
-
-        # re-localize if necessary
-        if file_name.startswith('proc_') and comm.size > 1 \
-                and comm.size != len(mdat_list):
-            warn_string = "Local pointers have been removed and will be"
-            warn_string += " re-created as necessary)"
-            warnings.warn(warn_string)
-            #loaded_disc._io_ptr_local = None
-            #loaded_disc._emulated_ii_ptr_local = None
-            #loaded_disc._emulated_oo_ptr_local = None
     return loaded_disc
 
 
-def load_discretization(file_name, discretization_name=None):
+def load_discretization(file_name, discretization_name=None, lazy=False):
     """
-    Loads a :class:`~bet.sample.discretization` from a ``.mat`` file. If a file
+    Loads a :class:`~bet.sample.discretization` from a ``.mat`` file or a
+    :class:`~bet.sample.chunked_store`. If a file
     contains multiple :class:`~bet.sample.discretization` objects then
     ``discretization_name`` is used to distinguish which between different
     :class:`~bet.sample.discretization` objects.
@@ -1329,6 +3316,8 @@ def load_discretization(file_name, discretization_name=None):
     :param string discretization_name: String to prepend to attribute names when
         saving multiple :class`bet.sample.discretization` objects to a single
         ``.mat`` file
+    :param bool lazy: Flag whether or not to memory-map sample set
+        attributes on first access, see :func:`load_sample_set`
 
     :rtype: :class:`~bet.sample.discretization`
     :returns: the ``discretization`` that matches the ``discretization_name``
@@ -1341,19 +3330,26 @@ def load_discretization(file_name, discretization_name=None):
     elif not os.path.exists(file_name) and os.path.exists(os.path.join(
             os.path.dirname(file_name),
             "proc{}_{}".format(comm.rank, os.path.basename(file_name)))):
-        return load_discretization_parallel(file_name, discretization_name)
-
-    mdat = sio.loadmat(file_name)
+        return load_discretization_parallel(file_name, discretization_name,
+                                            lazy)
+    elif not os.path.isdir(_chunked_path(file_name)) and \
+            os.path.isdir(_chunked_path(os.path.join(
+                os.path.dirname(file_name),
+                "proc{}_{}".format(comm.rank, os.path.basename(file_name))))):
+        return load_discretization_parallel(file_name, discretization_name,
+                                            lazy)
+
+    mdat = _loadmat(file_name)
     if discretization_name is None:
         discretization_name = 'default'
 
     input_sample_set = load_sample_set(file_name,
                                        discretization_name +
-                                       '_input_sample_set')
+                                       '_input_sample_set', lazy=lazy)
 
     output_sample_set = load_sample_set(file_name,
                                         discretization_name +
-                                        '_output_sample_set')
+                                        '_output_sample_set', lazy=lazy)
 
     loaded_disc = discretization(input_sample_set, output_sample_set)
 
@@ -1361,7 +3357,8 @@ def load_discretization(file_name, discretization_name=None):
         if attrname is not '_input_sample_set' and \
                 attrname is not '_output_sample_set':
             setattr(loaded_disc, attrname,
-                    load_sample_set(file_name, discretization_name+attrname))
+                    load_sample_set(file_name, discretization_name+attrname,
+                                    lazy=lazy))
 
     for attrname in discretization.vector_names:
         if discretization_name+attrname in list(mdat.keys()):
@@ -1385,6 +3382,9 @@ class voronoi_sample_set(sample_set_base):
 
     """
 
+    #: List of attribute names which :meth:`partition_shift` compares
+    partition_names = ['_values', '_values_local']
+
     def query(self, x, k=1):
         """
         Identify which value points x are associated with for discretization.
@@ -1396,13 +3396,72 @@ class voronoi_sample_set(sample_set_base):
         :rtype: tuple
         :returns: (dist, ptr)
         """
-        if self._kdtree is None:
-            self.set_kdtree()
-        else:
+        if self._kdtree is not None:
             self.check_num()
 
-        (dist, ptr) = self._kdtree.query(x, p=self._p_norm, k=k)
-        return (dist, ptr)
+        return self.query_kdtree(x, k=k)
+
+    def _query_is_collective(self):
+        """
+        Returns whether :meth:`query` involves all processors, which is the
+        case in distributed mode without global values, see
+        :meth:`~bet.sample.sample_set_base.query_kdtree`.
+        """
+        return self._distributed and self._values is None
+
+    def query_margin(self, x, chunk_size=None):
+        """
+        Identify which value points x are associated with for discretization
+        together with a margin for each point, half the difference of the
+        distances to the two nearest value points.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.query_margin`
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int chunk_size: maximum number of points per query
+
+        :rtype: tuple
+        :returns: (ptr, margin)
+        """
+        if self.check_num() < 2:
+            ptr = self.query_chunked(x, chunk_size=chunk_size)
+            return (ptr, np.inf*np.ones((len(ptr),)))
+        (dist, ptr) = self.query_chunked(x, k=2, chunk_size=chunk_size,
+                                         return_dist=True)
+        return (np.ascontiguousarray(ptr[:, 0]), 0.5*(dist[:, 1] - dist[:, 0]))
+
+    def partition_shift(self, other):
+        """
+        Returns the largest distance between the value points of this sample
+        set and of ``other``, or infinity if the cells cannot be compared.
+        Must be called on all processors.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.partition_shift`
+
+        :param other: sample set with the previous cells
+        :type other: :class:`~bet.sample.sample_set_base`
+
+        :rtype: float
+        :returns: shift
+        """
+        if not self._comparable(other):
+            return np.inf
+        if self._values is not None and other._values is not None:
+            return float(np.max(np.linalg.norm(
+                self._values - other._values, ord=self._p_norm, axis=1),
+                initial=0.0))
+        shift = np.inf
+        if self._values_local is not None and other._values_local is not \
+                None and self._values_local.shape == other._values_local.shape:
+            shift = float(np.max(np.linalg.norm(
+                self._values_local - other._values_local, ord=self._p_norm,
+                axis=1), initial=0.0))
+        return comm.allreduce(shift, op=MPI.MAX)
 
     def exact_volume_1D(self):
         r"""
@@ -1446,78 +3505,82 @@ class voronoi_sample_set(sample_set_base):
         :param float side_ratio: ratio of width to reflect across boundary
 
         """
-        # Check inputs
-        num = self.check_num()
         if self._dim != 2:
             raise dim_not_matching("Only applicable for 2D domains.")
-        new_samp = np.copy(self._values)
-
-        # Add points around boundary
-        add_points = np.less(self._values[:, 0],
-                             self._domain[0][0] +
-                             side_ratio*(self._domain[0][1] -
-                                         self._domain[0][0]))
-        points_new = self._values[add_points, :]
-        points_new[:, 0] = self._domain[0][0] - \
-            (points_new[:, 0]-self._domain[0][0])
-        new_samp = np.vstack((new_samp, points_new))
-
-        add_points = np.greater(self._values[:, 0],
-                                self._domain[0][1] -
-                                side_ratio*(self._domain[0][1] -
-                                            self._domain[0][0]))
-        points_new = self._values[add_points, :]
-        points_new[:, 0] = self._domain[0][1] + \
-            (-points_new[:, 0]+self._domain[0][1])
-        new_samp = np.vstack((new_samp, points_new))
-
-        add_points = np.less(self._values[:, 1],
-                             self._domain[1][0] +
-                             side_ratio*(self._domain[1][1] -
-                                         self._domain[1][0]))
-        points_new = self._values[add_points, :]
-        points_new[:, 1] = self._domain[1][0] - \
-            (points_new[:, 1]-self._domain[1][0])
-        new_samp = np.vstack((new_samp, points_new))
-
-        add_points = np.greater(self._values[:, 1],
-                                self._domain[1][1] -
-                                side_ratio*(self._domain[1][1] -
-                                            self._domain[1][0]))
-        points_new = self._values[add_points, :]
-        points_new[:, 1] = self._domain[1][1] + \
-            (-points_new[:, 1]+self._domain[1][1])
-        new_samp = np.vstack((new_samp, points_new))
-
-        # Make Voronoi diagram and calculate volumes
-        vor = spatial.Voronoi(new_samp)
+        self.exact_volume_nD(side_ratio)
+
+    def exact_volume_nD(self, side_ratio=0.25):
+        r"""
+
+        Exactly calculates the volume fraction of the Voronoi cells.
+        Specifically we are calculating 
+        :math:`\mu_\Lambda(\mathcal(V)_{i,N} \cap A)/\mu_\Lambda(\Lambda)`.
+
+        The Voronoi cells are clipped to the domain by reflecting the samples
+        within ``side_ratio`` of each face of the domain across that face.
+        Polygon areas are computed with the shoelace formula in 2D and
+        polytope volumes with :class:`scipy.spatial.ConvexHull` in higher
+        dimensions. The cells are split among processors.
+
+        :param float side_ratio: ratio of width to reflect across boundary
+
+        """
+        # Check inputs
+        num = self.check_num()
+        if self._dim == 1:
+            self.exact_volume_1D()
+            return
+
+        # Add points around boundary and make Voronoi diagram
+        vor = spatial.Voronoi(_reflect_boundary(self._values, self._domain,
+                                                side_ratio))
         local_index = np.arange(0+comm.rank, num, comm.size)
         local_array = np.array(local_index, dtype='int64')
+        regions = [vor.regions[vor.point_region[i]] for i in local_index]
+        bounded = np.array([len(region) > 0 and -1 not in region for region
+                            in regions], dtype=bool)
+        regions = [region for region, b in zip(regions, bounded) if b]
+
+        # calculate volumes
         lam_vol_local = np.zeros(local_array.shape)
-        for I, i in enumerate(local_index):
-            val = vor.point_region[i]
-            region = vor.regions[val]
-            if not -1 in region:
-                polygon = [vor.vertices[k] for k in region]
-                delan = spatial.Delaunay(polygon)
-                simplices = delan.points[delan.simplices]
-                vol = 0.0
-                for j in range(simplices.shape[0]):
-                    mat = np.empty((self._dim, self._dim))
-                    mat[:, :] = (simplices[j][1::, :] -
-                                 simplices[j][0, :]).transpose()
-                    vol += abs(1.0/math.factorial(self._dim)*linalg.det(mat))
-                lam_vol_local[I] = vol
+        if self._dim == 2:
+            lam_vol_local[bounded] = _polygon_areas(vor.vertices, regions)
+        else:
+            lam_vol_local[bounded] = [spatial.ConvexHull(
+                vor.vertices[region]).volume for region in regions]
         lam_size = np.prod(self._domain[:, 1] - self._domain[:, 0])
         lam_vol_local = lam_vol_local/lam_size
         lam_vol_global = util.get_global_values(lam_vol_local)
         global_index = util.get_global_values(local_array)
-        lam_vol = np.zeros(lam_vol_global.shape)
         self._volumes = np.zeros((num,))
         self._volumes[global_index] = lam_vol_global[:]
         self.global_to_local()
 
-    def estimate_radii(self, n_mc_points=int(1E4), normalize=True):
+    def _normalized_radii_callback(self, rad, normalize):
+        """
+        Returns a callback for :meth:`_sequential_mc` updating ``rad`` in
+        place with the largest distance from each sample to the MC points in
+        its cell (on the domain normalized to the unit hypercube if
+        ``normalize``).
+        """
+        num = rad.shape[0]
+        samples = self.get_values()
+        lower = self._domain[:, 0]
+        width = self._domain[:, 1] - self._domain[:, 0]
+        if normalize:
+            samples = (samples - lower)/width
+
+        def update_radii(mc_points, emulate_ptr):
+            if normalize:
+                mc_points = (mc_points - lower)/width
+            rad[:] = np.maximum(rad, cell_max(emulate_ptr, num, np.linalg.norm(
+                mc_points - samples[emulate_ptr, :], ord=self._p_norm,
+                axis=1)))
+        return update_radii
+
+    def estimate_radii(self, n_mc_points=int(1E4), normalize=True,
+                       rel_tol=None, max_mc_points=int(1E7), min_volume=0.0,
+                       min_probability=None):
         """
         Calculate the radii of cells approximately using Monte
         Carlo integration. 
@@ -1529,50 +3592,28 @@ class voronoi_sample_set(sample_set_base):
            ``emulated_input_sample_set`` is NOT used to calculate the volume.
            This should at least be an option. 
 
+        If ``rel_tol`` is given MC points are drawn in rounds as in
+        :meth:`~bet.sample.sample_set_base.estimate_volume`.
+
         :param int n_mc_points: If estimate is True, number of MC points to use
+            (per round if ``rel_tol`` is given)
         :param bool normalize: estimate normalized radius
+        :param float rel_tol: target relative standard error of the volumes
+        :param int max_mc_points: maximum number of MC points to use
+        :param float min_volume: only cells with a larger volume fraction need
+            to reach ``rel_tol``
+        :param float min_probability: only cells with a larger probability
+            need to reach ``rel_tol``
+
+        :rtype: :class:`numpy.ndarray` of shape (num,)
+        :returns: relative standard error of the volume of each cell
 
         """
         num = self.check_num()
-        n_mc_points = int(n_mc_points)
-        samples = np.copy(self.get_values())
-        n_mc_points_local = int(n_mc_points/comm.size) + \
-            int(comm.rank < n_mc_points % comm.size)
-
-        # normalize the samples
-        if normalize:
-            self.update_bounds()
-            samples = samples - self._left
-            samples = samples/self._width
-            self._left = None
-            self._right = None
-            self._width = None
-
-        width = self._domain[:, 1] - self._domain[:, 0]
-        mc_points = width*np.random.random((n_mc_points_local,
-                                            self._domain.shape[0])) +\
-            self._domain[:, 0]
-
-        (_, emulate_ptr) = self.query(mc_points)
-
-        if normalize:
-            self.update_bounds(n_mc_points_local)
-            mc_points = mc_points - self._left
-            mc_points = mc_points/self._width
-            self._left = None
-            self._right = None
-            self._width = None
-
         rad = np.zeros((num,))
-
-        for i in range(num):
-            rad[i] = np.max(np.linalg.norm(
-                            mc_points[np.equal(emulate_ptr, i), :] -
-                            samples[i, :], ord=self._p_norm, axis=1))
-
-        crad = np.copy(rad)
-        comm.Allreduce([rad, MPI.DOUBLE], [crad, MPI.DOUBLE], op=MPI.MAX)
-        rad = crad
+        (_, _, rel_error) = self._sequential_mc(
+            n_mc_points, rel_tol, max_mc_points, min_volume, min_probability,
+            self._normalized_radii_callback(rad, normalize))
 
         if normalize:
             self._normalized_radii = rad
@@ -1580,8 +3621,11 @@ class voronoi_sample_set(sample_set_base):
             self._radii = rad
 
         self.global_to_local()
+        return rel_error
 
-    def estimate_radii_and_volume(self, n_mc_points=int(1E4), normalize=True):
+    def estimate_radii_and_volume(self, n_mc_points=int(1E4), normalize=True,
+                                  rel_tol=None, max_mc_points=int(1E7),
+                                  min_volume=0.0, min_probability=None):
         """
         Calculate the radii and volume faction of cells approximately using
         Monte Carlo integration. 
@@ -1593,60 +3637,37 @@ class voronoi_sample_set(sample_set_base):
            ``emulated_input_sample_set`` is NOT used to calculate the volume.
            This should at least be an option. 
 
+        If ``rel_tol`` is given MC points are drawn in rounds as in
+        :meth:`~bet.sample.sample_set_base.estimate_volume`.
+
         :param int n_mc_points: If estimate is True, number of MC points to use
+            (per round if ``rel_tol`` is given)
         :param bool normalize: estimate normalized radius
+        :param float rel_tol: target relative standard error of the volumes
+        :param int max_mc_points: maximum number of MC points to use
+        :param float min_volume: only cells with a larger volume fraction need
+            to reach ``rel_tol``
+        :param float min_probability: only cells with a larger probability
+            need to reach ``rel_tol``
+
+        :rtype: :class:`numpy.ndarray` of shape (num,)
+        :returns: relative standard error of the volume of each cell
 
         """
         num = self.check_num()
-        n_mc_points = int(n_mc_points)
-        samples = np.copy(self.get_values())
-        n_mc_points_local = int(n_mc_points/comm.size) + \
-            int(comm.rank < n_mc_points % comm.size)
-
-        # normalize the samples
-        if normalize:
-            self.update_bounds()
-            samples = samples - self._left
-            samples = samples/self._width
-
-        width = self._domain[:, 1] - self._domain[:, 0]
-        mc_points = width*np.random.random((n_mc_points_local,
-                                            self._domain.shape[0])) +\
-            self._domain[:, 0]
-
-        (_, emulate_ptr) = self.query(mc_points)
-
-        if normalize:
-            self.update_bounds(n_mc_points_local)
-            mc_points = mc_points - self._left
-            mc_points = mc_points/self._width
-            self._left = None
-            self._right = None
-            self._width = None
-
-        vol = np.zeros((num,))
         rad = np.zeros((num,))
-        for i in range(num):
-            vol[i] = np.sum(np.equal(emulate_ptr, i))
-            rad[i] = np.max(np.linalg.norm(
-                            mc_points[np.equal(emulate_ptr, i), :] -
-                            samples[i, :], ord=self._p_norm, axis=1))
-
-        crad = np.copy(rad)
-        comm.Allreduce([rad, MPI.DOUBLE], [crad, MPI.DOUBLE], op=MPI.MAX)
-        rad = crad
+        (counts, n_total, rel_error) = self._sequential_mc(
+            n_mc_points, rel_tol, max_mc_points, min_volume, min_probability,
+            self._normalized_radii_callback(rad, normalize))
 
         if normalize:
             self._normalized_radii = rad
         else:
             self._radii = rad
 
-        cvol = np.copy(vol)
-        comm.Allreduce([vol, MPI.DOUBLE], [cvol, MPI.DOUBLE], op=MPI.SUM)
-        vol = cvol
-        vol = vol/float(n_mc_points)
-        self._volumes = vol
+        self._volumes = counts/float(n_total)
         self.global_to_local()
+        return rel_error
 
     def estimate_local_volume(self, num_emulate_local=500,
                               max_num_emulate=int(1e4)):
@@ -1682,15 +3703,15 @@ class voronoi_sample_set(sample_set_base):
         :param int max_num_emulate: Maximum number of local emulated samples
 
         """
-        self.check_num()
+        num = self.check_num()
         # normalize the samples
-        samples = np.copy(self.get_values())
-        self.update_bounds()
-        samples = samples - self._left
-        samples = samples/self._width
+        lower = self._domain[:, 0]
+        width = self._domain[:, 1] - self._domain[:, 0]
+        samples = (self.get_values() - lower)/width
         num_emulate_local = int(num_emulate_local)
         max_num_emulate = int(max_num_emulate)
-        kdtree = spatial.KDTree(samples)
+        (build, query) = get_kdtree_backend(self._kdtree_backend)
+        kdtree = build(samples)
 
         # for each sample determine the appropriate radius of the Lp ball (this
         # should be the distance to the farthest neighboring Voronoi cell)
@@ -1705,22 +3726,17 @@ class voronoi_sample_set(sample_set_base):
             num_mc_points = np.max([1e4, samples.shape[0]*20])
             self.estimate_radii(n_mc_points=int(num_mc_points))
             sample_radii = 1.5*np.copy(self._normalized_radii)
-        if np.sum(sample_radii <= 0) > 0:
-            # Calculate the pairwise distances
-            if not np.isinf(self._p_norm):
-                pairwise_distance = spatial.distance.pdist(samples,
-                                                           p=self._p_norm)
-            else:
-                pairwise_distance = spatial.distance.pdist(samples,
-                                                           p='chebyshev')
-            pairwise_distance = spatial.distance.squareform(pairwise_distance)
-            pairwise_distance_ma = np.ma.masked_less_equal(pairwise_distance,
-                                                           0.)
-            prob_est_radii = np.std(pairwise_distance_ma*.5, 0)*2.
-            # Calculate mean, std of pairwise distances
-            # TODO this may be too large/small
-            # Estimate radius as 2.*STD of the pairwise distance
-            sample_radii[sample_radii <= 0] = prob_est_radii[sample_radii <= 0]
+        if np.sum(sample_radii <= 0) > 0 and num > 1:
+            # Estimate the radius as the distance to the farthest of the
+            # 2*dim nearest neighbors (the first neighbor is the sample)
+            missing = np.nonzero(sample_radii <= 0)[0]
+            num_neighbors = min(2*self._dim, num - 1) + 1
+            (neighbor_dist, _) = query(kdtree, samples[missing],
+                                       k=num_neighbors, p=self._p_norm,
+                                       n_jobs=self._kdtree_n_jobs)
+            neighbor_dist = np.reshape(neighbor_dist, (missing.size,
+                                                       num_neighbors))
+            sample_radii[missing] = np.max(neighbor_dist, axis=1)
 
         # determine the volume of the Lp ball
         if not np.isinf(self._p_norm):
@@ -1732,43 +3748,52 @@ class voronoi_sample_set(sample_set_base):
 
         # Set up local arrays for parallelism
         self.global_to_local()
-        lam_vol_local = np.zeros(self._local_index.shape)
-
-        # parallize
-
-        for i, iglobal in enumerate(self._local_index):
-            samples_in_cell = 0
-            total_samples = 10
-            while samples_in_cell < num_emulate_local and \
-                    total_samples < max_num_emulate:
-                total_samples = total_samples*10
-                # Sample within an Lp ball until num_emulate_local samples are
-                # present in the Voronoi cell
-                local_lambda_emulate = \
-                    lp.Lp_generalized_uniform(self._dim, total_samples,
-                                              self._p_norm,
-                                              scale=sample_radii[iglobal],
-                                              loc=samples[iglobal])
+        local_index = self._local_index
+        samples_in_cell = np.zeros(local_index.shape)
+        total_samples = 10*np.ones(local_index.shape, dtype=np.int64)
+
+        # Sample within an Lp ball until num_emulate_local samples are present
+        # in the Voronoi cell, increasing the number of samples tenfold each
+        # round. All of the cells still growing are sampled in batches.
+        active = np.arange(local_index.shape[0])
+        while active.size > 0:
+            total_samples[active] *= 10
+            total = total_samples[active[0]]
+            batch_size = max(1, default_query_chunk_size//total)
+            for start in range(0, active.size, batch_size):
+                batch = active[start:start+batch_size]
+                owner = np.repeat(batch, total)
+                lambda_emulate = lp.Lp_generalized_uniform(
+                    self._dim, owner.size, self._p_norm,
+                    scale=sample_radii[local_index[owner]][:, np.newaxis],
+                    loc=samples[local_index[owner]])
 
                 # determine the number of samples in the Voronoi cell
                 # (intersected with the input_domain)
                 if self._domain is not None:
-                    inside = np.all(np.logical_and(
-                        local_lambda_emulate >= 0.0,
-                        local_lambda_emulate <= 1.0), 1)
-                    local_lambda_emulate = local_lambda_emulate[inside]
-
-                (_, emulate_ptr) = kdtree.query(local_lambda_emulate,
-                                                p=self._p_norm,
-                                                distance_upper_bound=sample_radii[iglobal])
-
-                samples_in_cell = np.sum(np.equal(emulate_ptr, iglobal))
-
-            # the volume for the Voronoi cell corresponding to this sample is
-            # the the volume of the Lp ball times the ratio
-            # "num_samples_in_cell/num_total_local_emulated_samples"
-            lam_vol_local[i] = sample_Lp_ball_vol[iglobal] *\
-                float(samples_in_cell) / float(total_samples)
+                    inside = np.all(np.logical_and(lambda_emulate >= 0.0,
+                                                   lambda_emulate <= 1.0), 1)
+                    lambda_emulate = lambda_emulate[inside]
+                    owner = owner[inside]
+
+                (_, emulate_ptr) = query(kdtree, lambda_emulate,
+                                         p=self._p_norm,
+                                         distance_upper_bound=np.max(
+                                             sample_radii[local_index[batch]]),
+                                         n_jobs=self._kdtree_n_jobs)
+                in_cell = np.equal(emulate_ptr, local_index[owner])
+                samples_in_cell[batch] = cell_sum(
+                    owner[in_cell], local_index.shape[0],
+                    globalize=False)[batch]
+            active = active[np.logical_and(
+                samples_in_cell[active] < num_emulate_local,
+                total_samples[active] < max_num_emulate)]
+
+        # the volume for the Voronoi cell corresponding to this sample is
+        # the the volume of the Lp ball times the ratio
+        # "num_samples_in_cell/num_total_local_emulated_samples"
+        lam_vol_local = sample_Lp_ball_vol[local_index] * samples_in_cell / \
+            total_samples.astype(np.float64)
 
         self.set_volumes_local(lam_vol_local)
         self.local_to_global()
@@ -1824,6 +3849,101 @@ class sample_set(voronoi_sample_set):
     """
 
 
+def _reflect_boundary(values, domain, side_ratio):
+    """
+    Returns ``values`` followed by the reflections across each face of
+    ``domain`` of the values within ``side_ratio`` of the width of that face.
+    """
+    width = domain[:, 1] - domain[:, 0]
+    new_samp = [values]
+    for d in range(values.shape[1]):
+        add_points = np.less(values[:, d], domain[d, 0] + side_ratio*width[d])
+        points_new = values[add_points, :]
+        points_new[:, d] = 2.0*domain[d, 0] - points_new[:, d]
+        new_samp.append(points_new)
+
+        add_points = np.greater(values[:, d],
+                                domain[d, 1] - side_ratio*width[d])
+        points_new = values[add_points, :]
+        points_new[:, d] = 2.0*domain[d, 1] - points_new[:, d]
+        new_samp.append(points_new)
+    return np.vstack(new_samp)
+
+
+def _polygon_areas(vertices, regions):
+    """
+    Returns the areas of the convex polygons given by lists of indices into
+    ``vertices`` of shape (num_vertices, 2). The vertices of each polygon are
+    ordered by angle around their center and the areas are computed at once
+    with the shoelace formula.
+    """
+    if len(regions) == 0:
+        return np.zeros((0,))
+    lengths = np.array([len(region) for region in regions])
+    max_len = np.max(lengths)
+    valid = np.less(np.arange(max_len), lengths[:, np.newaxis])
+    index = np.zeros(valid.shape, dtype=np.int64)
+    index[valid] = np.concatenate(regions)
+
+    # order the vertices of each polygon by angle around its center
+    center = np.sum(vertices[index]*valid[:, :, np.newaxis], 1) / \
+        lengths[:, np.newaxis]
+    diff = vertices[index] - center[:, np.newaxis, :]
+    angle = np.where(valid, np.arctan2(diff[:, :, 1], diff[:, :, 0]), np.inf)
+    index = np.take_along_axis(index, np.argsort(angle, axis=1), axis=1)
+    # pad with the last vertex, which adds no area
+    index = np.take_along_axis(index, np.minimum(np.arange(max_len),
+                                                 lengths[:, np.newaxis]-1),
+                               axis=1)
+    x = vertices[index, 0]
+    y = vertices[index, 1]
+    return 0.5*np.abs(np.sum(x*np.roll(y, -1, axis=1) -
+                             np.roll(x, -1, axis=1)*y, axis=1))
+
+
+def _offsets(counts):
+    """
+    Returns ``0, 1, ..., counts[i]-1`` for each entry of ``counts``,
+    concatenated.
+    """
+    return np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts,
+                                                 counts)
+
+
+def _bucket(index, x):
+    """
+    Returns the bucket coordinates of points ``x`` in a regular grid index
+    ``(lower, bucket_width, n_buckets)``. Points outside of the grid are
+    assigned to the closest bucket.
+    """
+    (lower, bucket_width, n_buckets) = index
+    b = np.floor((x - lower)/bucket_width)
+    b[np.isnan(b)] = 0
+    return np.clip(b, 0, n_buckets - 1).astype(np.int64)
+
+
+def _assign_containing(pts, regions, dist, pt, remainder):
+    """
+    Fills in ``dist`` and ``pt`` of shape (num_points, k) given the pairs
+    ``(pts, regions)`` of points and the regions containing them, sorted by
+    point and then by region. Regions are assigned in increasing order for
+    each point, entries of ``pt`` not yet assigned equal ``remainder``.
+    """
+    # order of each region among the regions containing the point
+    rank = np.arange(len(pts)) - np.searchsorted(pts, pts)
+    for r in range(np.max(rank, initial=-1) + 1):
+        p = pts[np.equal(rank, r)]
+        i = regions[np.equal(rank, r)]
+        for j in range(pt.shape[1]):
+            if j == 0:
+                in_rec_now = np.equal(pt[p, j], remainder)
+            else:
+                in_rec_now = np.logical_and(np.equal(pt[p, j], remainder),
+                                            np.not_equal(pt[p, j-1], i))
+            pt[p[in_rec_now], j] = i[in_rec_now]
+            dist[p[in_rec_now], j] = 0.0
+
+
 class rectangle_sample_set(sample_set_base):
     r"""
     A data structure containing arrays specific to a set of samples defining a
@@ -1836,6 +3956,24 @@ class rectangle_sample_set(sample_set_base):
 
     """
 
+    #: List of attribute names which determine the results of :meth:`query`
+    version_names = sample_set_base.version_names + ['_right', '_left']
+    #: List of attribute names which :meth:`partition_shift` compares
+    partition_names = ['_left', '_right']
+
+    def __init__(self, dim):
+        """
+
+        Initialization
+
+        :param int dim: Dimension of the space in which these samples reside.
+
+        """
+        sample_set_base.__init__(self, dim)
+        #: Bucket index of the rectangles used by :meth:`query`, see
+        #: :meth:`set_rectangle_index`
+        self._rectangle_index = None
+
     def setup(self, maxes, mins):
         """
 
@@ -1873,6 +4011,7 @@ class rectangle_sample_set(sample_set_base):
             msg += "calculated values will be wrong."
             logging.warning(msg)
         self._region = np.arange(len(maxes) + 1)
+        self._rectangle_index = None
 
     def update_bounds(self, num=None):
         """
@@ -1953,6 +4092,120 @@ class rectangle_sample_set(sample_set_base):
         msg = "Values cannot be appended for this type of sample set."
         logging.warning(msg)
 
+    def mark_changed(self, attrname=None):
+        """
+        Draws a new version of ``attrname``, or of all the attributes in
+        :attr:`version_names`, after changing it in place, and discards the
+        index of the rectangles.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.mark_changed`
+
+        :param string attrname: name of the attribute changed in place
+        """
+        sample_set_base.mark_changed(self, attrname)
+        self._rectangle_index = None
+
+    def set_rectangle_index(self):
+        """
+        Creates a bucket index of the rectangles. The bounding box of the
+        finite rectangle edges is split into a regular grid of about
+        ``num`` buckets and each bucket stores the (sorted) indices of the
+        rectangles that overlap it, so that :meth:`query` only tests a few
+        candidate rectangles for each point.
+        """
+        num = self.check_num()
+        # only index as many dimensions as leave at least two buckets each
+        index_dim = min(self._dim, max(1, int(np.log2(max(num - 1, 1)))))
+        left = self._left[0:num-1, 0:index_dim]
+        right = self._right[0:num-1, 0:index_dim]
+
+        # bounding box of the finite edges
+        edges = np.concatenate((left, right))
+        finite = np.isfinite(edges)
+        lower = np.min(np.where(finite, edges, np.inf), axis=0,
+                       initial=np.inf)
+        upper = np.max(np.where(finite, edges, -np.inf), axis=0,
+                       initial=-np.inf)
+        n_buckets = max(1, int(np.floor((num - 1)**(1.0/index_dim))))
+        bucket_width = (upper - lower)/float(n_buckets)
+        bucket_width[np.logical_not(bucket_width > 0)] = np.inf
+        lower[np.logical_not(np.isfinite(lower))] = 0.0
+
+        # list the buckets overlapped by each rectangle
+        index = (lower, bucket_width, n_buckets)
+        b_left = _bucket(index, left)
+        b_right = _bucket(index, right)
+        rect = np.arange(num - 1)
+        lin = np.zeros((num - 1,), dtype=np.int64)
+        for d in range(index_dim):
+            counts = b_right[rect, d] - b_left[rect, d] + 1
+            lin = np.repeat(lin, counts)*n_buckets + \
+                np.repeat(b_left[rect, d], counts) + _offsets(counts)
+            rect = np.repeat(rect, counts)
+
+        # sort by bucket then rectangle and store as compressed rows
+        order = np.lexsort((rect, lin))
+        starts = np.searchsorted(lin[order], np.arange(n_buckets**index_dim
+                                                       + 1))
+        self._rectangle_index = (self._left, self._right, index, starts,
+                                 rect[order])
+
+    def _check_rectangle_index(self):
+        """
+        Creates the index of the rectangles with :meth:`set_rectangle_index`
+        unless it exists for the current rectangles.
+        """
+        if self._rectangle_index is None or \
+                self._rectangle_index[0] is not self._left or \
+                self._rectangle_index[1] is not self._right:
+            self.set_rectangle_index()
+
+    def _overlapping_pairs(self):
+        """
+        Returns the indices ``(lower, higher)`` with ``lower < higher`` of the
+        pairs of rectangles whose interiors intersect, sorted by ``higher``
+        and then by ``lower``. Intersecting rectangles share a bucket of the
+        index, so only the pairs within each bucket are tested.
+        """
+        num = self.check_num()
+        self._check_rectangle_index()
+        (_, _, _, starts, rect) = self._rectangle_index
+        # pair every entry with the later entries of its bucket
+        entry = np.arange(len(rect))
+        later = np.repeat(starts[1:], starts[1:] - starts[:-1]) - entry - 1
+        first = np.repeat(entry, later)
+        second = first + 1 + _offsets(later)
+        (lower, higher) = (rect[first], rect[second])
+        overlap = np.all(np.logical_and(
+            np.less(self._left[lower], self._right[higher]),
+            np.less(self._left[higher], self._right[lower])), axis=1)
+        pairs = np.unique(higher[overlap]*num + lower[overlap])
+        return (pairs % num, pairs // num)
+
+    def _max_candidates(self):
+        """
+        Returns the largest number of candidate rectangles for one point.
+        """
+        starts = self._rectangle_index[3]
+        return max(1, int(np.max(starts[1:] - starts[:-1])))
+
+    def _candidates(self, x):
+        """
+        Returns the pairs ``(point, rectangle)`` of points in ``x`` and the
+        rectangles that may contain them, sorted by point and then by
+        rectangle.
+        """
+        (_, _, index, starts, rect) = self._rectangle_index
+        index_dim = index[0].shape[0]
+        lin = np.ravel_multi_index(_bucket(index, x[:, 0:index_dim]).
+                                   transpose(), (index[2],)*index_dim)
+        counts = starts[lin+1] - starts[lin]
+        pts = np.repeat(np.arange(x.shape[0]), counts)
+        rects = rect[np.repeat(starts[lin], counts) + _offsets(counts)]
+        return (pts, rects)
+
     def query(self, x, k=1):
         r"""
         Identify which value points x are associated with for discretization.
@@ -1960,6 +4213,9 @@ class rectangle_sample_set(sample_set_base):
         is set to 0 if it is in the rectangle and infinity if it is not.
         It is only considered in or out.
 
+        Only the rectangles found with the index created by
+        :meth:`set_rectangle_index` are tested for each point.
+
         .. seealso::
 
             :meth:`scipy.spatial.KDTree.query`
@@ -1972,28 +4228,115 @@ class rectangle_sample_set(sample_set_base):
 
         """
         num = self.check_num()
+        self._check_rectangle_index()
         dist = np.inf * np.ones((x.shape[0], k), dtype=np.float)
-        pt = (num - 1) * np.ones((x.shape[0], k), dtype=np.int)
-        for i in range(num - 1):
-            in_r = np.all(np.less_equal(x, self._right[i, :]), axis=1)
-            in_l = np.all(np.greater(x, self._left[i, :]), axis=1)
+        pt = (num - 1) * np.ones((x.shape[0], k), dtype=ptr_dtype(num))
+
+        # find the rectangles containing each point, bounding the number of
+        # candidate pairs tested at once
+        chunk_size = max(1, int(1E7)//self._max_candidates())
+        pts = [np.zeros((0,), dtype=np.int64)]
+        rects = [np.zeros((0,), dtype=np.int64)]
+        for start in range(0, x.shape[0], chunk_size):
+            x_chunk = x[start:start+chunk_size]
+            (p, i) = self._candidates(x_chunk)
+            in_r = np.all(np.less_equal(x_chunk[p], self._right[i]), axis=1)
+            in_l = np.all(np.greater(x_chunk[p], self._left[i]), axis=1)
             in_rec = np.logical_and(in_r, in_l)
-            for j in range(k):
-                if j == 0:
-                    in_rec_now = np.logical_and(np.equal(pt[:, j], num-1),
-                                                in_rec)
-                else:
-                    in_rec_now = np.logical_and(np.logical_and(
-                        np.equal(pt[:, j], num-1), in_rec),
-                        np.not_equal(pt[:, j-1], i))
-                pt[:, j][in_rec_now] = i
-                dist[:, j][in_rec_now] = 0.0
+            pts.append(p[in_rec] + start)
+            rects.append(i[in_rec])
+        _assign_containing(np.concatenate(pts), np.concatenate(rects), dist,
+                           pt, num - 1)
         if k == 1:
             dist = dist[:, 0]
             pt = pt[:, 0]
 
         return (dist, pt)
 
+    def query_margin(self, x, chunk_size=None):
+        """
+        Identify which value points x are associated with for discretization
+        together with a margin for each point, the distance to the nearest
+        face of its rectangle in any coordinate, or to the bounding box of
+        the rectangles for points in the remainder. If rectangles of lower
+        index overlap the rectangle of a point, the margin is at most the
+        distance their faces have to move to contain the point.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.query_margin`
+
+        :param x: points for query
+        :type x: :class:`numpy.ndarray` of shape ``(*, dim)``
+        :param int chunk_size: maximum number of points per query
+
+        :rtype: tuple
+        :returns: (ptr, margin)
+        """
+        if chunk_size is None:
+            chunk_size = default_query_chunk_size
+        num = self.check_num()
+        x = util.fix_dimensions_data(x, self._dim)
+        ptr = self.query_chunked(x, chunk_size=chunk_size)
+        margin = np.zeros((len(ptr),))
+        box_left = np.min(self._left[0:num-1], axis=0, initial=np.inf)
+        box_right = np.max(self._right[0:num-1], axis=0, initial=-np.inf)
+        (lower, higher) = self._overlapping_pairs()
+        for start in range(0, len(ptr), int(chunk_size)):
+            x_chunk = x[start:start+int(chunk_size)]
+            p = ptr[start:start+int(chunk_size)]
+            inside = p < num - 1
+            # points in the bounding box but in no rectangle keep margin 0
+            gap = np.max(np.maximum(box_left - x_chunk[~inside],
+                                    x_chunk[~inside] - box_right), axis=1,
+                         initial=0.0)
+            face = np.min(np.minimum(
+                x_chunk[inside] - self._left[p[inside]],
+                self._right[p[inside]] - x_chunk[inside]), axis=1,
+                initial=np.inf)
+            # rectangles of lower index overlapping the rectangle of a point
+            # claim it as soon as their faces reach it
+            first = np.searchsorted(higher, p[inside])
+            counts = np.searchsorted(higher, p[inside], side='right') - first
+            pts = np.repeat(np.arange(len(counts)), counts)
+            rects = lower[np.repeat(first, counts) + _offsets(counts)]
+            x_pts = x_chunk[inside][pts]
+            np.minimum.at(face, pts, np.max(np.maximum(
+                self._left[rects] - x_pts, x_pts - self._right[rects]),
+                axis=1))
+            margin[start:start+int(chunk_size)][~inside] = gap
+            margin[start:start+int(chunk_size)][inside] = face
+        return (ptr, margin)
+
+    def partition_shift(self, other):
+        """
+        Returns the largest change of a coordinate of the faces of the
+        rectangles between this sample set and ``other``, or infinity if the
+        cells cannot be compared.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.partition_shift`
+
+        :param other: sample set with the previous cells
+        :type other: :class:`~bet.sample.sample_set_base`
+
+        :rtype: float
+        :returns: shift
+        """
+        if not self._comparable(other):
+            return np.inf
+        shift = 0.0
+        for (new, old) in [(self._left, other._left),
+                           (self._right, other._right)]:
+            moved = new != old
+            if not np.all(np.isfinite(new[moved])) or \
+                    not np.all(np.isfinite(old[moved])):
+                return np.inf
+            shift = max(shift, float(np.max(np.abs(new[moved] - old[moved]),
+                                            initial=0.0)))
+        return shift
+
     def exact_volume_lebesgue(self):
         r"""
 
@@ -2020,6 +4363,22 @@ class ball_sample_set(sample_set_base):
 
     """
 
+    #: List of attribute names which determine the results of :meth:`query`
+    version_names = sample_set_base.version_names + ['_radii']
+
+    def __init__(self, dim):
+        """
+
+        Initialization
+
+        :param int dim: Dimension of the space in which these samples reside.
+
+        """
+        sample_set_base.__init__(self, dim)
+        #: Nearest neighbor search tree of the ball centers used by
+        #: :meth:`query`, see :meth:`set_ball_index`
+        self._ball_index = None
+
     def setup(self, centers, radii):
         """
         Initialize.
@@ -2048,6 +4407,7 @@ class ball_sample_set(sample_set_base):
             msg += "calculated values will be wrong."
             logging.warning(msg)
         self._region = np.arange(len(centers) + 1)
+        self._ball_index = None
 
     def append_values(self, values):
         """
@@ -2128,6 +4488,77 @@ class ball_sample_set(sample_set_base):
             "Bounds cannot be updated for this type of sample set.")
         pass
 
+    def mark_changed(self, attrname=None):
+        """
+        Draws a new version of ``attrname``, or of all the attributes in
+        :attr:`version_names`, after changing it in place, and discards the
+        index of the balls.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.mark_changed`
+
+        :param string attrname: name of the attribute changed in place
+        """
+        sample_set_base.mark_changed(self, attrname)
+        self._ball_index = None
+
+    def set_ball_index(self):
+        """
+        Creates a nearest neighbor search tree of the ball centers with the
+        backend chosen with
+        :meth:`~bet.sample.sample_set_base.set_kdtree_backend`. The largest
+        radius bounds the distance of the candidate balls for a point.
+        """
+        num = self.check_num()
+        tree = None
+        if num > 1 and self._p_norm >= 1:
+            (build, _) = get_kdtree_backend(self._kdtree_backend)
+            tree = build(self._values[0:num-1])
+        max_radius = np.max(self._radii[0:num-1], initial=0.0)
+        self._ball_index = (self._values, self._radii, self._p_norm,
+                            self._kdtree_backend, tree, max_radius)
+
+    def _candidates(self, x):
+        """
+        Returns the pairs ``(point, ball)`` of points in ``x`` and the balls
+        that may contain them, sorted by point and then by ball.
+        """
+        num_balls = self._values.shape[0] - 1
+        (_, _, _, backend, tree, max_radius) = self._ball_index
+        if tree is None:
+            # no usable tree so every ball is a candidate
+            pts = np.repeat(np.arange(x.shape[0]), num_balls)
+            return (pts, np.tile(np.arange(num_balls), x.shape[0]))
+        (_, query) = get_kdtree_backend(backend)
+        # pad the bound so round-off in the tree never drops a ball
+        bound = max_radius*(1.0 + 1E-8) + np.finfo(float).tiny
+
+        # query more neighbors for the points whose nearest neighbors are
+        # all within the bound
+        pts = [np.zeros((0,), dtype=np.int64)]
+        balls = [np.zeros((0,), dtype=np.int64)]
+        todo = np.arange(x.shape[0])
+        k = min(8, num_balls)
+        while todo.size > 0:
+            (_, ptr) = query(tree, x[todo], k=k, p=self._p_norm,
+                             distance_upper_bound=bound,
+                             n_jobs=self._kdtree_n_jobs)
+            ptr = np.reshape(ptr, (todo.size, k))
+            full = np.less(ptr[:, -1], num_balls)
+            if k == num_balls:
+                full[:] = False
+            done = np.logical_not(full)
+            found = np.less(ptr[done], num_balls)
+            pts.append(np.repeat(todo[done], k)[found.flat[:]])
+            balls.append(ptr[done][found])
+            todo = todo[full]
+            k = min(2*k, num_balls)
+        pts = np.concatenate(pts)
+        balls = np.concatenate(balls)
+        order = np.lexsort((balls, pts))
+        return (pts[order], balls[order])
+
     def query(self, x, k=1):
         """
         Identify which value points x are associated with for discretization.
@@ -2135,6 +4566,9 @@ class ball_sample_set(sample_set_base):
         if it is not.
         It is only considered in or out.
 
+        Only the balls whose centers are found within the largest radius with
+        the tree created by :meth:`set_ball_index` are tested for each point.
+
         .. seealso::
 
             :meth:`scipy.spatial.KDTree.query`
@@ -2146,21 +4580,35 @@ class ball_sample_set(sample_set_base):
         :returns: (dist, ptr)
         """
         num = self.check_num()
+        if self._ball_index is None or \
+                self._ball_index[0] is not self._values or \
+                self._ball_index[1] is not self._radii or \
+                self._ball_index[2] != self._p_norm or \
+                self._ball_index[3] != self._kdtree_backend:
+            self.set_ball_index()
         dist = np.inf * np.ones((x.shape[0], k), dtype=np.float)
-        pt = (num - 1) * np.ones((x.shape[0], k), dtype=np.int)
-        for i in range(num - 1):
-            in_rec = np.less(linalg.norm(x-self._values[i, :], self._p_norm,
-                                         axis=1), self._radii[i])
-            for j in range(k):
-                if j == 0:
-                    in_rec_now = np.logical_and(np.equal(pt[:, j], num-1),
-                                                in_rec)
-                else:
-                    in_rec_now = np.logical_and(np.logical_and(
-                        np.equal(pt[:, j], num-1), in_rec),
-                        np.not_equal(pt[:, j-1], i))
-                pt[:, j][in_rec_now] = i
-                dist[:, j][in_rec_now] = 0.0
+        pt = (num - 1) * np.ones((x.shape[0], k), dtype=ptr_dtype(num))
+
+        # find the balls containing each point, bounding the number of
+        # candidate pairs tested at once
+        if self._ball_index[4] is None:
+            chunk_size = max(1, int(1E7)//max(1, num - 1))
+        else:
+            chunk_size = int(1E6)
+        pts = [np.zeros((0,), dtype=np.int64)]
+        balls = [np.zeros((0,), dtype=np.int64)]
+        for start in range(0, x.shape[0], chunk_size):
+            x_chunk = x[start:start+chunk_size]
+            (p, i) = self._candidates(x_chunk)
+            if p.size == 0:
+                continue
+            in_ball = np.less(linalg.norm(x_chunk[p] - self._values[i],
+                                          self._p_norm, axis=1),
+                              self._radii[i])
+            pts.append(p[in_ball] + start)
+            balls.append(i[in_ball])
+        _assign_containing(np.concatenate(pts), np.concatenate(balls), dist,
+                           pt, num - 1)
         if k == 1:
             dist = dist[:, 0]
             pt = pt[:, 0]
@@ -2227,6 +4675,74 @@ class cartesian_sample_set(rectangle_sample_set):
 
         rectangle_sample_set.setup(self, maxes, mins)
 
+    def set_rectangle_index(self):
+        """
+        Creates an index of the grid so that :meth:`query` finds the
+        rectangle containing a point with :meth:`numpy.searchsorted` in each
+        dimension. If the rectangles do not form a full Cartesian grid the
+        bucket index of :class:`~bet.sample.rectangle_sample_set` is used.
+        """
+        num = self.check_num()
+        left = self._left[0:num-1]
+        right = self._right[0:num-1]
+        grid = [np.unique(np.concatenate((left[:, d], right[:, d]))) for d
+                in range(self._dim)]
+        shape = tuple([len(xv) - 1 for xv in grid])
+        b_left = np.array([np.searchsorted(grid[d], left[:, d]) for d in
+                           range(self._dim)], dtype=np.int64)
+        is_grid = int(np.prod(shape)) == num - 1 and \
+            np.all(np.isfinite(left)) and np.all(np.isfinite(right)) and \
+            np.all(b_left < np.array(shape)[:, np.newaxis])
+        if is_grid:
+            is_grid = np.all([np.array_equal(grid[d][b_left[d]+1],
+                                             right[:, d]) for d in
+                              range(self._dim)])
+        if is_grid:
+            cells = -np.ones((num - 1,), dtype=np.int64)
+            cells[np.ravel_multi_index(b_left, shape)] = np.arange(num - 1)
+            is_grid = np.all(cells >= 0)
+        if not is_grid:
+            rectangle_sample_set.set_rectangle_index(self)
+        else:
+            self._rectangle_index = (self._left, self._right, None, grid,
+                                     cells.reshape(shape))
+
+    def _overlapping_pairs(self):
+        """
+        Returns the indices ``(lower, higher)`` of the pairs of rectangles
+        whose interiors intersect, which are none for a full Cartesian grid.
+        """
+        self._check_rectangle_index()
+        if self._rectangle_index[2] is not None:
+            return rectangle_sample_set._overlapping_pairs(self)
+        return (np.zeros((0,), dtype=np.int64), np.zeros((0,),
+                                                          dtype=np.int64))
+
+    def _max_candidates(self):
+        """
+        Returns the largest number of candidate rectangles for one point.
+        """
+        if self._rectangle_index[2] is not None:
+            return rectangle_sample_set._max_candidates(self)
+        return 1
+
+    def _candidates(self, x):
+        """
+        Returns the pairs ``(point, rectangle)`` of points in ``x`` and the
+        rectangles that may contain them, sorted by point and then by
+        rectangle.
+        """
+        if self._rectangle_index[2] is not None:
+            return rectangle_sample_set._candidates(self, x)
+        (_, _, _, grid, cells) = self._rectangle_index
+        # x is in the rectangle (grid[d][b], grid[d][b+1]] in dimension d
+        b = np.array([np.searchsorted(grid[d], x[:, d]) - 1 for d in
+                      range(self._dim)], dtype=np.int64)
+        inside = np.all(np.logical_and(
+            b >= 0, b < np.array(cells.shape)[:, np.newaxis]), axis=0)
+        pts = np.nonzero(inside)[0]
+        return (pts, cells[tuple(b[:, inside])])
+
 
 class discretization(object):
     """
@@ -2272,6 +4788,17 @@ class discretization(object):
         self._emulated_ii_ptr_local = None
         #: local emulated oo ptr for parallelism
         self._emulated_oo_ptr_local = None
+        #: Margins of the local output samples from the last incremental
+        #: query, see :meth:`set_io_ptr`
+        self._io_margin_local = None
+        #: Copies of the cells of the output probability set and version of
+        #: the local output samples the margins refer to
+        self._io_margin_state = None
+        #: Copies of the local io pointer, sums of the volumes over each
+        #: output cell, output probabilities, local volumes and local
+        #: probabilities of the last incremental call of
+        #: :meth:`bet.calculateP.calculateP.prob`
+        self._prob_state = None
 
         if output_sample_set is not None:
             self.check_nums()
@@ -2313,24 +4840,81 @@ class discretization(object):
             self._emulated_oo_ptr = util.get_global_values(
                 self._emulated_oo_ptr_local)
 
-    def set_io_ptr(self, globalize=True):
+    def set_io_ptr(self, globalize=True, chunk_size=None, incremental=False,
+                   use_cache=False):
         """
 
         Creates the pointer from ``self._output_sample_set`` to
         ``self._output_probability_set``
 
+        With ``incremental`` the margins of the output samples are kept, see
+        :meth:`bet.sample.sample_set_base.query_margin`. When the output
+        probability set is then replaced by one whose cells moved by at most
+        a shift, see :meth:`bet.sample.sample_set_base.partition_shift`,
+        only the output samples whose margin is not larger than the shift
+        are queried again. Output values changed in place must be marked with
+        :meth:`bet.sample.sample_set_base.mark_changed` in between.
+
+        .. seealso::
+
+            :meth:`bet.sample.sample_set_base.query_sample_set`
+
         :param bool globalize: flag whether or not to globalize
             ``self._output_sample_set``
+        :param int chunk_size: maximum number of points per query
+        :param bool incremental: flag whether or not to only query the output
+            samples which may have changed cells since the last incremental
+            query
+        :param bool use_cache: flag whether or not to reuse cached pointers,
+            see :meth:`bet.sample.sample_set_base.query_sample_set`
 
         """
-        if self._output_sample_set._values_local is None:
-            self._output_sample_set.global_to_local()
-        (_, self._io_ptr_local) = self._output_probability_set.query(
-            self._output_sample_set._values_local)
+        if incremental:
+            self._update_io_ptr(chunk_size)
+        else:
+            self._io_ptr_local = self._output_probability_set.\
+                query_sample_set(self._output_sample_set,
+                                 chunk_size=chunk_size, use_cache=use_cache)
+            self._io_margin_local = None
+            self._io_margin_state = None
 
         if globalize:
             self._io_ptr = util.get_global_values(self._io_ptr_local)
 
+    def _update_io_ptr(self, chunk_size=None):
+        """
+        Queries the local output samples which may have changed cells since
+        the last incremental query, or all of them, and keeps their margins.
+        """
+        out_set = self._output_sample_set
+        prob_set = self._output_probability_set
+        if out_set._values_local is None:
+            out_set.global_to_local()
+        values_local = out_set._values_local
+        version = out_set.get_version_local()
+
+        shift = np.inf
+        if self._io_margin_state is not None:
+            (old_set, old_version) = self._io_margin_state
+            shift = prob_set.partition_shift(old_set)
+            if old_version != version or self._io_ptr_local is None or \
+                    len(self._io_ptr_local) != values_local.shape[0]:
+                shift = np.inf
+        if np.isinf(shift):
+            (ptr, margin) = prob_set.query_margin(values_local, chunk_size)
+        else:
+            ptr = np.array(self._io_ptr_local,
+                           dtype=ptr_dtype(prob_set.check_num()))
+            # the boundaries may have moved towards the other samples
+            margin = self._io_margin_local - shift
+            requery = np.flatnonzero(np.logical_not(margin > 0.0))
+            (ptr[requery], margin[requery]) = prob_set.query_margin(
+                values_local[requery], chunk_size)
+        ptr.flags.writeable = False
+        self._io_ptr_local = ptr
+        self._io_margin_local = margin
+        self._io_margin_state = (prob_set._partition_snapshot(), version)
+
     def get_io_ptr(self):
         """
 
@@ -2348,7 +4932,8 @@ class discretization(object):
         """
         return self._io_ptr
 
-    def set_emulated_ii_ptr(self, globalize=True):
+    def set_emulated_ii_ptr(self, globalize=True, chunk_size=None,
+                            use_cache=False):
         """
 
         Creates the pointer from ``self._emulated_input_sample_set`` to
@@ -2356,17 +4941,18 @@ class discretization(object):
 
         .. seealso::
 
-            :meth:`scipy.spatial.KDTree.query``
+            :meth:`bet.sample.sample_set_base.query_sample_set`
 
         :param bool globalize: flag whether or not to globalize
             ``self._output_sample_set``
-        :param int p: Which Minkowski p-norm to use. (1 <= p <= infinity)
+        :param int chunk_size: maximum number of points per query
+        :param bool use_cache: flag whether or not to reuse cached pointers,
+            see :meth:`bet.sample.sample_set_base.query_sample_set`
 
         """
-        if self._emulated_input_sample_set._values_local is None:
-            self._emulated_input_sample_set.global_to_local()
-        (_, self._emulated_ii_ptr_local) = self._input_sample_set.query(
-            self._emulated_input_sample_set._values_local)
+        self._emulated_ii_ptr_local = self._input_sample_set.query_sample_set(
+            self._emulated_input_sample_set, chunk_size=chunk_size,
+            use_cache=use_cache)
         if globalize:
             self._emulated_ii_ptr = util.get_global_values(
                 self._emulated_ii_ptr_local)
@@ -2388,7 +4974,8 @@ class discretization(object):
         """
         return self._emulated_ii_ptr
 
-    def set_emulated_oo_ptr(self, globalize=True):
+    def set_emulated_oo_ptr(self, globalize=True, chunk_size=None,
+                            use_cache=False):
         """
 
         Creates the pointer from ``self._emulated_output_sample_set`` to
@@ -2396,17 +4983,19 @@ class discretization(object):
 
         .. seealso::
 
-            :meth:`scipy.spatial.KDTree.query``
+            :meth:`bet.sample.sample_set_base.query_sample_set`
 
         :param bool globalize: flag whether or not to globalize
             ``self._output_sample_set``
-        :param int p: Which Minkowski p-norm to use. (1 <= p <= infinity)
+        :param int chunk_size: maximum number of points per query
+        :param bool use_cache: flag whether or not to reuse cached pointers,
+            see :meth:`bet.sample.sample_set_base.query_sample_set`
 
         """
-        if self._emulated_output_sample_set._values_local is None:
-            self._emulated_output_sample_set.global_to_local()
-        (_, self._emulated_oo_ptr_local) = self._output_probability_set.query(
-            self._emulated_output_sample_set._values_local)
+        self._emulated_oo_ptr_local = \
+            self._output_probability_set.query_sample_set(
+                self._emulated_output_sample_set, chunk_size=chunk_size,
+                use_cache=use_cache)
 
         if globalize:
             self._emulated_oo_ptr = util.get_global_values(
@@ -2431,26 +5020,48 @@ class discretization(object):
 
     def copy(self):
         """
-        Makes a copy using :meth:`numpy.copy`.
+        Makes a copy using :meth:`numpy.copy`, see
+        :meth:`bet.sample.sample_set_base.copy`.
 
         :rtype: :class:`~bet.sample.discretization`
         :returns: Copy of this :class:`~bet.sample.discretization`
 
         """
-        my_copy = discretization(self._input_sample_set.copy(),
-                                 self._output_sample_set.copy())
+        return self._copy('copy', np.copy)
+
+    def shallow_copy(self):
+        """
+        Makes a copy that shares the arrays of this discretization, see
+        :meth:`bet.sample.sample_set_base.shallow_copy`.
+
+        :rtype: :class:`~bet.sample.discretization`
+        :returns: Shallow copy of this :class:`~bet.sample.discretization`
+
+        """
+        return self._copy('shallow_copy', _shared_view)
+
+    def _copy(self, copy_set, copy_array):
+        """
+        Makes a copy whose sample sets are copied with their method named
+        ``copy_set`` and whose pointers are ``copy_array`` of the pointers of
+        this discretization, see :meth:`copy` and :meth:`shallow_copy`.
+        """
+        my_copy = discretization(
+            getattr(self._input_sample_set, copy_set)(),
+            getattr(self._output_sample_set, copy_set)())
 
         for attrname in discretization.sample_set_names:
-            if attrname is not '_input_sample_set' and \
-                    attrname is not '_output_sample_set':
+            if attrname != '_input_sample_set' and \
+                    attrname != '_output_sample_set':
                 curr_sample_set = getattr(self, attrname)
                 if curr_sample_set is not None:
-                    setattr(my_copy, attrname, curr_sample_set.copy())
+                    setattr(my_copy, attrname,
+                            getattr(curr_sample_set, copy_set)())
 
         for array_name in discretization.vector_names:
             current_array = getattr(self, array_name)
             if current_array is not None:
-                setattr(my_copy, array_name, np.copy(current_array))
+                setattr(my_copy, array_name, copy_array(current_array))
         return my_copy
 
     def get_input_sample_set(self):
@@ -13,6 +13,7 @@ We employ an approach based on using multiple sample chains.
 import math
 import os
 import glob
+import re
 import logging
 import numpy as np
 import scipy.io as sio
@@ -58,8 +59,12 @@ def loadmat(save_file, lb_model=None, hot_start=None, num_chains=None):
         base_name = os.path.basename(save_file)
         mdat_files = glob.glob(os.path.join(save_dir,
                                             "proc*_{}".format(base_name)))
+        # order by processor so that chains are in their global order
+        mdat_files.sort(key=lambda f: int(re.match(
+            r"proc(\d+)_", os.path.basename(f)).group(1)))
         if len(mdat_files) > 0:
-            tmp_mdat = sio.loadmat(mdat_files[0])
+            tmp_mdat = sio.loadmat(mdat_files[0], variable_names=[
+                'num_chains', 'kern_old', 'step_ratios'])
         else:
             tmp_mdat = sio.loadmat(save_file)
         if num_chains is None:
@@ -100,49 +105,54 @@ def loadmat(save_file, lb_model=None, hot_start=None, num_chains=None):
             all_step_ratios = np.squeeze(tmp_mdat['step_ratios'])
         elif hot_start == 1 and len(mdat_files) != comm.size:
             logging.info("HOT START using parallel files (diff nproc)")
-            # Determine how many processors the previous data used
-            # otherwise gather the data from mdat and then scatter
-            # among the processors and update mdat
-            mdat_files_local = comm.scatter(mdat_files)
-            mdat_local = [sio.loadmat(m) for m in mdat_files_local]
-            disc_local = [sample.load_discretization(m) for m in
-                          mdat_files_local]
-            mdat_list = comm.allgather(mdat_local)
-            disc_list = comm.allgather(disc_local)
-            mdat_global = []
-            disc_global = []
-            # instead of a list of lists, create a list of mdat
-            for mlist, dlist in zip(mdat_list, disc_list):
-                mdat_global.extend(mlist)
-                disc_global.extend(dlist)
-            # get num_proc and num_chains_pproc for previous run
-            old_num_proc = max((len(mdat_list), 1))
-            old_num_chains_pproc = num_chains // old_num_proc
-            # get batch size and/or number of dimensions
-            chain_length = disc_global[0].check_nums() // \
-                old_num_chains_pproc
-            disc = disc_global[0].copy()
-            # create lists of local data
+            # Read only the rows of the chains this processor continues from
+            # the files holding them
+            num_chains_pproc = num_chains // comm.size
+            old_num_chains_pproc = num_chains // len(mdat_files)
+            input_key = 'default_input_sample_set_values_local'
+            output_key = 'default_output_sample_set_values_local'
+            chain_length = sample.saved_shapes(mdat_files[0])[input_key][0] \
+                // old_num_chains_pproc
+            # the sample sets are set up from the attributes of the first
+            # file which are not rows, the rows are read below
+            input_sample_set = sample.load_sample_set_attributes(
+                mdat_files[0], 'default_input_sample_set')
+            output_sample_set = sample.load_sample_set_attributes(
+                mdat_files[0], 'default_output_sample_set')
+            chains = np.arange(comm.rank*num_chains_pproc,
+                               (comm.rank+1)*num_chains_pproc)
             temp_input = []
             temp_output = []
             all_step_ratios = []
             kern_old = []
-            # RESHAPE old_num_chains_pproc, chain_length(or batch), dim
-            for mdat, disc_local in zip(mdat_global, disc_local):
-                temp_input.append(np.reshape(disc_local.
-                                             _input_sample_set.get_values_local(),
-                                             (old_num_chains_pproc, chain_length, -1), 'F'))
-                temp_output.append(np.reshape(disc_local.
-                                              _output_sample_set.get_values_local(),
-                                              (old_num_chains_pproc, chain_length, -1), 'F'))
-                all_step_ratios.append(np.reshape(mdat['step_ratios'],
-                                                  (old_num_chains_pproc, chain_length, -1), 'F'))
-                kern_old.append(np.reshape(mdat['kern_old'],
-                                           (old_num_chains_pproc,), 'F'))
+            for (proc, mdat_file) in enumerate(mdat_files):
+                old_chains = chains[chains // old_num_chains_pproc == proc] \
+                    % old_num_chains_pproc
+                if len(old_chains) == 0:
+                    continue
+                # rows are ordered by step and then by chain
+                rows = (np.arange(chain_length)[:, np.newaxis] *
+                        old_num_chains_pproc + old_chains).ravel()
+                temp_input.append(np.reshape(sample.load_rows(
+                    mdat_file, input_key, rows), (chain_length,
+                                                  len(old_chains), -1)))
+                temp_output.append(np.reshape(sample.load_rows(
+                    mdat_file, output_key, rows), (chain_length,
+                                                   len(old_chains), -1)))
+                all_step_ratios.append(np.reshape(sample.load_rows(
+                    mdat_file, 'step_ratios', rows, True),
+                    (chain_length, len(old_chains))))
+                kern_old.append(sample.load_rows(mdat_file, 'kern_old',
+                                                 old_chains, True))
             # turn into arrays
-            temp_input = np.concatenate(temp_input)
-            temp_output = np.concatenate(temp_output)
-            all_step_ratios = np.concatenate(all_step_ratios)
+            input_sample_set.set_values_local(np.reshape(
+                np.concatenate(temp_input, 1),
+                (num_chains_pproc*chain_length, -1)))
+            output_sample_set.set_values_local(np.reshape(
+                np.concatenate(temp_output, 1),
+                (num_chains_pproc*chain_length, -1)))
+            disc = sample.discretization(input_sample_set, output_sample_set)
+            all_step_ratios = np.concatenate(all_step_ratios, 1).ravel()
             kern_old = np.concatenate(kern_old)
     if hot_start == 2:  # HOT START FROM COMPLETED RUN:
         if comm.rank == 0:
@@ -166,8 +176,7 @@ def loadmat(save_file, lb_model=None, hot_start=None, num_chains=None):
             all_step_ratios = np.reshape(all_step_ratios,
                                          (num_chains, chain_length), 'F')
     # SPLIT DATA IF NECESSARY
-    if comm.size > 1 and (hot_start == 2 or (hot_start == 1 and
-                                             len(mdat_files) != comm.size)):
+    if comm.size > 1 and hot_start == 2:
         # Use split to split along num_chains and set *._values_local
         disc._input_sample_set.set_values_local(np.reshape(np.split(
             temp_input, comm.size, 0)[comm.rank],
@@ -371,7 +380,7 @@ class sampler(bsam.sampler):
 
     def generalized_chains(self, input_obj, t_set, kern,
                            savefile, initial_sample_type="random", criterion='center',
-                           hot_start=0):
+                           hot_start=0, file_format=None):
         """
         Basic adaptive sampling algorithm using generalized chains.
 
@@ -401,6 +410,9 @@ class sampler(bsam.sampler):
             start from finished run
         :param string criterion: latin hypercube criterion see 
             `PyDOE <http://pythonhosted.org/pyDOE/randomized.html>`_
+        :param string file_format: format of the saved discretization,
+            ``'chunked'`` only writes the new batch at each save, defaults to
+            :data:`bet.sample.default_file_format`
 
         :rtype: tuple
         :returns: (``discretization``, ``all_step_ratios``) where
@@ -493,7 +505,8 @@ class sampler(bsam.sampler):
             mdat['step_ratios'] = all_step_ratios
             mdat['kern_old'] = kern_old
 
-            super(sampler, self).save(mdat, savefile, disc, globalize=False)
+            super(sampler, self).save(mdat, savefile, disc, globalize=False,
+                                      file_format=file_format)
             input_old = input_new
 
         # collect everything
@@ -513,7 +526,8 @@ class sampler(bsam.sampler):
         mdat['step_ratios'] = all_step_ratios
         mdat['kern_old'] = util.get_global_values(kern_old,
                                                   shape=(self.num_chains,))
-        super(sampler, self).save(mdat, savefile, disc, globalize=True)
+        super(sampler, self).save(mdat, savefile, disc, globalize=True,
+                                  file_format=file_format)
 
         return (disc, all_step_ratios)
 
@@ -590,13 +604,10 @@ class transition_set(object):
         # calculate maximum proposed step
         my_right = input_old.get_values_local() + 0.5*step_size
         my_left = input_old.get_values_local() - 0.5*step_size
-        # Is the new sample greaters than the right limit?
-        far_right = my_right >= input_old._right_local
-        far_left = my_left <= input_old._left_local
         # If the input could leave the domain then truncate the box defining
         # the step_size
-        my_right[far_right] = input_old._right_local[far_right]
-        my_left[far_left] = input_old._left_local[far_left]
+        np.minimum(my_right, input_old._right_local, out=my_right)
+        np.maximum(my_left, input_old._left_local, out=my_left)
         my_width = my_right-my_left
         #input_center = (input_right+input_left)/2.0
         input_new_values = my_width * np.random.random(input_old.shape_local())
@@ -115,10 +115,9 @@ def random_sample_set(sample_type, input_obj, num_samples,
     if sample_type == "lhs":
         # update the bounds based on the number of samples
         input_sample_set.update_bounds(num_samples)
-        input_values = np.copy(input_sample_set._width)
-        input_values = input_values * lhs(dim,
-                                          num_samples, criterion)
-        input_values = input_values + input_sample_set._left
+        input_values = lhs(dim, num_samples, criterion)
+        input_values *= input_sample_set._width
+        input_values += input_sample_set._left
         input_sample_set.set_values_local(np.array_split(input_values,
                                                          comm.size)[comm.rank])
     elif sample_type == "random" or "r":
@@ -127,10 +126,9 @@ def random_sample_set(sample_type, input_obj, num_samples,
                                 (comm.rank < num_samples % comm.size))
         # update the bounds based on the number of samples
         input_sample_set.update_bounds_local(num_samples_local)
-        input_values_local = np.copy(input_sample_set._width_local)
-        input_values_local = input_values_local * \
-            np.random.random(input_values_local.shape)
-        input_values_local = input_values_local + input_sample_set._left_local
+        input_values_local = np.random.random((num_samples_local, dim))
+        input_values_local *= input_sample_set._width_local
+        input_values_local += input_sample_set._left_local
 
         input_sample_set.set_values_local(input_values_local)
 
@@ -254,7 +252,8 @@ class sampler(object):
         self.error_estimates = error_estimates
         self.jacobians = jacobians
 
-    def save(self, mdict, save_file, discretization=None, globalize=False):
+    def save(self, mdict, save_file, discretization=None, globalize=False,
+             file_format=None):
         """
         Save matrices to a ``*.mat`` file for use by ``MATLAB BET`` code and
         :meth:`~bet.basicSampling.loadmat`
@@ -264,6 +263,9 @@ class sampler(object):
         :param discretization: input and output from sampling
         :type discretization: :class:`bet.sample.discretization`
         :param bool globalize: Makes local variables global. 
+        :param string file_format: format of the saved discretization,
+            ``'mat'`` or ``'chunked'``, defaults to
+            :data:`bet.sample.default_file_format`
 
         """
 
@@ -279,7 +281,8 @@ class sampler(object):
 
         if discretization is not None:
             sample.save_discretization(discretization, save_file,
-                                       globalize=globalize)
+                                       globalize=globalize,
+                                       file_format=file_format)
 
     def update_mdict(self, mdict):
         """
@@ -56,10 +56,9 @@ def sample_lp_ball(input_set, num_close, radius, p_num=2):
                                                        num_close*inflate, p_num, radius, centers[i, :])
             # check bounds
             if input_domain is not None:
-                cluster_set.update_bounds(num_close*inflate)
-                left = np.all(np.greater_equal(new_cluster, cluster_set._left),
-                              axis=1)
-                right = np.all(np.less_equal(new_cluster, cluster_set._right),
+                left = np.all(np.greater_equal(new_cluster,
+                                               input_domain[:, 0]), axis=1)
+                right = np.all(np.less_equal(new_cluster, input_domain[:, 1]),
                                axis=1)
                 inside = np.logical_and(left, right)
                 in_bounds = np.sum(inside)
@@ -73,10 +72,6 @@ def sample_lp_ball(input_set, num_close, radius, p_num=2):
             new_cluster = new_cluster[:num_close, :]
         cluster_set.append_values(new_cluster)
 
-    # reset bounds
-    cluster_set._left = None
-    cluster_set._right = None
-    cluster_set._width = None
     return cluster_set
 
 
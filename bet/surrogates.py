@@ -75,39 +75,41 @@ class piecewise_polynomial_surrogate(object):
         # Assumes Voronoi sample set for now
         output_sample_set = sample.sample_set(self.input_disc.
                                               _output_sample_set._dim)
-        self.dummy_disc = self.input_disc.copy()
+        self.dummy_disc = self.input_disc.shallow_copy()
         self.dummy_disc.set_emulated_input_sample_set(input_sample_set)
         self.dummy_disc.set_emulated_ii_ptr(globalize=False)
 
+        ptr_local = self.dummy_disc._emulated_ii_ptr_local
+        input_set = self.input_disc._input_sample_set
+        output_set = self.input_disc._output_sample_set
         if order == 0:
             # define new values based on piecewise constants
-            new_values_local = self.input_disc._output_sample_set.\
-                _values[self.dummy_disc._emulated_ii_ptr_local]
+            new_values_local = output_set.get_global_rows('_values',
+                                                          ptr_local)
             output_sample_set.set_values_local(new_values_local)
         elif order == 1:
             # define new values based on piecewise linears using Jacobians
-            if self.input_disc._input_sample_set._jacobians is None:
-                if self.input_disc._input_sample_set._jacobians_local is None:
+            if input_set._jacobians is None:
+                if input_set._jacobians_local is None:
                     msg = "The input discretization must"
                     msg += " have jacobians defined."
                     raise calculateError.wrong_argument_type(msg)
                 else:
-                    self.input_disc._input_sample_set.local_to_global()
+                    input_set.local_to_global()
 
-            jac_local = self.input_disc._input_sample_set._jacobians[
-                self.dummy_disc._emulated_ii_ptr_local]
-            diff_local = self.input_disc._input_sample_set._values[
-                self.dummy_disc._emulated_ii_ptr_local] - \
+            jac_local = input_set.get_global_rows('_jacobians', ptr_local)
+            diff_local = input_set.get_global_rows('_values', ptr_local) - \
                 input_sample_set._values_local
-            new_values_local = self.input_disc._output_sample_set._values[
-                self.dummy_disc._emulated_ii_ptr_local]
+            new_values_local = output_set.get_global_rows('_values',
+                                                          ptr_local)
             new_values_local += np.einsum('ijk,ik->ij', jac_local, diff_local)
             output_sample_set.set_values_local(new_values_local)
 
         # if they exist, define error estimates with piecewise constants
-        if self.input_disc._output_sample_set._error_estimates is not None:
-            new_ee = self.input_disc._output_sample_set._error_estimates[
-                self.dummy_disc._emulated_ii_ptr_local]
+        if output_set._error_estimates is not None or \
+                output_set._error_estimates_local is not None:
+            new_ee = output_set.get_global_rows('_error_estimates',
+                                                ptr_local)
             output_sample_set.set_error_estimates_local(new_ee)
         # create discretization object for the surrogate
         self.surrogate_discretization = sample.discretization(input_sample_set=input_sample_set, output_sample_set=output_sample_set,
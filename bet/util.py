@@ -62,40 +62,140 @@ def meshgrid_ndim(X):
     return X_new
 
 
+def _rows_buffer(array):
+    """
+    Returns ``array`` with at least one dimension, and for numeric types as
+    a contiguous array in native byte order which can be sent as a typed
+    buffer.
+    """
+    array = np.asarray(array)
+    if array.ndim == 0:
+        array = np.reshape(array, (1,))
+    if array.dtype.kind in 'biufc':
+        if not array.dtype.isnative:
+            array = array.astype(array.dtype.newbyteorder('='))
+        array = np.ascontiguousarray(array)
+    return array
+
+
+def _counts_displs(nums, row_size):
+    """
+    Returns the counts and displacements of blocks of ``nums`` rows of
+    ``row_size`` entries laid out one after another.
+    """
+    counts = np.asarray(nums, dtype=np.int64)*row_size
+    displs = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return (counts, displs)
+
+
 def get_global_values(array, shape=None):
     """
-    Concatenates local arrays into global array using :meth:`np.vstack`.
+    Concatenates local arrays into global array along the first axis.
+
+    Arrays of numeric type are gathered with a typed ``Allgatherv`` straight
+    into a preallocated array, after exchanging the number of rows on each
+    processor, so arrays of any shape such as Jacobians are sent without
+    pickling. Arrays of other types are pickled with ``allgather``.
 
     :param array: Array.
     :type P_samples: :class:`~numpy.ndarray`
+    :param tuple shape: shape of the global array, only used to reshape it
     :rtype: :class:`~numpy.ndarray`
     :returns: array
     """
     if comm.size == 1:
         return array
+    array = _rows_buffer(array)
+    if array.dtype.kind not in 'biufc':
+        # do a lowercase allgather
+        whole_a = np.concatenate(comm.allgather(array))
     else:
-        # Figure out the subtype of the elements of the array
-        dtype = array.dtype
-        mpi_dtype = False
-        for ptype in possible_types.keys():
-            if np.issubdtype(dtype, ptype):
-                mpi_dtype = True
-                dtype = ptype
-
-        if shape is None or not mpi_dtype:
-            # do a lowercase allgather
-            a_shape = len(array.shape)
-            array = comm.allgather(array)
-            if a_shape <= 1:
-                return np.hstack(array)
-            else:
-                return np.vstack(array)
-        else:
-            # do an uppercase Allgather
-            whole_a = np.empty(shape, dtype=dtype)
-            comm.Allgather([array.ravel(), possible_types[dtype]], [whole_a,
-                                                                    possible_types[dtype]])
-            return whole_a
+        # do an uppercase Allgatherv
+        nums = np.empty((comm.size,), dtype=np.int64)
+        comm.Allgather([np.array([array.shape[0]], dtype=np.int64),
+                        MPI.INT64_T], [nums, MPI.INT64_T])
+        whole_a = np.empty((int(np.sum(nums)),) + array.shape[1:],
+                           dtype=array.dtype)
+        comm.Allgatherv(array, [whole_a, _counts_displs(
+            nums, int(np.prod(array.shape[1:])))])
+    if shape is not None:
+        whole_a = np.reshape(whole_a, shape)
+    return whole_a
+
+
+def get_root_values(array, root=0):
+    """
+    Concatenates local arrays into global array along the first axis on the
+    processor ``root`` only, with a typed ``Gatherv`` for arrays of numeric
+    type, see :meth:`get_global_values`.
+
+    :param array: Array.
+    :type array: :class:`~numpy.ndarray`
+    :param int root: processor receiving the global array
+    :rtype: :class:`~numpy.ndarray`
+    :returns: array on ``root`` and ``None`` on the other processors
+    """
+    if comm.size == 1:
+        return array
+    array = _rows_buffer(array)
+    if array.dtype.kind not in 'biufc':
+        arrays = comm.gather(array, root=root)
+        if comm.rank == root:
+            return np.concatenate(arrays)
+        return None
+    nums = comm.gather(array.shape[0], root=root)
+    if comm.rank != root:
+        comm.Gatherv(array, None, root=root)
+        return None
+    whole_a = np.empty((int(np.sum(nums)),) + array.shape[1:],
+                       dtype=array.dtype)
+    comm.Gatherv(array, [whole_a, _counts_displs(
+        nums, int(np.prod(array.shape[1:])))], root=root)
+    return whole_a
+
+
+def get_global_values_at(array, index):
+    """
+    Returns the rows ``index`` of the global array whose local rows on each
+    processor are ``array``, without forming the global array. Each processor
+    sends the indices it needs to the processors holding them, which send
+    back the rows, with typed ``Alltoallv`` for arrays of numeric type.
+
+    :param array: local rows of the global array
+    :type array: :class:`~numpy.ndarray`
+    :param index: indices of the rows of the global array
+    :type index: :class:`~numpy.ndarray` of ints
+    :rtype: :class:`~numpy.ndarray`
+    :returns: rows of shape ``index.shape + array.shape[1:]``
+    """
+    if comm.size == 1:
+        return array[index]
+    array = _rows_buffer(array)
+    index = np.asarray(index)
+    if array.dtype.kind not in 'biufc':
+        return get_global_values(array)[index]
+    offsets = np.cumsum([0] + comm.allgather(array.shape[0]))
+    flat_index = np.ravel(index).astype(np.int64)
+    owner = np.searchsorted(offsets, flat_index, side='right') - 1
+    order = np.argsort(owner, kind='stable')
+    send_nums = np.bincount(owner, minlength=comm.size)
+    recv_nums = np.array(comm.alltoall(send_nums.tolist()), dtype=np.int64)
+
+    # send the requested indices to the processors holding them
+    requests = np.empty((int(np.sum(recv_nums)),), dtype=np.int64)
+    comm.Alltoallv([flat_index[order], _counts_displs(send_nums, 1)],
+                   [requests, _counts_displs(recv_nums, 1)])
+
+    # send back the requested rows
+    row_size = int(np.prod(array.shape[1:]))
+    replies = np.ascontiguousarray(array[requests - offsets[comm.rank]])
+    sorted_rows = np.empty((len(flat_index),) + array.shape[1:],
+                           dtype=array.dtype)
+    comm.Alltoallv([replies, _counts_displs(recv_nums, row_size)],
+                   [sorted_rows, _counts_displs(send_nums, row_size)])
+    rows = np.empty_like(sorted_rows)
+    rows[order] = sorted_rows
+    return np.reshape(rows, index.shape + array.shape[1:])
 
 
 def fix_dimensions_vector(vector):
@@ -194,7 +294,8 @@ def fix_dimensions_data(data, dim=None):
 
 def clean_data(data):
     """
-    Clean data so that NaN->0, inf-> maxfloat, -inf-> -maxfloat
+    Clean data so that NaN->0, inf-> maxfloat, -inf-> -maxfloat. Read-only
+    data, e.g. shared between copies of a sample set, is copied first.
 
     :param data: numerical object
     :type data: :class:`numpy.ndarray`
@@ -202,6 +303,8 @@ def clean_data(data):
     :returns: array of shape (data.shape)
 
     """
+    if not data.flags.writeable:
+        data = np.copy(data)
     data[np.isnan(data)] = 0.0
     data[np.isinf(data)] = np.sign(data[np.isinf(data)])*sys.float_info[0]
 
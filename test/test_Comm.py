@@ -5,6 +5,8 @@ This module contains unittests for :mod:`~bet.Comm`
 """
 
 import unittest
+import numpy as np
+import numpy.testing as nptest
 import bet.Comm as Comm
 from pkgutil import iter_modules
 
@@ -39,6 +41,30 @@ class Test_comm_for_no_mpi4py(unittest.TestCase):
         thing = list(range(4))
         self.assertEqual(self.comm.Allgather(thing), thing)
 
+    def test_Allgatherv(self):
+        thing = np.arange(6.0).reshape((3, 2))
+        recv = np.empty((3, 2))
+        self.assertIs(self.comm.Allgatherv(thing, [recv, (6, 0)]), thing)
+        nptest.assert_array_equal(recv, thing)
+
+    def test_Gatherv(self):
+        thing = np.arange(6.0).reshape((3, 2))
+        recv = np.empty((3, 2))
+        self.assertIs(self.comm.Gatherv(thing, [recv, (6, 0)], root=0),
+                      thing)
+        nptest.assert_array_equal(recv, thing)
+
+    def test_Alltoallv(self):
+        thing = np.arange(4)
+        recv = np.empty((4,), dtype=thing.dtype)
+        self.assertIs(self.comm.Alltoallv([thing, (4, 0)], [recv, (4, 0)]),
+                      thing)
+        nptest.assert_array_equal(recv, thing)
+
+    def test_alltoall(self):
+        thing = [4]
+        self.assertEqual(self.comm.alltoall(thing), thing)
+
     def test_Allreduce(self):
         thing1 = list(range(4))
         thing2 = list(range(4))
@@ -95,6 +95,32 @@ class calculate_error(object):
         else:
             self.assertAlmostEqual(low, lower[0])
 
+    def Test_sampling_error_distributed(self):
+        """
+        Testing :meth:`bet.calculateP.calculateError.sampling_error` is not
+        set up for an input sample set in distributed mode.
+        """
+        disc = self.disc.copy()
+        disc._input_sample_set.set_distributed()
+        with self.assertRaises(NotImplementedError):
+            calculateError.sampling_error(disc)
+
+    def test_model_error_copied_discretization(self):
+        """
+        Testing :meth:`bet.calculateP.calculateError.model_error` on a copied
+        or shallow copied discretization leaves the original unchanged.
+        """
+        output_set = self.disc._output_sample_set
+        values = np.copy(output_set._values_local)
+        for disc in [self.disc.copy(), self.disc.shallow_copy()]:
+            m_error = calculateError.model_error(disc)
+            er_est = m_error.calculate_for_contour_events()
+            nptest.assert_array_almost_equal(
+                er_est, calculateError.model_error(
+                    self.disc).calculate_for_contour_events())
+            nptest.assert_array_equal(output_set._values_local, values)
+            self.assertTrue(output_set._values_local.flags.writeable)
+
     def Test_model_error(self):
         """
         Testing :meth:`bet.calculateP.calculateError.model_error`
@@ -8,6 +8,7 @@ Most of these tests should make sure certain values are within a tolerance
 rather than exact due to the stocastic nature of the algorithms being tested.
 """
 import os
+import shutil
 import unittest
 import bet
 import bet.calculateP.calculateP as calcP
@@ -21,6 +22,8 @@ from bet.Comm import comm
 
 #data_path = os.path.dirname(bet.__file__) + "/../test/test_calculateP/datafiles"
 data_path = "test/test_calculateP/datafiles"
+#local_path = os.path.join(os.path.dirname(bet.__file__), "/test")
+local_path = ''
 
 
 class prob:
@@ -145,6 +148,101 @@ class Test_prob_3to2(TestProbMethod_3to2, prob):
         calcP.prob(self.disc)
         self.P_ref = np.loadtxt(data_path + "/3to2_prob.txt.gz")
 
+    def test_prob_batch(self):
+        """
+        Test that batched probabilities match those of separate solves.
+        """
+        probs = self.output_prob._probabilities
+        P = calcP.prob_batch(self.disc, np.array([probs, 0.5*probs]))
+        self.assertEqual(P.shape, (2, self.inputs.check_num()))
+        nptest.assert_almost_equal(P[0], self.inputs._probabilities)
+        nptest.assert_almost_equal(P[1], 0.5*self.inputs._probabilities)
+
+        # several output partitions
+        output_prob2 = simpleFunP.regular_partition_uniform_distribution_rectangle_scaled(
+            self.outputs, Q_ref=np.array([0.5, 0.9]), rect_scale=0.3,
+            cells_per_dimension=2)
+        P = calcP.prob_batch(self.disc, [self.output_prob, output_prob2,
+                                         self.output_prob])
+        nptest.assert_almost_equal(P[0], self.inputs._probabilities)
+        nptest.assert_almost_equal(P[2], self.inputs._probabilities)
+        disc2 = samp.discretization(input_sample_set=self.inputs,
+                                    output_sample_set=self.outputs,
+                                    output_probability_set=output_prob2)
+        calcP.prob(disc2)
+        nptest.assert_almost_equal(P[1], self.inputs._probabilities)
+
+    def test_prob_streaming(self):
+        """
+        Test that probabilities streamed to disk match those of prob.
+        """
+        self.outputs.global_to_local()
+
+        def chunks():
+            for start in range(0, len(self.inputs._volumes_local), 1000):
+                rows = slice(start, start + 1000)
+                yield (self.inputs._values_local[rows],
+                       self.outputs._values_local[rows],
+                       self.inputs._volumes_local[rows])
+        file_name = os.path.join(local_path, 'testfile_prob_streaming')
+        local_file_name = file_name
+        if comm.size > 1:
+            local_file_name = os.path.join(local_path, "proc{}_{}".format(
+                comm.rank, os.path.basename(file_name)))
+        self.addCleanup(shutil.rmtree, local_file_name + '.bet', True)
+        calcP.prob_streaming(chunks, self.output_prob, file_name,
+                             chunk_size=300)
+        P = samp.load_rows(local_file_name,
+                           'default_input_sample_set_probabilities',
+                           slice(None))
+        nptest.assert_almost_equal(P, self.inputs._probabilities_local)
+        nptest.assert_array_equal(
+            samp.load_rows(local_file_name, 'default_io_ptr', slice(None)),
+            self.output_prob.query(self.outputs._values_local)[1])
+
+    def test_prob_incremental(self):
+        """
+        Test that probabilities updated after moving the output probability
+        set match those of a full solve, and leave the last probabilities
+        unchanged.
+        """
+        simpleFunP.regular_partition_uniform_distribution_rectangle_scaled(
+            self.disc, Q_ref=np.array([0.43, 0.94]), rect_scale=0.2,
+            cells_per_dimension=2)
+        calcP.prob(self.disc)
+        self.assertIsNone(self.disc._prob_state)
+        calcP.prob(self.disc, incremental=True)
+        P_local = self.inputs._probabilities_local
+        P_local_old = np.copy(P_local)
+        output_prob = simpleFunP.\
+            regular_partition_uniform_distribution_rectangle_scaled(
+                self.disc, Q_ref=np.array([0.44, 0.93]), rect_scale=0.2,
+                cells_per_dimension=2)
+        self.disc.set_io_ptr(globalize=False, incremental=True)
+        self.assertIsNotNone(calcP._update_probabilities(
+            self.disc, self.inputs._volumes_local, output_prob.check_num()))
+        calcP.prob(self.disc, incremental=True)
+        self.assertIsNot(self.inputs._probabilities_local, P_local)
+        nptest.assert_array_equal(P_local, P_local_old)
+
+        inputs = samp.sample_set(3)
+        inputs.set_values(self.inputs._values)
+        inputs.set_volumes(self.inputs._volumes)
+        disc = samp.discretization(input_sample_set=inputs,
+                                   output_sample_set=self.outputs,
+                                   output_probability_set=output_prob)
+        calcP.prob(disc)
+        nptest.assert_almost_equal(self.inputs._probabilities,
+                                   inputs._probabilities)
+
+        # volumes and probabilities edited in place are not reused
+        self.inputs._probabilities_local[:] = 0.0
+        self.inputs._volumes_local[:] = 2.0*self.inputs._volumes_local
+        self.assertIsNone(calcP._update_probabilities(
+            self.disc, self.inputs._volumes_local, output_prob.check_num()))
+        calcP.prob(self.disc, incremental=True)
+        nptest.assert_almost_equal(self.inputs._probabilities,
+                                   inputs._probabilities)
 
 class Test_prob_on_emulated_samples_3to2(TestProbMethod_3to2, prob_on_emulated_samples):
     """
@@ -446,3 +544,34 @@ class Test_prob_from_sample_set(unittest.TestCase):
                                    emulated_input_sample_set=self.set_em)
         calcP.prob_from_discretization_input(disc, self.set_new)
         nptest.assert_almost_equal(self.set_new._probabilities, [0.25, 0.75])
+
+    def test_transfer_operator(self):
+        """
+        Check that a transfer operator reused for different probabilities
+        matches the functions building it each time.
+        """
+        transfer = calcP.transfer_operator(self.set_old, self.set_new,
+                                           self.set_em)
+        self.assertEqual(transfer.overlap.shape, (2, self.set_old.check_num()))
+        nptest.assert_almost_equal(
+            transfer.apply(self.set_old._probabilities), [0.25, 0.75])
+
+        probs = np.zeros((self.set_old.check_num(),))
+        probs[0] = 1.0
+        self.set_old.set_probabilities(probs)
+        nptest.assert_almost_equal(
+            transfer.apply(probs),
+            calcP.prob_from_sample_set_with_emulated_volumes(
+                self.set_old, self.set_new, self.set_em))
+        self.set_old.global_to_local()
+        nptest.assert_almost_equal(
+            transfer.apply_local(self.set_old._probabilities_local),
+            transfer.apply(probs))
+        transfer = calcP.transfer_operator(self.set_old, self.set_new)
+        self.assertIsNone(transfer.counts)
+        nptest.assert_almost_equal(
+            transfer.apply(probs),
+            calcP.prob_from_sample_set(self.set_old, self.set_new))
+        nptest.assert_almost_equal(
+            transfer.apply_local(self.set_old._probabilities_local),
+            transfer.apply(probs))
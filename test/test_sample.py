@@ -5,8 +5,13 @@
 import unittest
 import os
 import glob
+import shutil
+import pickle
+import json
 import numpy as np
 import numpy.testing as nptest
+import scipy.spatial as spatial
+import scipy.io as sio
 import bet
 import bet.sample as sample
 import bet.util as util
@@ -171,6 +176,311 @@ class Test_sample_set(unittest.TestCase):
         elif not globalize:
             os.remove(local_file_name)
 
+    def test_save_load_chunked(self):
+        """
+        Check save_sample_set and load_sample_set with a chunked store.
+        """
+        self.sam_set.set_volumes(np.ones((self.num,)))
+        self.sam_set.set_domain(self.domain)
+        self.sam_set.global_to_local()
+        file_name = os.path.join(local_path, 'testfile_chunked')
+        store_name = file_name + '.bet'
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+
+        # appending values only writes new rows
+        self.sam_set.append_values(np.zeros((5, self.dim)))
+        self.sam_set.set_volumes(np.ones((self.num + 5,)))
+        self.sam_set.global_to_local()
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+        if comm.rank == 0:
+            self.assertEqual(len(os.listdir(os.path.join(
+                store_name, "TEST_values"))), 2)
+        # changed rows rewrite the attribute
+        self.sam_set.set_volumes(2.0*np.ones((self.num + 5,)))
+        self.sam_set.global_to_local()
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+        if comm.rank == 0:
+            self.assertEqual(len(os.listdir(os.path.join(
+                store_name, "TEST_volumes"))), 1)
+
+        loaded_set = sample.load_sample_set(file_name, "TEST")
+        self.assertIsNone(sample.load_sample_set(file_name))
+        self.assertEqual(type(loaded_set), type(self.sam_set))
+        for attrname in sample.sample_set.vector_names+sample.sample_set.\
+                all_ndarray_names:
+            curr_attr = getattr(loaded_set, attrname)
+            if curr_attr is not None:
+                nptest.assert_array_equal(getattr(self.sam_set, attrname),
+                                          curr_attr)
+        comm.barrier()
+        if comm.rank == 0:
+            shutil.rmtree(store_name)
+
+    def test_save_load_chunked_changed_rows(self):
+        """
+        Check that saving a chunked store again rewrites attributes whose
+        stored rows changed before the last one.
+        """
+        file_name = os.path.join(local_path, 'testfile_changed')
+        probabilities = np.zeros((self.num,))
+        probabilities[0:2] = 0.5
+        self.sam_set.set_probabilities(probabilities)
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+        probabilities = np.zeros((self.num,))
+        probabilities[2:4] = 0.5
+        self.sam_set.set_probabilities(probabilities)
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+        loaded_set = sample.load_sample_set(file_name, "TEST")
+        nptest.assert_array_equal(loaded_set._probabilities, probabilities)
+        comm.barrier()
+        if comm.rank == 0:
+            shutil.rmtree(file_name + '.bet')
+
+    def test_chunked_store_append_rows(self):
+        """
+        Check rows appended a chunk at a time to a chunked store.
+        """
+        store_name = os.path.join(local_path, "proc{}_testfile_append.bet".
+                                  format(comm.rank))
+        store = sample.chunked_store(store_name)
+        values = self.sam_set.get_values()
+        store.append_rows('TEST', 'sample_set', '_values', values[5:],
+                          new=True)
+        # new rows replace the stored rows
+        store.append_rows('TEST', 'sample_set', '_values', values[:5],
+                          new=True)
+        store.append_rows('TEST', 'sample_set', '_values', values[5:])
+        nptest.assert_array_equal(store['TEST_values'], values)
+        self.assertEqual(len(os.listdir(os.path.join(store_name,
+                                                     "TEST_values"))), 2)
+        nptest.assert_array_equal(np.concatenate(list(store.iter_chunks(
+            'TEST', '_values'))), values)
+        self.assertEqual(store.shapes()['TEST_values'], values.shape)
+        self.assertRaises(sample.dim_not_matching, store.append_rows, 'TEST',
+                          'sample_set', '_values', np.zeros((2, self.dim+1)))
+        shutil.rmtree(store_name)
+
+    def test_save_load_kdtree(self):
+        """
+        Check the nearest neighbor search tree is saved and restored only if
+        the values it indexes are unchanged.
+        """
+        self.sam_set.set_kdtree()
+        x = np.random.random((20, self.dim))
+        (dist, ptr) = self.sam_set.query(x)
+        for file_format in ['mat', 'chunked']:
+            file_name = os.path.join(local_path, 'testfile_kdtree.mat')
+            sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                                   file_format=file_format)
+            comm.barrier()
+            kdtree_file = sample._kdtree_path(file_name, "TEST")
+            self.assertTrue(os.path.exists(kdtree_file))
+
+            loaded_set = sample.load_sample_set(file_name, "TEST")
+            self.assertIsNotNone(loaded_set._kdtree)
+            (loaded_dist, loaded_ptr) = loaded_set.query(x)
+            nptest.assert_array_equal(loaded_dist, dist)
+            nptest.assert_array_equal(loaded_ptr, ptr)
+            loaded_set = sample.load_sample_set(file_name, "TEST", lazy=True)
+            self.assertIsNotNone(loaded_set.get_kdtree())
+
+            # a tree of other values is not restored
+            changed_set = self.sam_set.copy()
+            changed_set.set_values(self.sam_set.get_values() + 1.0)
+            changed_set.global_to_local()
+            sample.save_sample_set(changed_set, file_name, "TEST", True,
+                                   file_format=file_format)
+            comm.barrier()
+            self.assertFalse(os.path.exists(kdtree_file))
+            # the tree is not unpickled unless the hash in the header matches
+            if comm.rank == 0:
+                with open(kdtree_file, 'wb') as f:
+                    f.write((json.dumps({
+                        'backend': self.sam_set._kdtree_backend,
+                        'hash': 'stale'}) + '\n').encode('utf-8'))
+                    f.write(b'not a pickle')
+            comm.barrier()
+            self.assertIsNone(sample.load_sample_set(file_name,
+                                                     "TEST")._kdtree)
+            comm.barrier()
+            if comm.rank == 0:
+                with open(kdtree_file, 'wb') as f:
+                    pickle.dump({'backend': self.sam_set._kdtree_backend,
+                                 'hash': 'stale'}, f)
+            comm.barrier()
+            self.assertIsNone(sample.load_sample_set(file_name,
+                                                     "TEST")._kdtree)
+            comm.barrier()
+            if comm.rank == 0:
+                os.remove(kdtree_file)
+                if file_format == 'mat':
+                    os.remove(file_name)
+                else:
+                    shutil.rmtree(file_name[:-4] + '.bet')
+
+    def test_copy_clip_kdtree(self):
+        """
+        Check copy and clip reuse the nearest neighbor search tree.
+        """
+        self.sam_set.set_kdtree()
+        my_copy = self.sam_set.copy()
+        self.assertIs(my_copy._kdtree, self.sam_set._kdtree)
+        self.assertIs(self.sam_set.shallow_copy()._kdtree,
+                      self.sam_set._kdtree)
+        self.assertIs(self.sam_set.clip(self.num)._kdtree,
+                      self.sam_set._kdtree)
+        # trees of appended blocks within the clipped values are kept
+        self.sam_set.append_values(np.random.random((self.num//2,
+                                                     self.dim)))
+        clipped = self.sam_set.clip(self.num)
+        self.assertIs(clipped._kdtree.trees[0][1],
+                      self.sam_set._kdtree.trees[0][1])
+        x = np.random.random((20, self.dim))
+        (dist, ptr) = clipped.query(x)
+        (copy_dist, copy_ptr) = my_copy.query(x)
+        nptest.assert_array_equal(dist, copy_dist)
+        nptest.assert_array_equal(ptr, copy_ptr)
+        # stale trees and trees of the values of the original are rebuilt
+        self.sam_set.set_values(self.sam_set.get_values()[:self.num] + 1.0)
+        self.assertIsNot(self.sam_set.copy()._kdtree, self.sam_set._kdtree)
+        self.sam_set.set_kdtree_backend('kdtree')
+        self.sam_set.set_kdtree()
+        my_copy = self.sam_set.copy()
+        self.assertIsNot(my_copy._kdtree, self.sam_set._kdtree)
+        ptr = my_copy.query(x)[1]
+        self.sam_set._values[:] = 0.0
+        nptest.assert_array_equal(my_copy.query(x)[1], ptr)
+
+    def test_load_parallel_diff_nproc(self):
+        """
+        Check load_sample_set reads the local rows of files saved by a
+        different number of processors.
+        """
+        file_name = os.path.join(local_path, 'testfile_nproc.mat')
+        values = np.array_split(self.sam_set.get_values(), comm.size + 1)
+        volumes = np.array_split(np.arange(self.num, dtype=float),
+                                 comm.size + 1)
+        for file_format in ['mat', 'chunked']:
+            if comm.rank == 0:
+                for proc in range(comm.size + 1):
+                    proc_file_name = os.path.join(local_path, "proc{}_{}".
+                                                  format(proc, 'testfile_nproc.mat'))
+                    attributes = {'_dim': self.dim,
+                                  '_values_local': values[proc],
+                                  '_volumes_local': volumes[proc],
+                                  '_domain': self.domain}
+                    if file_format == 'mat':
+                        mdat = {'TEST' + k: v for (k, v) in attributes.items()}
+                        mdat['TEST_sample_set_type'] = 'sample_set'
+                        sio.savemat(proc_file_name, mdat)
+                    else:
+                        sample.chunked_store(proc_file_name[:-4] + '.bet').save(
+                            'TEST', 'sample_set', attributes)
+            comm.barrier()
+
+            loaded_set = sample.load_sample_set(file_name, "TEST")
+            nptest.assert_array_equal(loaded_set._values_local, np.array_split(
+                self.sam_set.get_values(), comm.size)[comm.rank])
+            nptest.assert_array_equal(loaded_set._volumes_local,
+                                      np.array_split(np.arange(self.num),
+                                                     comm.size)[comm.rank])
+            nptest.assert_array_equal(loaded_set._domain, self.domain)
+            self.assertIsNone(loaded_set._values)
+            comm.barrier()
+            if comm.rank == 0:
+                for proc in range(comm.size + 1):
+                    proc_file_name = os.path.join(local_path, "proc{}_{}".
+                                                  format(proc, 'testfile_nproc.mat'))
+                    if file_format == 'mat':
+                        os.remove(proc_file_name)
+                    else:
+                        shutil.rmtree(proc_file_name[:-4] + '.bet')
+
+    def test_load_attributes(self):
+        """
+        Check load_sample_set_attributes loads the domain but no rows.
+        """
+        file_name = os.path.join(local_path, 'testfile_attributes.mat')
+        self.sam_set.set_domain(self.domain)
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True)
+        comm.barrier()
+
+        loaded_set = sample.load_sample_set_attributes(file_name, "TEST")
+        self.assertEqual(loaded_set._dim, self.dim)
+        nptest.assert_array_equal(loaded_set._domain, self.domain)
+        self.assertIsNone(loaded_set._values)
+        self.assertIsNone(loaded_set._values_local)
+        self.assertIsNone(sample.load_sample_set_attributes(file_name,
+                                                            "NONE"))
+        comm.barrier()
+        if comm.rank == 0:
+            os.remove(file_name)
+
+    def test_load_lazy(self):
+        """
+        Check load_sample_set maps attributes of a chunked store on access.
+        """
+        self.sam_set.set_volumes(np.ones((self.num,)))
+        self.sam_set.global_to_local()
+        file_name = os.path.join(local_path, 'testfile_lazy')
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+
+        loaded_set = sample.load_sample_set(file_name, "TEST",
+                                            localize=False, lazy=True)
+        self.assertEqual(loaded_set.check_num(), self.num)
+        self.assertNotIn('_volumes', loaded_set.__dict__)
+        self.assertIsInstance(loaded_set._volumes, np.memmap)
+        nptest.assert_array_equal(loaded_set._volumes, self.sam_set._volumes)
+        loaded_set.global_to_local()
+        self.assertIn('_values', loaded_set._lazy)
+        self.assertIsInstance(loaded_set._values_local, np.memmap)
+        nptest.assert_array_equal(loaded_set._values_local,
+                                  self.sam_set._values_local)
+        # localizing does not load the global arrays
+        loaded_set = sample.load_sample_set(file_name, "TEST", lazy=True)
+        self.assertIn('_values', loaded_set._lazy)
+        self.assertIn('_volumes', loaded_set._lazy)
+        nptest.assert_array_equal(loaded_set._volumes_local,
+                                  self.sam_set._volumes_local)
+        self.assertIn('_volumes', loaded_set._lazy)
+        # writes are private to the sample set
+        loaded_set._values[0] = -1.0
+        self.assertTrue(np.all(sample.load_sample_set(
+            file_name, "TEST", lazy=True)._values[0] != -1.0))
+        # setting an attribute discards its loader
+        loaded_set = sample.load_sample_set(file_name, "TEST", lazy=True)
+        loaded_set.set_jacobians(None)
+        self.assertIsNone(loaded_set._jacobians)
+        self.assertNotIn('_jacobians', loaded_set._lazy)
+        # attributes stored in several chunks are localized per chunk
+        self.sam_set.append_values(self.sam_set._values[:2])
+        self.sam_set.set_volumes(np.ones((self.num + 2,)))
+        self.sam_set.global_to_local()
+        sample.save_sample_set(self.sam_set, file_name, "TEST", True,
+                               file_format='chunked')
+        comm.barrier()
+        loaded_set = sample.load_sample_set(file_name, "TEST", lazy=True)
+        self.assertEqual(loaded_set.check_num(), self.num + 2)
+        nptest.assert_array_equal(loaded_set._values_local,
+                                  self.sam_set._values_local)
+        self.assertIn('_values', loaded_set._lazy)
+        del loaded_set
+        comm.barrier()
+        if comm.rank == 0:
+            shutil.rmtree(file_name + '.bet')
+
     def test_copy(self):
         """
         Check copy.
@@ -199,6 +509,32 @@ class Test_sample_set(unittest.TestCase):
 
         assert copied_set._kdtree is not None
 
+        # the copy and the original are changed in place independently
+        self.sam_set._values[0] = 5.0
+        self.assertFalse(np.any(copied_set._values == 5.0))
+        copied_set._volumes[0] = 2.0
+        self.assertEqual(self.sam_set._volumes[0], 1.0/float(self.num))
+
+    def test_shallow_copy(self):
+        """
+        Check that shallow copies share read-only arrays until one is set,
+        and that the arrays of the original stay writable.
+        """
+        self.sam_set.set_volumes(np.ones((self.num,)))
+        version = self.sam_set.get_version()
+        copied_set = self.sam_set.shallow_copy()
+        self.assertEqual(self.sam_set.get_version(), version)
+        self.assertTrue(np.shares_memory(copied_set._values,
+                                         self.sam_set._values))
+        self.assertTrue(self.sam_set._volumes.flags.writeable)
+        with self.assertRaises(ValueError):
+            copied_set._volumes[0] = 2.0
+
+        copied_set.set_volumes(2.0*np.ones((self.num,)))
+        nptest.assert_array_equal(self.sam_set._volumes, 1.0)
+        self.sam_set.append_values(np.zeros((5, self.dim)))
+        self.assertEqual(copied_set._values.shape, (self.num, self.dim))
+
     def test_update_bounds(self):
         """
         Check update_bounds
@@ -220,6 +556,25 @@ class Test_sample_set(unittest.TestCase):
         nptest.assert_array_equal(self.sam_set._width,
                                   np.repeat([self.domain[:, 1] - self.domain[:, 0]], o_num, 0))
 
+    def test_update_bounds_broadcast(self):
+        """
+        Check that the bounds are broadcast from the domain and stay so
+        through copies and local_to_global.
+        """
+        self.sam_set.set_domain(self.domain)
+        self.sam_set.update_bounds()
+        self.assertEqual(self.sam_set._left.strides[0], 0)
+        self.assertFalse(self.sam_set._width.flags.writeable)
+        self.assertEqual(self.sam_set.copy()._right.strides[0], 0)
+
+        self.sam_set.global_to_local()
+        self.sam_set._left = None
+        self.sam_set.local_to_global()
+        self.assertEqual(self.sam_set._left.shape, (self.num, self.dim))
+        self.assertEqual(self.sam_set._left.strides[0], 0)
+        nptest.assert_array_equal(self.sam_set._left,
+                                  np.repeat([self.domain[:, 0]], self.num, 0))
+
     def test_update_bounds_local(self):
         """
         Check update_bounds_local
@@ -268,6 +623,39 @@ class Test_sample_set(unittest.TestCase):
         nptest.assert_array_equal(util.fix_dimensions_data(values),
                                   self.sam_set.get_values_local())
 
+    def test_values_dtype(self):
+        """
+        Check that values keep the type set by set_values_dtype through
+        appends, copies, globalization, queries and save/load.
+        """
+        self.sam_set.set_values_dtype(np.float32)
+        self.assertEqual(self.sam_set.get_values_dtype(), np.float32)
+        self.assertEqual(self.sam_set.get_values().dtype, np.float32)
+        self.sam_set.append_values(np.zeros((5, self.dim)))
+        self.assertEqual(self.sam_set.get_values().dtype, np.float32)
+        self.assertEqual(self.sam_set.copy().get_values_dtype(), np.float32)
+
+        self.sam_set.global_to_local()
+        self.assertEqual(self.sam_set._values_local.dtype, np.float32)
+        self.assertEqual(self.sam_set._local_index.dtype, np.int32)
+        self.sam_set._values = None
+        self.sam_set.local_to_global()
+        self.assertEqual(self.sam_set.get_values().dtype, np.float32)
+        (_, ptr) = self.sam_set.query(np.zeros((3, self.dim)))
+        nptest.assert_array_equal(ptr, self.num)
+
+        file_name = os.path.join(local_path, 'testfile_dtype.mat')
+        sample.save_sample_set(self.sam_set, file_name, globalize=True)
+        loaded_set = sample.load_sample_set(file_name)
+        self.assertEqual(loaded_set.get_values().dtype, np.float32)
+        comm.barrier()
+        if comm.rank == 0:
+            os.remove(file_name)
+            os.remove(sample._kdtree_path(file_name, "default"))
+
+        self.assertEqual(sample.ptr_dtype(2**31), np.uint32)
+        self.assertEqual(sample.ptr_dtype(2**32), np.int64)
+
     def test_get_values(self):
         """
         Check get_samples.
@@ -291,6 +679,28 @@ class Test_sample_set(unittest.TestCase):
         nptest.assert_array_equal(util.fix_dimensions_data(new_values),
                                   self.sam_set.get_values()[self.num::, :])
 
+    def test_append_values_kdtree(self):
+        """
+        Check that repeated appends extend the nearest neighbor search tree.
+        """
+        self.sam_set.set_kdtree()
+        for i in range(7):
+            self.sam_set.append_values(np.random.random((i+1, self.dim)))
+        self.assertIsInstance(self.sam_set._kdtree, sample.kdtree_forest)
+        self.assertEqual(self.sam_set.check_num(), self.num + 28)
+        self.assertLessEqual(len(self.sam_set._kdtree.trees), 5)
+        x = np.random.random((20, self.dim))
+        tree = spatial.cKDTree(self.sam_set.get_values())
+        for k in [1, 3]:
+            (dist, ptr) = self.sam_set.query(x, k=k)
+            (dist2, ptr2) = tree.query(x, k=k, p=self.sam_set._p_norm)
+            nptest.assert_array_almost_equal(dist, dist2)
+            nptest.assert_array_equal(ptr.shape, ptr2.shape)
+            nptest.assert_array_almost_equal(np.linalg.norm(
+                self.sam_set.get_values()[ptr] - x[:, np.newaxis, :]
+                if k > 1 else self.sam_set.get_values()[ptr] - x,
+                axis=-1), dist)
+
     def test_append_values_local(self):
         """
         Check appending of local values.
@@ -381,6 +791,36 @@ class Test_sample_set(unittest.TestCase):
         self.sam_set.append_values(new_values)
         self.assertRaises(sample.length_not_matching, self.sam_set.check_num)
 
+    def test_check_num_cached(self):
+        """
+        Check that the global number of samples summed from the local arrays
+        is kept until the number of rows of a local array changes, unless
+        debugging.
+        """
+        self.sam_set.set_values_local(np.ones((5, self.dim)))
+        self.sam_set._values = None
+        self.assertEqual(self.sam_set.check_num(), 5*comm.size)
+        self.assertEqual(self.sam_set._num_from_local, 5*comm.size)
+        # rows of the same number set on one processor only
+        if comm.rank == 0:
+            self.sam_set.set_values_local(np.zeros((5, self.dim)))
+        self.assertEqual(self.sam_set._num_from_local, 5*comm.size)
+        self.assertEqual(self.sam_set.check_num(), 5*comm.size)
+        self.sam_set.set_values_local(np.ones((3, self.dim)))
+        self.assertIsNone(self.sam_set._num_from_local)
+        self.assertEqual(self.sam_set.check_num(), 3*comm.size)
+        self.assertEqual(self.sam_set.check_num_local(), 3)
+        self.sam_set.set_volumes_local(np.ones((4,)))
+        self.assertRaises(sample.length_not_matching,
+                          self.sam_set.check_num_local)
+
+        sample.debug_checks = True
+        try:
+            self.assertRaises(sample.length_not_matching,
+                              self.sam_set.check_num)
+        finally:
+            sample.debug_checks = False
+
     def test_kd_tree(self):
         """
         Check features of the KD Tree
@@ -388,6 +828,61 @@ class Test_sample_set(unittest.TestCase):
         self.sam_set.set_kdtree()
         self.sam_set.get_kdtree()
 
+    def test_kdtree_backend(self):
+        """
+        Check that the nearest neighbor backends agree and can be registered.
+        """
+        self.sam_set.set_values(np.random.random((self.num, self.dim)))
+        x = np.random.random((20, self.dim))
+        self.assertEqual(self.sam_set.get_kdtree_backend(),
+                         sample.default_kdtree_backend)
+        (dist1, ptr1) = self.sam_set.query(x, k=2)
+
+        self.sam_set.set_kdtree_backend('kdtree')
+        self.assertIsNone(self.sam_set._kdtree)
+        (dist2, ptr2) = self.sam_set.query(x, k=2)
+        nptest.assert_array_equal(ptr1, ptr2)
+        nptest.assert_array_almost_equal(dist1, dist2)
+
+        sample.register_kdtree_backend('test_backend',
+                                       *sample.kdtree_backends['ckdtree'])
+        self.sam_set.set_kdtree_backend('test_backend', n_jobs=2)
+        (dist3, ptr3) = self.sam_set.query(x, k=2)
+        nptest.assert_array_equal(ptr1, ptr3)
+        self.assertEqual(self.sam_set.copy().get_kdtree_backend(),
+                         'test_backend')
+        sample.kdtree_backends.pop('test_backend')
+
+        self.assertRaises(sample.unknown_kdtree_backend,
+                          self.sam_set.set_kdtree_backend, 'not_a_backend')
+
+    def test_query_chunked(self):
+        """
+        Check that chunked queries match a single query.
+        """
+        self.sam_set.set_values(np.random.random((self.num, self.dim)))
+        x = np.random.random((55, self.dim))
+        (dist, ptr) = self.sam_set.query(x)
+
+        ptr1 = self.sam_set.query_chunked(x, chunk_size=10)
+        self.assertEqual(ptr1.dtype, np.int32)
+        nptest.assert_array_equal(ptr, ptr1)
+
+        (dist2, ptr2) = self.sam_set.query_chunked((x[i:i+20] for i in
+                                                    range(0, 55, 20)),
+                                                   chunk_size=7,
+                                                   return_dist=True)
+        nptest.assert_array_equal(ptr, ptr2)
+        nptest.assert_array_almost_equal(dist, dist2)
+
+        ptr_out = np.empty((55, 2), dtype=np.int32)
+        self.sam_set.query_chunked(x, k=2, chunk_size=10, ptr_out=ptr_out)
+        nptest.assert_array_equal(self.sam_set.query(x, k=2)[1], ptr_out)
+
+        self.assertRaises(sample.length_not_matching,
+                          self.sam_set.query_chunked, x, chunk_size=10,
+                          ptr_out=np.empty((50,), dtype=np.int32))
+
     def test_parallel_features(self):
         """
         Check parallel features.
@@ -441,6 +936,67 @@ class Test_sample_set(unittest.TestCase):
                                           getattr(self.sam_set, array_name +
                                                   "_old"))
 
+    def test_distributed(self):
+        """
+        Check that distributed mode frees the global arrays and that its
+        queries and rows match those of the global arrays.
+        """
+        values = comm.bcast(np.random.random((self.num, self.dim)))
+        x = comm.bcast(np.random.random((20, self.dim)))
+        self.sam_set.set_values(values)
+        self.sam_set.set_volumes(np.arange(self.num, dtype=float))
+        (dist, ptr) = self.sam_set.query(x, k=2)
+
+        self.sam_set.set_distributed()
+        self.assertTrue(self.sam_set.get_distributed())
+        if comm.size > 1:
+            self.assertIsNone(self.sam_set._values)
+            self.assertIsNone(self.sam_set._volumes)
+        self.sam_set.local_to_global()
+        if comm.size > 1:
+            self.assertIsNone(self.sam_set._values)
+        (dist2, ptr2) = self.sam_set.query(x, k=2)
+        nptest.assert_array_almost_equal(dist, dist2)
+        nptest.assert_array_equal(ptr, ptr2)
+        nptest.assert_array_equal(self.sam_set.get_global_rows('_values',
+                                                               ptr2),
+                                  values[ptr])
+
+        root_set = self.sam_set.gather_to_root()
+        if comm.rank == 0:
+            self.assertFalse(root_set.get_distributed())
+            nptest.assert_array_equal(root_set._values, values)
+            nptest.assert_array_equal(root_set._volumes_local,
+                                      np.arange(self.num, dtype=float))
+        else:
+            self.assertIsNone(root_set)
+
+    def test_distributed_chunked(self):
+        """
+        Check that chunked queries in distributed mode match those of the
+        global arrays when processors have different numbers of chunks, and
+        that cached pointers are only reused if all processors have them.
+        """
+        values = comm.bcast(np.random.random((self.num, self.dim)))
+        self.sam_set.set_values(values)
+        # the first processor has no points
+        x = np.random.random((7*comm.rank, self.dim))
+        ptr = self.sam_set.query_chunked(x, chunk_size=3)
+        other_set = sample.sample_set(self.dim)
+        other_set.set_values_local(x)
+
+        self.sam_set.set_distributed()
+        nptest.assert_array_equal(self.sam_set.query_chunked(
+            x, chunk_size=3), ptr)
+        nptest.assert_array_equal(self.sam_set.query_chunked(
+            iter([x[:2], x[2:]]), chunk_size=3), ptr)
+        nptest.assert_array_equal(self.sam_set.query_sample_set(
+            other_set, chunk_size=3, use_cache=True), ptr)
+        if comm.rank == 0:
+            sample.query_cache.clear()
+        nptest.assert_array_equal(self.sam_set.query_sample_set(
+            other_set, chunk_size=3, use_cache=True), ptr)
+
     def test_domain(self):
         """
         Test domain information.
@@ -526,6 +1082,54 @@ class Test_discretization_simple(unittest.TestCase):
         self.disc.get_io_ptr()
         self.disc.globalize_ptrs()
 
+    def test_set_io_ptr_incremental(self):
+        """
+        Test that incremental io pointers match full queries when the
+        output probability set moves.
+        """
+        output_set = sample.sample_set(dim=2)
+        output_set.set_values(comm.bcast(np.random.random((200, 2))))
+        disc = sample.discretization(input_sample_set=output_set.copy(),
+                                     output_sample_set=output_set)
+        centers = comm.bcast(np.random.random((10, 2)))
+        for shift in [0.0, 0.01, 0.02, 0.5]:
+            prob_set = sample.sample_set(dim=2)
+            prob_set.set_values(centers + shift)
+            disc._output_probability_set = prob_set
+            disc.set_io_ptr(globalize=False, incremental=True)
+            nptest.assert_array_equal(disc._io_ptr_local, prob_set.query(
+                output_set._values_local)[1])
+            self.assertEqual(len(disc._io_margin_local),
+                             len(disc._io_ptr_local))
+        # the output probability set stays writable and is compared with
+        # copies of its cells
+        self.assertTrue(prob_set._values.flags.writeable)
+        prob_set._values += 0.3
+        prob_set.set_values(prob_set._values)
+        disc.set_io_ptr(globalize=False, incremental=True)
+        nptest.assert_array_equal(disc._io_ptr_local, prob_set.query(
+            output_set._values_local)[1])
+        for shift in [0.0, 0.01, 0.3]:
+            prob_set = sample.cartesian_sample_set(dim=2)
+            prob_set.setup([np.linspace(0.2, 0.6, 3) + shift,
+                            np.linspace(0.1, 0.5, 4)])
+            disc._output_probability_set = prob_set
+            disc.set_io_ptr(globalize=False, incremental=True)
+            nptest.assert_array_equal(disc._io_ptr_local, prob_set.query(
+                output_set._values_local)[1])
+        # a growing rectangle claims samples of the overlapping rectangles
+        # of higher index
+        for right in [0.45, 0.55, 0.65, 0.5]:
+            prob_set = sample.rectangle_sample_set(dim=2)
+            prob_set.setup([[right, 0.7], [1.0, 0.8], [0.6, 1.0]],
+                           [[0.0, 0.0], [0.0, 0.2], [0.3, 0.5]])
+            disc._output_probability_set = prob_set
+            disc.set_io_ptr(globalize=False, incremental=True)
+            nptest.assert_array_equal(disc._io_ptr_local, prob_set.query(
+                output_set._values_local)[1])
+        disc.set_io_ptr(globalize=False)
+        self.assertIsNone(disc._io_margin_local)
+
     def test_set_emulated_ii_ptr(self):
         """
         Test setting emulated ii ptr
@@ -557,6 +1161,75 @@ class Test_discretization_simple(unittest.TestCase):
         self.disc.get_emulated_oo_ptr()
         self.disc.globalize_ptrs()
 
+    def test_query_cache(self):
+        """
+        Test that pointers are reused until a set changes.
+        """
+        self.disc.set_io_ptr(globalize=False, use_cache=True)
+        ptr = self.disc._io_ptr_local
+        self.assertFalse(ptr.flags.writeable)
+        self.disc.copy().set_io_ptr(globalize=False, use_cache=True)
+        self.disc.set_io_ptr(globalize=False, use_cache=True)
+        self.assertIs(self.disc._io_ptr_local, ptr)
+        self.disc._output_sample_set.local_to_global()
+        self.disc.set_io_ptr(globalize=False, use_cache=True)
+        self.assertIs(self.disc._io_ptr_local, ptr)
+        self.disc.set_io_ptr(globalize=False)
+        self.assertIsNot(self.disc._io_ptr_local, ptr)
+
+        values = np.zeros((self.num, self.dim2))
+        values[-1] = 1.0
+        self.disc._output_probability_set.set_values(values)
+        self.disc._output_probability_set.set_kdtree()
+        self.disc.set_io_ptr(globalize=False, use_cache=True)
+        self.assertIsNot(self.disc._io_ptr_local, ptr)
+        nptest.assert_array_equal(self.disc._io_ptr_local, self.num - 1)
+
+        self.disc._output_sample_set.set_values(np.zeros((self.num,
+                                                          self.dim2)))
+        self.disc._output_sample_set.global_to_local()
+        self.disc.set_io_ptr(globalize=False, use_cache=True)
+        self.assertLess(np.max(self.disc._io_ptr_local), self.num - 1)
+
+    def test_query_cache_in_place(self):
+        """
+        Test that values changed in place are queried again, by default or
+        with the cache once they are marked as changed.
+        """
+        output_set = sample.sample_set(dim=1)
+        output_set.set_values(np.array([[0.1], [0.9]]))
+        prob_set = sample.sample_set(dim=1)
+        prob_set.set_values(np.array([[0.0], [1.0]]))
+        disc = sample.discretization(input_sample_set=output_set.copy(),
+                                     output_sample_set=output_set,
+                                     output_probability_set=prob_set)
+        disc.set_io_ptr(use_cache=True)
+        nptest.assert_array_equal(disc._io_ptr, [0, 1])
+        output_set._values_local[:] = 1.0 - output_set._values_local
+        disc.set_io_ptr()
+        nptest.assert_array_equal(disc._io_ptr, [1, 0])
+        output_set.mark_changed('_values_local')
+        disc.set_io_ptr(use_cache=True)
+        nptest.assert_array_equal(disc._io_ptr, [1, 0])
+
+    def test_query_cache_eviction(self):
+        """
+        Test that the least recently used pointers are evicted.
+        """
+        cache = sample.query_result_cache(max_bytes=100)
+        cache.put('a', np.zeros((10,), dtype=np.int32))
+        cache.put('b', np.zeros((10,), dtype=np.int32))
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', np.zeros((10,), dtype=np.int32))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.nbytes, 80)
+        cache.put('d', np.zeros((30,), dtype=np.int32))
+        self.assertIsNone(cache.get('d'))
+        cache.set_max_bytes(50)
+        self.assertIsNone(cache.get('c'))
+        self.assertEqual(cache.nbytes, 40)
+
     def test_set_input_sample_set(self):
         """
         Test setting input sample set
@@ -692,6 +1365,31 @@ class Test_discretization_simple(unittest.TestCase):
         elif not globalize:
             os.remove(local_file_name)
 
+    def test_save_load_discretization_chunked(self):
+        """
+        Test saving and loading of discretization with a chunked store
+        """
+        file_name = os.path.join(local_path, 'testfile_chunked')
+        self.disc.set_io_ptr()
+        sample.save_discretization(self.disc, file_name, "TEST", True,
+                                   file_format='chunked')
+        comm.barrier()
+        loaded_disc = sample.load_discretization(file_name, "TEST")
+
+        # the local pointers saved are those of processor 0
+        for attrname in sample.discretization.vector_names:
+            curr_attr = getattr(loaded_disc, attrname)
+            if curr_attr is not None and not attrname.endswith('_local'):
+                nptest.assert_array_equal(curr_attr, getattr(self.disc,
+                                                             attrname))
+        for attrname in ['_input_sample_set', '_output_sample_set']:
+            nptest.assert_array_equal(
+                getattr(loaded_disc, attrname)._values,
+                getattr(self.disc, attrname)._values)
+        comm.barrier()
+        if comm.rank == 0:
+            shutil.rmtree(file_name + '.bet')
+
     def test_copy_discretization(self):
         """
         Test copying of discretization
@@ -811,6 +1509,43 @@ class Test_discretization_simple(unittest.TestCase):
         nptest.assert_almost_equal(np.sum(lam_vol), 1.0)
 
 
+class TestCellReductions(unittest.TestCase):
+    """
+    Test :meth:`bet.sample.cell_sum` and :meth:`bet.sample.cell_max`.
+    """
+
+    def setUp(self):
+        self.num = 7
+        self.ptr = np.random.randint(0, self.num + 1, (200,))
+        self.values = np.random.random((200,))
+
+    def test_cell_sum(self):
+        """
+        Check counts and weighted sums against a loop over cells.
+        """
+        counts = sample.cell_sum(self.ptr, self.num, globalize=False)
+        sums = sample.cell_sum(self.ptr, self.num, self.values,
+                               globalize=False)
+        for i in range(self.num):
+            self.assertEqual(counts[i], np.sum(np.equal(self.ptr, i)))
+            nptest.assert_almost_equal(sums[i],
+                                       np.sum(self.values[self.ptr == i]))
+
+    def test_cell_max(self):
+        """
+        Check maxima against a loop over cells.
+        """
+        self.ptr[self.ptr == 3] = 4
+        maxes = sample.cell_max(self.ptr, self.num, self.values,
+                                globalize=False)
+        self.assertEqual(maxes.shape, (self.num,))
+        self.assertEqual(maxes[3], 0.0)
+        for i in range(self.num):
+            if i != 3:
+                self.assertEqual(maxes[i],
+                                 np.max(self.values[self.ptr == i]))
+
+
 class TestEstimateVolume(unittest.TestCase):
     """
     Test :meth:`bet.calculateP.calculateP.estimate_volulme`.
@@ -861,6 +1596,23 @@ class TestEstimateVolume(unittest.TestCase):
         nptest.assert_array_almost_equal(self.lam_vol, self.volume_exact, 1)
         nptest.assert_almost_equal(np.sum(self.lam_vol), 1.0)
 
+    def test_sequential(self):
+        """
+        Check that sequential MC stops at the relative error or the budget.
+        """
+        rel_error = self.s_set.estimate_volume(n_mc_points=100, rel_tol=0.05,
+                                               max_mc_points=int(1E5))
+        self.assertTrue(np.all(rel_error <= 0.05))
+        nptest.assert_array_almost_equal(self.s_set._volumes,
+                                         self.volume_exact, 1)
+        nptest.assert_almost_equal(np.sum(self.s_set._volumes), 1.0)
+
+        rel_error = self.s_set.estimate_volume(n_mc_points=100, rel_tol=1E-4,
+                                               max_mc_points=250)
+        self.assertTrue(np.any(rel_error > 1E-4))
+        nptest.assert_array_almost_equal(self.s_set._volumes*250,
+                                         np.round(self.s_set._volumes*250))
+
 
 class TestEstimateVolumeEmulated(unittest.TestCase):
     """
@@ -967,6 +1719,17 @@ class TestEstimateLocalVolume(unittest.TestCase):
         nptest.assert_array_almost_equal(self.lam_vol, self.volume_exact, 2)
         nptest.assert_almost_equal(np.sum(self.lam_vol), 1.0)
 
+    def test_missing_radii(self):
+        """
+        Check that radii missing from ``_normalized_radii`` are estimated from
+        the nearest neighbors.
+        """
+        self.s_set._normalized_radii = np.zeros((self.s_set.check_num(),))
+        self.s_set.estimate_local_volume()
+        nptest.assert_array_almost_equal(self.s_set._volumes,
+                                         self.volume_exact, 2)
+        nptest.assert_almost_equal(np.sum(self.s_set._volumes), 1.0)
+
 
 class TestExactVolume1D(unittest.TestCase):
     """
@@ -1036,6 +1799,55 @@ class TestExactVolume2D(unittest.TestCase):
         nptest.assert_almost_equal(np.sum(self.vol1), 1.0)
 
 
+class TestExactVolumeND(unittest.TestCase):
+    """
+    Test :meth:`bet.sample.voronoi_sample_set.exact_volume_nD`.
+    """
+
+    def setUp(self):
+        """
+        Set up a regular grid and random samples in 3D.
+        """
+        sampler = bsam.sampler(None)
+        self.regular = sample.sample_set(3)
+        self.regular.set_domain(np.array([[0.0, 1.0], [0.0, 2.0],
+                                          [-1.0, 1.0]]))
+        self.regular = sampler.regular_sample_set(
+            self.regular, num_samples_per_dim=[4, 3, 5])
+        self.random = sample.sample_set(3)
+        self.random.set_domain(np.array([[0.0, 1.0], [0.0, 1.0], [0.0, 1.0]]))
+        self.random.set_values(comm.bcast(np.random.random((100, 3))))
+
+    def test_volumes(self):
+        """
+        Check that the volumes of a regular grid of samples are exact.
+        """
+        self.regular.exact_volume_nD()
+        nptest.assert_array_almost_equal(self.regular._volumes, 1.0/60.0)
+
+    def test_sum_to_1(self):
+        """
+        Check that the volumes of random samples sum to 1 when every sample
+        near the boundary is reflected.
+        """
+        self.random.exact_volume_nD(side_ratio=1.0)
+        nptest.assert_almost_equal(np.sum(self.random._volumes), 1.0)
+        nptest.assert_array_less(0.0, self.random._volumes)
+
+    def test_2D(self):
+        """
+        Check that the volumes in 2D match those of the Monte Carlo estimate.
+        """
+        s_set = sample.sample_set(2)
+        s_set.set_domain(np.array([[0.0, 1.0], [0.0, 1.0]]))
+        s_set.set_values(comm.bcast(np.random.random((50, 2))))
+        s_set.exact_volume_nD(side_ratio=1.0)
+        vol1 = np.copy(s_set._volumes)
+        s_set.estimate_volume(n_mc_points=int(1E5))
+        nptest.assert_almost_equal(np.sum(vol1), 1.0)
+        nptest.assert_array_almost_equal(vol1, s_set._volumes, 2)
+
+
 class TestEstimateRadii(unittest.TestCase):
     """
     Test :meth:`bet.calculateP.calculateP.estimate_radii`.
@@ -1271,6 +2083,24 @@ class Test_rectangle_sample_set(unittest.TestCase):
         (d, ptr) = self.sam_set.query(x)
         nptest.assert_array_equal(ptr, [1, 0, 2])
 
+    def test_query_index(self):
+        """
+        Check that indexed queries return the first containing rectangle.
+        """
+        mins = np.random.random((200, self.dim))
+        maxes = mins + 0.2*np.random.random((200, self.dim))
+        self.sam_set.setup(maxes, mins)
+        x = np.random.random((500, self.dim))
+        x[0:10] = maxes[0:10]
+        in_rec = np.logical_and(
+            np.all(x[:, np.newaxis, :] <= maxes[np.newaxis], axis=2),
+            np.all(x[:, np.newaxis, :] > mins[np.newaxis], axis=2))
+        expected = np.where(np.any(in_rec, axis=1), np.argmax(in_rec, axis=1),
+                            200)
+        (d, ptr) = self.sam_set.query(x)
+        nptest.assert_array_equal(ptr, expected)
+        nptest.assert_array_equal(d, np.where(expected < 200, 0.0, np.inf))
+
     def test_volumes(self):
         """
         Check volume calculation
@@ -1403,6 +2233,26 @@ class Test_ball_sample_set(unittest.TestCase):
         (d, ptr) = self.sam_set.query(x)
         nptest.assert_array_equal(ptr, [0, 2, 1])
 
+    def test_query_index(self):
+        """
+        Check that indexed queries return the first containing ball.
+        """
+        centers = np.random.random((300, self.dim))
+        radii = 0.1*np.random.random((300,))
+        self.sam_set.setup(centers, radii)
+        x = np.random.random((500, self.dim))
+        for p_norm in [1.0, 2.0, np.inf]:
+            self.sam_set.set_p_norm(p_norm)
+            in_ball = np.less(np.linalg.norm(x[:, np.newaxis, :] -
+                                             centers[np.newaxis], p_norm,
+                                             axis=2), radii[np.newaxis])
+            expected = np.where(np.any(in_ball, axis=1),
+                                np.argmax(in_ball, axis=1), 300)
+            (d, ptr) = self.sam_set.query(x)
+            nptest.assert_array_equal(ptr, expected)
+            nptest.assert_array_equal(d, np.where(expected < 300, 0.0,
+                                                  np.inf))
+
     def test_volumes(self):
         """
         Check volume calculation
@@ -1541,6 +2391,23 @@ class Test_cartesian_sample_set(unittest.TestCase):
         (d, ptr) = self.sam_set.query(x)
         nptest.assert_array_equal(ptr, [0, 3, 1, 2, 4])
 
+    def test_query_grid(self):
+        """
+        Check that grid queries match the rectangle query.
+        """
+        xi = [np.sort(np.random.random((5,))), np.linspace(0, 1, 7)]
+        self.sam_set.setup(xi)
+        rec_set = sample.rectangle_sample_set(dim=self.dim)
+        rec_set.setup(self.sam_set._right[0:-1], self.sam_set._left[0:-1])
+        x = np.random.random((500, self.dim))
+        x[0:10] = self.sam_set._right[0:10]
+        for k in [1, 3]:
+            (d, ptr) = self.sam_set.query(x, k)
+            (rec_d, rec_ptr) = rec_set.query(x, k)
+            nptest.assert_array_equal(ptr, rec_ptr)
+            nptest.assert_array_equal(d, rec_d)
+        self.assertIsNone(self.sam_set._rectangle_index[2])
+
     def test_volumes(self):
         """
         Check volume calculation
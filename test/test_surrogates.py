@@ -113,6 +113,29 @@ class Test_piecewise_polynomial_surrogate_3_to_2(unittest.TestCase):
                                                       regions=[0],
                                                       update_input=True)
 
+    def test_copied_discretization(self):
+        """
+        Test the surrogate of a shallow copied discretization leaves the
+        original unchanged.
+        """
+        disc = self.sur.input_disc
+        values = np.copy(disc._output_sample_set._values_local)
+        sur = surrogates.piecewise_polynomial_surrogate(disc.shallow_copy())
+        iss = bsam.random_sample_set('r', disc._input_sample_set._domain,
+                                     num_samples=10, globalize=False)
+        sur_disc = sur.generate_for_input_set(iss, order=1)
+        s_set = sur_disc._input_sample_set.copy()
+        sur_disc.set_io_ptr()
+        s_set.set_region_local(np.equal(sur_disc._io_ptr_local, 0))
+        s_set.local_to_global()
+        (probabilities, error_estimates) = \
+            sur.calculate_prob_for_sample_set_region(s_set, regions=[0])
+        self.assertEqual(len(probabilities), 1)
+        self.assertEqual(len(error_estimates), 1)
+        nptest.assert_array_equal(disc._output_sample_set._values_local,
+                                  values)
+        self.assertTrue(disc._output_sample_set._values_local.flags.writeable)
+
 
 class Test_piecewise_polynomial_surrogate_3_to_1(unittest.TestCase):
     """
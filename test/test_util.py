@@ -88,6 +88,63 @@ def compare_get_global_values(i, provide_shape):
     nptest.assert_array_equal(original_array, recomposed_array)
 
 
+def test_get_global_values_dtypes():
+    """
+    Tests :meth:`bet.util.get_global_values` for arrays of different types
+    and dimensions.
+    """
+    for dtype in [np.int32, np.int64, np.float32, np.bool_, np.complex128]:
+        for shape in [(), (2,), (3, 2)]:
+            for first_rows in [0, 1]:
+                yield compare_get_global_values_dtype, dtype, shape, \
+                    first_rows
+
+
+def compare_get_global_values_dtype(dtype, shape, first_rows):
+    """
+    Compares the results of get global values for arrays with a different
+    number of rows on each processor to the global array.
+
+    :param dtype: type of the array
+    :param tuple shape: shape of the rows of the array
+    :param int first_rows: number of rows on the first processor, the next
+        processors hold one more row each
+
+    """
+    nums = first_rows + np.arange(comm.size)
+    offsets = np.cumsum(nums) - nums
+    global_shape = (int(np.sum(nums)),) + shape
+    global_array = np.arange(np.prod(global_shape)).reshape(global_shape)
+    if dtype is np.bool_:
+        global_array = global_array % 3 == 1
+    elif dtype is np.complex128:
+        global_array = global_array - 1j*global_array
+    global_array = global_array.astype(dtype)
+    my_array = global_array[offsets[comm.rank]:offsets[comm.rank] +
+                            nums[comm.rank]]
+    recomposed_array = util.get_global_values(my_array)
+    assert recomposed_array.dtype == my_array.dtype
+    nptest.assert_array_equal(recomposed_array, global_array)
+
+
+def test_get_global_values_at():
+    """
+    Tests :meth:`bet.util.get_global_values_at` and
+    :meth:`bet.util.get_root_values` against the global array.
+    """
+    my_array = np.arange(2*(comm.rank+1)).reshape((comm.rank+1, 2)) + \
+        comm.rank*(comm.rank+1)
+    global_array = util.get_global_values(my_array)
+    index = np.array([[len(global_array)-1, 0], [comm.rank, 0]])
+    nptest.assert_array_equal(util.get_global_values_at(my_array, index),
+                              global_array[index])
+    root_array = util.get_root_values(my_array)
+    if comm.rank == 0:
+        nptest.assert_array_equal(root_array, global_array)
+    else:
+        assert root_array is None
+
+
 def test_fix_dimensions_vector():
     """
     Tests :meth:`bet.util.fix_dimensions_vector`